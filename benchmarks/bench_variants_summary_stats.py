@@ -0,0 +1,76 @@
+"""Micro-benchmark of the per-variant summary statistics of a VariantCallsSlice
+
+Compares the fused single-pass kernel with the pandas, NumPy and scikit-allel based implementations on a
+synthetic matrix of alternate allele counts and checks that all of them yield the same values.
+
+Usage:
+    python benchmarks/bench_variants_summary_stats.py --variants 20000 --samples 1000
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from divbrowse.lib.variant_calls_slice import VariantCallsSlice
+
+
+IMPLEMENTATIONS = {
+    'pandas': 'calc_variants_summary_stats',
+    'numpy': 'calc_variants_summary_stats_numpy',
+    'scikitallel': 'calc_variants_summary_stats_scikitallel',
+    'fused': 'calc_variants_summary_stats_fused'
+}
+
+
+
+def make_slice(count_variants: int, count_samples: int, missing_rate: float, seed: int) -> VariantCallsSlice:
+    """Creates a diploid slice with random calls without going through GenotypeData"""
+
+    rng = np.random.default_rng(seed)
+    n_alt = rng.integers(0, 3, size=(count_samples, count_variants), dtype=np.int8)
+    n_alt[rng.random(n_alt.shape) < missing_rate] = -1
+
+    slice = VariantCallsSlice.__new__(VariantCallsSlice)
+    slice.sliced_variant_calls = None
+    slice.ploidy = 2
+    slice.numbers_of_alternate_alleles = n_alt
+    slice.missing_mask = n_alt == -1
+    return slice
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--variants', type=int, default=20000)
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--missing-rate', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip', action='append', default=[], choices=list(IMPLEMENTATIONS.keys()), help='Implementation to leave out, e.g. the slow pandas one')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    slice = make_slice(args.variants, args.samples, args.missing_rate, args.seed)
+    print('{:d} variants x {:d} samples, best of {:d} runs'.format(args.variants, args.samples, args.repeat))
+
+    reference = None
+    for name, method in IMPLEMENTATIONS.items():
+        if name in args.skip:
+            continue
+
+        calc = getattr(slice, method)
+        seconds = min(timeit.repeat(calc, number=1, repeat=args.repeat))
+        result = {key: np.asarray(values, dtype=np.float64) for key, values in calc().items()}
+
+        if reference is None:
+            reference = result
+            deviation = 0.0
+        else:
+            deviation = max(float(np.nanmax(np.abs(result[key] - reference[key]), initial=0)) for key in reference)
+
+        print('{:<12s} {:10.4f} s   max deviation {:.2e}'.format(name, seconds, deviation))
+
+
+
+if __name__ == '__main__':
+    main()
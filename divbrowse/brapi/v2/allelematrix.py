@@ -79,15 +79,11 @@ class BrapiAllelematrix():
 
         if self.has_position_range:
 
-            location_start, lookup_type_start = self.gd.get_posidx_by_genome_coordinate(self.input['chrom'], self.input['startpos'])
-            location_end, lookup_type_end = self.gd.get_posidx_by_genome_coordinate(self.input['chrom'], self.input['endpos'])
-            location_end = location_end + 1
+            # all variants with startpos <= POS <= endpos
+            self.slice_variant_calls = self.gd.position_index.locate_range(self.input['chrom'], self.input['startpos'], self.input['endpos'])
+            self.slice_variants_indices = np.arange(self.slice_variant_calls.start, self.slice_variant_calls.stop, 1)
 
-            self.slice_variant_calls = slice(location_start, location_end, None)
-            self.slice_variants_indices = np.arange(location_start, location_end, 1)
-            positions = self.gd.pos[self.slice_variant_calls]
-
-            self.count_variants = len(positions)
+            self.count_variants = len(self.slice_variants_indices)
 
         else:
             self.count_variants = self.gd.count_variants
@@ -36,6 +36,26 @@ def get_chromosomes(path_zarr):
     return chromosomes
 
 
+def resolve_path_zarr(path_zarr):
+    """Returns the given path of the Zarr archive or the one configured in `divbrowse.config.yml`, exits if it does not exist"""
+
+    if path_zarr == None:
+        try:
+            with open('divbrowse.config.yml') as config_file:
+                config = yaml.full_load(config_file)
+        except FileNotFoundError:
+            log.error('Divbrowse config file `divbrowse.config.yml` not found in current directory!')
+            exit(1)
+
+        path_zarr = config['datadir'] + config['variants']['zarr_dir']
+
+    if not os.path.exists(path_zarr):
+        log.error('The Zarr archive does not exist or is not accessible: '+str(path_zarr))
+        exit(1)
+
+    return path_zarr
+
+
 
 @click.group()
 @click.version_option(prog_name='DivBrowse', version=DIVBROWSE_VERSION)
@@ -45,12 +65,131 @@ def main():
 
 
 @click.command()
-def calcsumstats():
+@click.option('--path-zarr', help='Full path to the Zarr archive. If not given, the Zarr archive configured in `divbrowse.config.yml` is used')
+@click.option('--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of CPUs')
+@click.option('--overwrite', is_flag=True, help='If set: discard already calculated statistics instead of resuming an interrupted calculation')
+def calcsumstats(path_zarr: str, workers: int, overwrite: bool):
+    """Precompute per-variant and per-sample summary statistics and save them in the Zarr archive"""
+
+    from divbrowse.lib.variants_stats import write_variants_stats
 
     click.echo('Starting calculation of variant summary statistics...')
     log.info('Starting calculation of variant summary statistics...')
 
-    from divbrowse.lib.annotation_data import AnnotationData
+    path_zarr = resolve_path_zarr(path_zarr)
+
+    def progress(count_processed, count_chunks):
+        click.echo('Processed '+str(count_processed)+' of '+str(count_chunks)+' chunks')
+
+    write_variants_stats(path_zarr, workers=workers, overwrite=overwrite, progress=progress)
+
+    click.secho('Calculation of variant summary statistics finished.', fg='green')
+
+
+
+
+
+@click.command()
+@click.option('--path-zarr', help='Full path to the Zarr archive. If not given, the Zarr archive configured in `divbrowse.config.yml` is used')
+@click.option('--chunk-variants', type=int, default=None, help='Chunk length along the variants axis. Defaults to the one of calldata/GT')
+@click.option('--chunk-samples', type=int, default=None, help='Chunk length along the samples axis. Defaults to the one of calldata/GT')
+@click.option('--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of CPUs')
+@click.option('--overwrite', is_flag=True, help='If set: discard an existing calldata/NALT array instead of resuming an interrupted conversion')
+def calcnalt(path_zarr: str, chunk_variants: int, chunk_samples: int, workers: int, overwrite: bool):
+    """Precompute the number of alternate alleles of all genotype calls and save them as calldata/NALT in the Zarr archive"""
+
+    from divbrowse.lib.derived_calldata import write_nalt
+
+    click.echo('Starting calculation of the numbers of alternate alleles...')
+    log.info('Starting calculation of the numbers of alternate alleles...')
+
+    path_zarr = resolve_path_zarr(path_zarr)
+
+    def progress(count_processed, count_chunks):
+        click.echo('Processed '+str(count_processed)+' of '+str(count_chunks)+' chunks')
+
+    try:
+        write_nalt(path_zarr, chunk_variants=chunk_variants, chunk_samples=chunk_samples, workers=workers, overwrite=overwrite, progress=progress)
+    except ValueError as error:
+        log.error(str(error))
+        exit(1)
+
+    click.secho('Calculation of the numbers of alternate alleles finished.', fg='green')
+
+
+
+
+
+@click.command()
+@click.option('--path-zarr', help='Full path to the Zarr archive. If not given, the Zarr archive configured in `divbrowse.config.yml` is used')
+@click.option('--array', 'array_name', type=click.Choice(['GT', 'NALT']), default='GT', help='Array of the calldata group that should be replicated', show_default=True)
+@click.option('--chunk-variants', type=int, default=65536, help='Chunk length of the replica along the variants axis', show_default=True)
+@click.option('--chunk-samples', type=int, default=16, help='Chunk length of the replica along the samples axis', show_default=True)
+@click.option('--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of CPUs')
+@click.option('--overwrite', is_flag=True, help='If set: discard an existing replica instead of resuming an interrupted run')
+def rechunk(path_zarr: str, array_name: str, chunk_variants: int, chunk_samples: int, workers: int, overwrite: bool):
+    """Write a replica of calldata/GT or calldata/NALT with narrow sample chunks for queries on small subsets of the samples"""
+
+    from divbrowse.lib.derived_calldata import write_replica
+
+    click.echo('Starting to write the rechunked replica of calldata/'+array_name+'...')
+    log.info('Starting to write the rechunked replica of calldata/'+array_name+'...')
+
+    path_zarr = resolve_path_zarr(path_zarr)
+
+    def progress(count_processed, count_blocks):
+        click.echo('Processed '+str(count_processed)+' of '+str(count_blocks)+' blocks')
+
+    write_replica(path_zarr, source='calldata/'+array_name, chunk_variants=chunk_variants, chunk_samples=chunk_samples, workers=workers, overwrite=overwrite, progress=progress)
+
+    click.secho('Rechunked replica of calldata/'+array_name+' written.', fg='green')
+
+
+
+
+
+@click.command()
+@click.option('--path-zarr', help='Full path to the Zarr archive. If not given, the Zarr archive configured in `divbrowse.config.yml` is used')
+@click.option('--bin-sizes', default='1000,10000,100000,1000000', help='Comma-separated list of bin sizes in base pairs', show_default=True)
+def calcdensitytracks(path_zarr: str, bin_sizes: str):
+    """Precompute genome-wide density tracks at multiple resolutions for zoomed-out views
+
+    The density tracks and the position index are saved next to the Zarr archive, i.e. in the `datadir` of the DivBrowse config.
+    """
+
+    from divbrowse.lib.density_tracks import write_density_tracks
+
+    path_zarr = resolve_path_zarr(path_zarr)
+    datadir = os.path.dirname(os.path.normpath(path_zarr)) + os.sep
+
+    def progress(chrom, count_processed):
+        click.echo('Chromosome '+str(chrom)+': processed '+str(count_processed)+' variants')
+
+    write_density_tracks(
+        path_zarr = path_zarr,
+        path_density_tracks = datadir + '____density_tracks____.zarr',
+        path_position_index = datadir + '____position_index____',
+        bin_sizes = [int(bin_size) for bin_size in bin_sizes.split(',')],
+        progress = progress
+    )
+
+    click.secho('Calculation of density tracks finished.', fg='green')
+
+
+
+
+
+@click.command()
+@click.option('--chromosomes', default=None, help='Comma-separated list of chromosome IDs. Defaults to all chromosomes')
+@click.option('--components', type=int, default=10, help='Number of principal components', show_default=True)
+@click.option('--iterations', type=int, default=4, help='Number of power iterations of the streaming PCA', show_default=True)
+@click.option('--umap-neighbors', type=int, default=15, help='n_neighbors parameter of UMAP', show_default=True)
+@click.option('--no-umap', is_flag=True, help='If set: only calculate the PCA')
+@click.option('--overwrite', is_flag=True, help='If set: recalculate chromosomes whose embeddings have already been saved')
+def calcembeddings(chromosomes: str, components: int, iterations: int, umap_neighbors: int, no_umap: bool, overwrite: bool):
+    """Precompute PCA and UMAP embeddings of all samples for whole chromosomes"""
+
+    from divbrowse.lib.embeddings import write_embeddings
     from divbrowse.lib.genotype_data import GenotypeData
 
     try:
@@ -61,10 +200,23 @@ def calcsumstats():
         exit(1)
 
     gd = GenotypeData(config)
-    ad = AnnotationData(config, gd)
 
-    vcf_header_lines = gd.get_vcf_header()
-    print(vcf_header_lines)
+    def progress(chrom):
+        click.echo('Chromosome '+str(chrom)+': embeddings saved')
+
+    write_embeddings(
+        gd,
+        path_embeddings = config['datadir'] + '____embeddings____.zarr',
+        chromosomes = chromosomes.split(',') if chromosomes else None,
+        n_components = components,
+        n_iter = iterations,
+        umap_n_neighbors = umap_neighbors,
+        with_umap = not no_umap,
+        overwrite = overwrite,
+        progress = progress
+    )
+
+    click.secho('Calculation of embeddings finished.', fg='green')
 
 
 
@@ -242,6 +394,10 @@ def start(host: str, port: str, infer_config: bool, save_config):
 main.add_command(vcf2zarr)
 main.add_command(start)
 main.add_command(calcsumstats)
+main.add_command(calcdensitytracks)
+main.add_command(calcembeddings)
+main.add_command(calcnalt)
+main.add_command(rechunk)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -5,15 +5,15 @@ import numpy as np
 
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import RobustScaler
-from sklearn.metrics import pairwise_distances
 import umap
 
 from divbrowse import log
+from divbrowse.lib.distances import count_non_reference_calls, hamming_distance_matrix, pack_genotype_planes
 from divbrowse.lib.variant_calls_slice import VariantCallsSlice
 
 
 
-def calculate_mean(sliced_variant_calls: np.ndarray) -> np.ndarray:
+def calculate_mean(sliced_variant_calls: np.ndarray, missing_mask: np.ndarray = None) -> np.ndarray:
     """Calculate the mean for each variant of a variant matrix array holding the number of alternate alleles
 
     Note:
@@ -21,71 +21,239 @@ def calculate_mean(sliced_variant_calls: np.ndarray) -> np.ndarray:
 
     Args:
         sliced_variant_calls (numpy.ndarray): Numpy array representing a variant matrix holding the number of alternate allele calls
+        missing_mask (numpy.ndarray): Boolean mask of missing calls, derived from the -1 values if not given
 
     Returns:
         numpy.ndarray: Numpy array holding the means per variant
     """
 
-    sliced_variant_calls_missing_values_to_nan = np.where(sliced_variant_calls == -1, np.nan, sliced_variant_calls)
-    return np.nanmean(sliced_variant_calls_missing_values_to_nan, axis=0) #, keepdims=True
+    return VariantCallsSlice.calculate_mean(sliced_variant_calls, missing_mask)
 
 
-def impute_with_mean(sliced_variant_calls: np.ndarray) -> np.ndarray:
+def impute_with_mean(sliced_variant_calls: np.ndarray, missing_mask: np.ndarray = None) -> np.ndarray:
     """variant matrix array for that missing values should be imputed (replaced) with the mean for the variant
 
     Args:
         sliced_variant_calls (numpy.ndarray): Numpy array representing a variant matrix holding the number of alternate allele calls
+        missing_mask (numpy.ndarray): Boolean mask of missing calls, derived from the -1 values if not given
 
     Returns:
-        numpy.ndarray: Imputed version of the input variant matrix array
+        numpy.ndarray: Imputed version of the input variant matrix array (float32)
     """
 
-    imputed = np.copy(sliced_variant_calls).astype(np.float32)
-    means = calculate_mean(sliced_variant_calls)
-    indices_missing = np.where(sliced_variant_calls == -1)
-    imputed[indices_missing] = np.take(means, indices_missing[1])
-    imputed = np.nan_to_num(imputed)
+    if missing_mask is None:
+        missing_mask = sliced_variant_calls == -1
+
+    means = np.nan_to_num(calculate_mean(sliced_variant_calls, missing_mask)).astype(np.float32)
+
+    # the float32 copy is the only full-size allocation, missing calls are overwritten in place
+    imputed = sliced_variant_calls.astype(np.float32)
+    np.copyto(imputed, np.broadcast_to(means, imputed.shape), where=missing_mask)
     return imputed
 
 
+def scale_and_center_block(sliced_variant_calls: np.ndarray, missing_mask: np.ndarray = None) -> np.ndarray:
+    """Imputes, robust-scales and centers a block of variants as `Analysis.pca()` does for a whole slice
+
+    All three steps work per variant (column), so that blocks of variants can be processed independently.
+    Scaling follows `sklearn.preprocessing.RobustScaler`: the median is subtracted and the result is divided
+    by the interquartile range (or 1 if it is 0).
+
+    Args:
+        sliced_variant_calls (numpy.ndarray): Numpy array representing a variant matrix holding the number of alternate allele calls
+        missing_mask (numpy.ndarray): Boolean mask of missing calls, derived from the -1 values if not given
+
+    Returns:
+        numpy.ndarray: Centered float32 block of shape (samples, variants)
+    """
+
+    block = impute_with_mean(sliced_variant_calls, missing_mask)
+
+    q25, median, q75 = np.percentile(block, [25, 50, 75], axis=0)
+    scale = q75 - q25
+    scale[scale == 0] = 1
+
+    block -= median.astype(np.float32)
+    block /= scale.astype(np.float32)
+    block -= block.mean(axis=0, dtype=np.float64).astype(np.float32)
+    return block
+
+
+def streaming_pca(gd, chrom, startpos, endpos, samples = None, variant_filter_settings = None, n_components = 10, n_iter = 4, oversampling = 10, block_size = None, random_state = 42, with_sample_ids = True):
+    """Calculates a PCA of a genomic region without holding its variant matrix in memory
+
+    The region is read block by block via `GenotypeData.iter_variant_call_blocks()`, each block is imputed,
+    scaled and centered with `scale_and_center_block()`. The principal components are found with a randomized
+    range finder (Halko et al. 2011) whose products with the variant matrix are accumulated over the blocks,
+    so only matrices of shape (samples, n_components + oversampling) are kept. The region is read
+    `n_iter + 2` times.
+
+    Args:
+        gd (GenotypeData): The genotype data instance
+        chrom (str): ID of the chromosome
+        startpos (int): First position of the genomic region
+        endpos (int): Last position of the genomic region
+        samples (list): List of sample IDs, defaults to all samples
+        variant_filter_settings (dict): Variant filter settings as for `GenotypeData.get_slice_of_variant_calls()`
+        n_components (int): Maximum number of principal components
+        n_iter (int): Number of power iterations
+        oversampling (int): Number of additional random vectors of the range finder
+        block_size (int): Number of variants per block, derived from the number of samples if not given
+        random_state (int): Seed of the random vectors
+        with_sample_ids (bool): Prepend the sample IDs as first column, otherwise the float64 coordinates are returned
+
+    Returns:
+        numpy.ndarray: PCA result aligned with the sample IDs in the first column
+        numpy.ndarray: Explained variance ratio of each component
+    """
+
+    start = timer()
+
+    samples_mask, samples_selected_mapped = gd.get_samples_mask(samples if samples is not None else gd.samples)
+    count_samples = int(np.count_nonzero(samples_mask))
+
+    if block_size is None:
+        # a block is held as int8 calls and as a float32 copy, keep it at about 256 MB
+        block_size = max(1, (256 * 1024 * 1024) // (max(count_samples, 1) * 12))
+
+    def iter_blocks():
+        for _, _, block in gd.iter_variant_call_blocks(chrom, startpos = startpos, endpos = endpos, samples = samples, variant_filter_settings = variant_filter_settings, block_size = block_size):
+            # if no variant of a block passes the filters, its matrix is left unfiltered
+            if block.filtered_positions_indices.shape[0] > 0:
+                yield scale_and_center_block(block.numbers_of_alternate_alleles, block.missing_mask)
+
+    # first pass: project on random vectors, count the variants and the total variance
+    rng = np.random.default_rng(random_state)
+    count_vectors = min(n_components + oversampling, count_samples)
+    projection = np.zeros((count_samples, count_vectors), dtype=np.float64)
+    count_variants = 0
+    total_variance = 0.0
+
+    for block in iter_blocks():
+        random_vectors = rng.standard_normal((block.shape[1], count_vectors)).astype(np.float32)
+        projection += block @ random_vectors
+        count_variants += block.shape[1]
+        total_variance += float(np.square(block, dtype=np.float64).sum())
+
+    n_components = min(n_components, count_samples, count_variants)
+    if n_components == 0:
+        return False
+
+    # power iterations: projection = X @ X.T @ basis
+    for _ in range(n_iter):
+        basis = np.linalg.qr(projection)[0].astype(np.float32)
+        projection = np.zeros_like(projection)
+        for block in iter_blocks():
+            projection += block @ (block.T @ basis)
+
+    # last pass: covariance of the data projected on the basis
+    basis = np.linalg.qr(projection)[0]
+    basis_float32 = basis.astype(np.float32)
+    covariance = np.zeros((basis.shape[1], basis.shape[1]), dtype=np.float64)
+    for block in iter_blocks():
+        projected = (block.T @ basis_float32).astype(np.float64)
+        covariance += projected.T @ projected
+
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    eigenvalues = np.clip(eigenvalues[order], 0, None)
+
+    pca_result = (basis @ eigenvectors[:, order]) * np.sqrt(eigenvalues)
+    # deterministic signs: the largest absolute coordinate of each component is positive
+    signs = np.sign(pca_result[np.argmax(np.abs(pca_result), axis=0), np.arange(n_components)])
+    pca_result *= np.where(signs == 0, 1, signs)
+
+    explained_variance_ratio = eigenvalues / total_variance if total_variance > 0 else np.zeros_like(eigenvalues)
+
+    log.debug("==== streaming PCA of %d variants calculation time: %f", count_variants, timer() - start)
+
+    if not with_sample_ids:
+        return pca_result, explained_variance_ratio
+
+    sample_ids = np.array(samples_selected_mapped).reshape((-1, 1)).copy()
+    pca_result_combined = np.concatenate((sample_ids, pca_result), axis=1)
+    return pca_result_combined, explained_variance_ratio
+
+
+def calc_umap(features: np.ndarray, sample_ids: list = None, n_neighbors: int = 15) -> np.ndarray:
+    """Calculate UMAP for a feature matrix of shape (samples, features)
+
+    Args:
+        features (numpy.ndarray): Imputed variant calls or principal components of the samples
+        sample_ids (list): Sample IDs in the order of the rows, if not given only the coordinates are returned
+        n_neighbors (int): `n_neighbors` parameter of umap.UMAP() method
+
+    Returns:
+        numpy.ndarray: UMAP result aligned with the sample IDs in the first column
+    """
+
+    start = timer()
+    umap_result = umap.UMAP(n_components = 2, n_neighbors=n_neighbors, metric='euclidean', random_state=42).fit_transform(features) # , random_state=42, densmap=True  , min_dist=0.5   , dens_lambda=5
+    log.debug("==== UMAP calculation time: %f", timer() - start)
+
+    if sample_ids is None:
+        return umap_result
+
+    sample_ids = np.array(sample_ids).reshape((-1, 1)).copy()
+    umap_result_combined = np.concatenate((sample_ids, umap_result), axis=1)
+    return umap_result_combined
+
+
 
 class Analysis:
 
-    def __init__(self, variant_calls_slice: VariantCallsSlice):
+    def __init__(self, variant_calls_slice: VariantCallsSlice, executor = None):
         self.variant_calls_slice = variant_calls_slice # self.variant_calls_slice.samples_selected_mapped
+        self.executor = executor # shared ComputeExecutor of the server, distance calculations are tiled onto it
         self.imputed_calls = None
+        self.genotype_planes = None
 
 
     def get_imputed_calls(self):
         if self.imputed_calls is None:
-            self.imputed_calls = impute_with_mean(self.variant_calls_slice.numbers_of_alternate_alleles)
+            self.imputed_calls = impute_with_mean(self.variant_calls_slice.numbers_of_alternate_alleles, self.variant_calls_slice.missing_mask)
         
         return self.imputed_calls
 
 
-    def calc_distance_to_reference(self, samples):
+    def get_genotype_planes(self):
+        """Returns the bit-packed codes of the mean-imputed calls, see `pack_genotype_planes()`"""
 
-        calls_imputed = self.get_imputed_calls()
+        if self.genotype_planes is None:
+            n_alt = self.variant_calls_slice.numbers_of_alternate_alleles
+            missing_mask = self.variant_calls_slice.missing_mask
+            means = calculate_mean(n_alt, missing_mask)
+            self.genotype_planes = pack_genotype_planes(n_alt, missing_mask, means)
+
+        return self.genotype_planes
+
+
+    def calc_distance_to_reference(self, samples, missing = 'impute'):
+        """Calculates the Hamming distance of each sample to the reference, i.e. the number of variants with a non-reference call
+
+        Args:
+            samples (numpy.ndarray): All sample IDs of the variant matrix
+            missing (str): Handling of missing calls, see `count_non_reference_calls()`
 
-        ref_vec = np.zeros(self.variant_calls_slice.numbers_of_alternate_alleles.shape[1]).reshape(1, self.variant_calls_slice.numbers_of_alternate_alleles.shape[1])
+        Returns:
+            numpy.ndarray: object array of shape (samples, 2) holding the sample ID and the distance (int)
+        """
 
         start = timer()
-        distances = pairwise_distances(calls_imputed, ref_vec, n_jobs=1, metric='hamming')
-        distances = distances * self.variant_calls_slice.numbers_of_alternate_alleles.shape[1]
-        distances = distances.astype(np.int16);
-        sample_ids = np.array(self.variant_calls_slice.samples_selected_mapped).reshape(samples[self.variant_calls_slice.samples_mask].shape[0], 1)
-        distances_combined = np.concatenate((sample_ids, distances), axis=1)
-        log.debug("==== pairwise_distances() calculation time: %f", timer() - start)
+        distances = count_non_reference_calls(self.variant_calls_slice.numbers_of_alternate_alleles, self.variant_calls_slice.missing_mask, missing=missing, executor=self.executor)
+        distances_combined = np.empty((samples[self.variant_calls_slice.samples_mask].shape[0], 2), dtype=object)
+        distances_combined[:, 0] = self.variant_calls_slice.samples_selected_mapped
+        distances_combined[:, 1] = distances.tolist()
+        log.debug("==== count_non_reference_calls() calculation time: %f", timer() - start)
         return distances_combined
 
     
     def calc_distance_matrix(self, samples):
-        calls_imputed = self.get_imputed_calls()
+        """Calculates the Hamming distances between all pairs of samples, i.e. the numbers of variants with different imputed calls"""
 
         start = timer()
-        distances = pairwise_distances(calls_imputed, n_jobs=4, metric='hamming')
-        distances = distances * self.variant_calls_slice.numbers_of_alternate_alleles.shape[1]
-        distances = distances.astype(np.int16);
+        distances = hamming_distance_matrix(self.get_genotype_planes(), executor=self.executor)
+        log.debug("==== hamming_distance_matrix() calculation time: %f", timer() - start)
         #sample_ids = np.array(self.variant_calls_slice.samples_selected_mapped).reshape(samples[self.variant_calls_slice.samples_mask].shape[0], 1)
         #distances_combined = np.concatenate((sample_ids, distances), axis=1)
         #log.debug("==== pairwise_distances() calculation time: %f", timer() - start)
@@ -135,12 +303,6 @@ class Analysis:
             numpy.ndarray: PCA result aligned with the sample IDs in the first column
         """
 
-        sample_ids = np.array(self.variant_calls_slice.samples_selected_mapped).reshape((-1, 1)).copy()
         #calls_imputed = impute_with_mean(self.variant_calls_slice.numbers_of_alternate_alleles)
         calls_imputed = self.get_imputed_calls()
-
-        start = timer()
-        umap_result = umap.UMAP(n_components = 2, n_neighbors=n_neighbors, metric='euclidean', random_state=42).fit_transform(calls_imputed) # , random_state=42, densmap=True  , min_dist=0.5   , dens_lambda=5
-        log.debug("==== UMAP calculation time: %f", timer() - start)
-        umap_result_combined = np.concatenate((sample_ids, umap_result), axis=1)
-        return umap_result_combined
\ No newline at end of file
+        return calc_umap(calls_imputed, self.variant_calls_slice.samples_selected_mapped, n_neighbors = n_neighbors)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
 import json
 
@@ -10,9 +11,59 @@ import zarr
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 
+from divbrowse.lib.position_index import get_pos_fingerprint
+
 #pandarallel.initialize(nb_workers=3, progress_bar=True)
 
 
+
+def sum_over_contained_intervals(outer_starts, outer_ends, inner_starts, inner_ends, inner_weights) -> np.ndarray:
+    """Sums the weights of all inner intervals that are fully contained in each outer interval
+
+    All intervals have to be located on the same sequence. The inner intervals are sorted by start, so all inner
+    intervals starting within an outer interval form a contiguous range whose weight sum is taken from a prefix sum.
+    Only inner intervals reaching beyond the end of an outer interval have to be subtracted individually.
+
+    Args:
+        outer_starts (numpy.ndarray): Start positions of the outer intervals (e.g. genes)
+        outer_ends (numpy.ndarray): End positions of the outer intervals
+        inner_starts (numpy.ndarray): Start positions of the inner intervals (e.g. exons)
+        inner_ends (numpy.ndarray): End positions of the inner intervals
+        inner_weights (numpy.ndarray): Weights of the inner intervals (e.g. number of variants)
+
+    Returns:
+        numpy.ndarray: Sum of the weights per outer interval
+    """
+
+    order = np.argsort(inner_starts, kind='stable')
+    inner_starts = inner_starts[order]
+    inner_ends = inner_ends[order]
+    inner_weights = inner_weights[order]
+    prefix_sum = np.concatenate(([0], np.cumsum(inner_weights)))
+
+    lo = np.searchsorted(inner_starts, outer_starts, side='left')
+    hi = np.searchsorted(inner_starts, outer_ends, side='right')
+    result = prefix_sum[hi] - prefix_sum[np.minimum(lo, hi)]
+
+    # number of inner intervals with start <= end of the outer interval < inner end
+    crossing = hi - np.searchsorted(np.sort(inner_ends), outer_ends, side='right')
+    flagged = np.flatnonzero(crossing > 0)
+
+    if flagged.size > 0 and inner_starts.size > 0:
+        # crossing inner intervals start within (outer end - longest inner interval, outer end]
+        max_length = int((inner_ends - inner_starts).max())
+        candidates_lo = np.maximum(lo[flagged], np.searchsorted(inner_starts, outer_ends[flagged] - max_length, side='left'))
+        candidates_hi = np.maximum(hi[flagged], candidates_lo)
+        lengths = candidates_hi - candidates_lo
+
+        owner = np.repeat(np.arange(flagged.size), lengths)
+        idx = np.repeat(candidates_lo - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) + np.arange(lengths.sum())
+        reaching_beyond = inner_ends[idx] > outer_ends[flagged][owner]
+        result[flagged] -= np.bincount(owner[reaching_beyond], weights=inner_weights[idx][reaching_beyond], minlength=flagged.size).astype(result.dtype)
+
+    return result
+
+
 class AnnotationData:
 
     def __init__(self, config, gd):
@@ -82,26 +133,15 @@ class AnnotationData:
         genes_with_descriptions = genes_with_descriptions.loc[ genes_with_descriptions['seqid'].isin(list(self.chrom_gff3_map.values())) ]
 
 
-        def count_exon_variants(row):
-            _chromosome_gff3 = row['seqid']
-            _chromosome_vcf = self.metadata_gff3['gff3_to_vcf_chromosome_mapping'][ _chromosome_gff3 ]
-            number_of_variants = self.gd.count_variants_in_window(str(_chromosome_vcf), row['start'], row['end'])
-            return number_of_variants
-
-        def count_genic_variants(row):
-            print(str(row['seqid'])+' / '+str(row['start']))
-            _chromosome_gff3 = row['seqid']
-            _chromosome_vcf = self.metadata_gff3['gff3_to_vcf_chromosome_mapping'][ _chromosome_gff3 ]
-            number_of_variants = self.gd.count_variants_in_window(str(_chromosome_vcf), row['start'], row['end'])
-            exons = self.genes.loc[(self.genes['seqid'] == row['seqid']) & (self.genes['start'] >= row['start']) & (self.genes['end'] <= row['end']) & (self.genes['type'] == 'exon')]
-            number_of_exon_variants = exons.apply(count_exon_variants, axis=1)
-            return pd.Series( [number_of_variants, number_of_exon_variants.sum() ], index=['number_of_variants', 'number_of_exon_variants'])
-
-
         if self.config['gff3']['count_exon_variants'] is True:
 
             geneStatsCacheFilename = self.datadir+'____gene_stats_.hdf5'
+            cache_signature = self._get_gene_stats_cache_signature()
             try:
+                cached_signature = pd.read_hdf(geneStatsCacheFilename, key='signature')
+                if not cached_signature.equals(cache_signature):
+                    raise FileNotFoundError('cached gene stats are outdated')
+
                 gene_list = pd.read_hdf(geneStatsCacheFilename, key='s')
                 print("++++ Loaded Pandas Dataframe for gene stats")
 
@@ -110,19 +150,18 @@ class AnnotationData:
                 #gene_list = merged[ ['ID', 'seqid', 'start', 'end', 'primary_confidence_class', 'description', 'Ontology_term', 'number_of_variants', 'number_of_exon_variants'] ].copy()
                 gene_list = merged.copy()
 
-            except FileNotFoundError:
+            except (FileNotFoundError, KeyError):
                 start = timer()
                 
                 print("++++ Count variants on genes and exons..........")
-                #genes_number_of_variants = genes_with_descriptions.parallel_apply(count_genic_variants, axis=1, result_type='expand')
-                #genes_with_descriptions = genes_with_descriptions.iloc[0:50]
-                genes_number_of_variants = genes_with_descriptions.apply(count_genic_variants, axis=1, result_type='expand')
-                print("==== genes_with_descriptions.parallel_apply() calculation time: ", timer() - start)
+                genes_number_of_variants = self._count_gene_and_exon_variants(genes_with_descriptions)
+                print("==== _count_gene_and_exon_variants() calculation time: ", timer() - start)
                 merged = pd.concat([genes_with_descriptions, genes_number_of_variants], axis=1)
 
                 #gene_list = merged[ ['ID', 'seqid', 'start', 'end', 'primary_confidence_class', 'description', 'number_of_variants', 'number_of_exon_variants'] ].copy()
                 gene_list = merged.copy()
                 gene_list.to_hdf(geneStatsCacheFilename, key='s', mode='w', complevel=5, complib='blosc:zstd')
+                cache_signature.to_hdf(geneStatsCacheFilename, key='signature', mode='a')
 
         else:
             gene_list = genes_with_descriptions
@@ -145,6 +184,116 @@ class AnnotationData:
         self.genes_grouped_by_seqid = genes_grouped_by_seqid
         self.genes_start_positions = genes_start_positions
 
+        self._create_feature_interval_index()
+
+
+    def _create_feature_interval_index(self):
+        """Creates a per-seqid interval index over all GFF3 features
+
+        Features of each seqid are sorted by start and augmented with the running maximum of their end positions.
+        All features overlapping a region lie between the first feature whose running maximum end reaches the region
+        start and the last feature starting before the region end.
+        """
+
+        feature_interval_index = {}
+        for seqid, features in self.genes.groupby('seqid'):
+            features = features.sort_values('start', kind='stable')
+            ends = features['end'].values
+            feature_interval_index[seqid] = {
+                'starts': features['start'].values,
+                'ends': ends,
+                'max_ends': np.maximum.accumulate(ends),
+                'row_positions': self.genes.index.get_indexer(features.index)
+            }
+
+        self.feature_interval_index = feature_interval_index
+
+
+    def get_features_in_region(self, chrom, startpos, endpos) -> pd.DataFrame:
+        """Returns all GFF3 features overlapping a genomic region
+
+        Args:
+            chrom (str): ID of the chromosome in the variant matrix
+            startpos (int): First position of the region
+            endpos (int): Last position of the region
+
+        Returns:
+            pandas.DataFrame: Overlapping features sorted by start position
+        """
+
+        seqid = self.chrom_gff3_map.get(str(chrom), None)
+        if seqid not in self.feature_interval_index:
+            return self.genes.iloc[0:0].reset_index(drop=True)
+
+        index = self.feature_interval_index[seqid]
+        lo = np.searchsorted(index['max_ends'], startpos, side='left')
+        hi = np.searchsorted(index['starts'], endpos, side='right')
+        candidates = np.arange(lo, max(lo, hi))
+        overlapping = candidates[ index['ends'][candidates] >= startpos ]
+
+        return self.genes.iloc[ index['row_positions'][overlapping] ].reset_index(drop=True)
+
+
+    def _get_gene_stats_cache_signature(self) -> pd.Series:
+        """Returns size and modification time of the GFF3 file and the fingerprint of the POS array of the Zarr archive to detect outdated caches"""
+
+        stat_gff3 = os.stat(self.path_gff3)
+        signature = {
+            'gff3_size': stat_gff3.st_size,
+            'gff3_mtime_ns': stat_gff3.st_mtime_ns
+        }
+        signature.update({'pos_' + key: value for key, value in get_pos_fingerprint(self.gd.callset).items()})
+
+        return pd.Series(signature, dtype=object)
+
+
+    def _count_gene_and_exon_variants(self, genes) -> pd.DataFrame:
+        """Counts the variants on each gene and on all exons located within each gene
+
+        Exon counts are joined to the genes via a sorted interval containment join per chromosome,
+        the chromosomes are processed in parallel.
+
+        Args:
+            genes (pandas.DataFrame): Genes with `seqid`, `start` and `end` columns
+
+        Returns:
+            pandas.DataFrame: Columns `number_of_variants` and `number_of_exon_variants` aligned to the index of `genes`
+        """
+
+        gff3_to_vcf = self.metadata_gff3['gff3_to_vcf_chromosome_mapping']
+        exons = self.genes.loc[(self.genes['type'] == 'exon'), ['seqid', 'start', 'end']]
+        exons_grouped_by_seqid = dict(list(exons.groupby('seqid')))
+
+        def count_on_seqid(seqid):
+            genes_on_seqid = genes.loc[(genes['seqid'] == seqid)]
+            _chromosome_vcf = [str(gff3_to_vcf[seqid])]
+            genes_starts = genes_on_seqid['start'].values
+            genes_ends = genes_on_seqid['end'].values
+
+            number_of_variants = self.gd.count_variants_in_windows(_chromosome_vcf * genes_starts.shape[0], genes_starts, genes_ends)
+            number_of_exon_variants = np.zeros(genes_starts.shape[0], dtype=np.int64)
+
+            if seqid in exons_grouped_by_seqid:
+                exons_on_seqid = exons_grouped_by_seqid[seqid]
+                exons_starts = exons_on_seqid['start'].values
+                exons_ends = exons_on_seqid['end'].values
+                exons_number_of_variants = self.gd.count_variants_in_windows(_chromosome_vcf * exons_starts.shape[0], exons_starts, exons_ends)
+                number_of_exon_variants = sum_over_contained_intervals(genes_starts, genes_ends, exons_starts, exons_ends, exons_number_of_variants)
+
+            return pd.DataFrame({
+                'number_of_variants': number_of_variants,
+                'number_of_exon_variants': number_of_exon_variants
+            }, index=genes_on_seqid.index)
+
+        seqids = pd.unique(genes['seqid']).tolist()
+        with ThreadPoolExecutor(max_workers=max(1, min(len(seqids), os.cpu_count() or 1))) as executor:
+            counts = list(executor.map(count_on_seqid, seqids))
+
+        if not counts:
+            return pd.DataFrame(columns=['number_of_variants', 'number_of_exon_variants'], index=genes.index)
+
+        return pd.concat(counts).loc[genes.index]
+
 
     def get_nearest_gene_start_pos(self, chrom, pos):
         seqid = self.chrom_gff3_map[chrom]
@@ -0,0 +1,330 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numcodecs
+from numcodecs.compat import ensure_bytes
+import zarr
+
+from divbrowse import log
+
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with a size budget and hit/miss counters
+
+    Args:
+        max_size (int): Maximum total size of all cached values
+        getsizeof (callable): Returns the size of a value, defaults to 1 per entry
+    """
+
+    def __init__(self, max_size: int, getsizeof=None):
+        self.max_size = int(max_size)
+        self.getsizeof = getsizeof if getsizeof is not None else (lambda value: 1)
+        self.current_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._sizes = {}
+        self._mutex = threading.Lock()
+
+
+    def get(self, key, default=None):
+        with self._mutex:
+            try:
+                value = self._values[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._values.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def set(self, key, value):
+        size = self.getsizeof(value)
+        if size > self.max_size:
+            return
+
+        with self._mutex:
+            if key in self._values:
+                self.current_size -= self._sizes.pop(key)
+                del self._values[key]
+
+            while self._values and self.current_size + size > self.max_size:
+                evicted_key, _ = self._values.popitem(last=False)
+                self.current_size -= self._sizes.pop(evicted_key)
+
+            self._values[key] = value
+            self._sizes[key] = size
+            self.current_size += size
+
+
+    def clear(self):
+        with self._mutex:
+            self._values.clear()
+            self._sizes.clear()
+            self.current_size = 0
+
+
+    def stats(self) -> dict:
+        with self._mutex:
+            return {
+                'entries': len(self._values),
+                'current_size': self.current_size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+
+def canonical_hash(obj) -> str:
+    """Returns a hex digest of a JSON-serializable object that does not depend on the order of dict keys"""
+
+    serialized = json.dumps(obj, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(serialized.encode('utf-8'), digest_size=20).hexdigest()
+
+
+
+class ResultCache:
+    """Two-tier cache for serialized analysis results: an in-memory LRU tier and an optional directory on disk
+
+    Values are bytes. A value found only on disk is copied into the memory tier. The disk tier evicts the
+    least recently used files (by modification time, which is updated on every hit) once `max_disk_bytes` is
+    exceeded and survives restarts of the server.
+
+    Args:
+        max_memory_bytes (int): Budget of the in-memory tier, 0 disables it
+        disk_dir (str): Directory of the disk tier, None disables it
+        max_disk_bytes (int): Budget of the disk tier
+    """
+
+    def __init__(self, max_memory_bytes: int, disk_dir: str = None, max_disk_bytes: int = 0):
+        self.memory = LRUCache(max_memory_bytes, getsizeof=len) if max_memory_bytes else None
+        self.disk_dir = disk_dir if disk_dir and max_disk_bytes else None
+        self.max_disk_bytes = int(max_disk_bytes)
+        self.disk_size = 0
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self._mutex = threading.Lock()
+
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            for filename in os.listdir(self.disk_dir):
+                path = os.path.join(self.disk_dir, filename)
+                if filename.endswith('.part'):
+                    os.remove(path)
+                elif filename.endswith('.bin'):
+                    self.disk_size += os.path.getsize(path)
+
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + '.bin')
+
+
+    def get(self, key: str) -> bytes:
+        if self.memory is not None:
+            value = self.memory.get(key)
+            if value is not None:
+                return value
+
+        if self.disk_dir is None:
+            return None
+
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._mutex:
+                self.disk_misses += 1
+            return None
+
+        with self._mutex:
+            self.disk_hits += 1
+
+        if self.memory is not None:
+            self.memory.set(key, value)
+
+        return value
+
+
+    def set(self, key: str, value: bytes):
+        if self.memory is not None:
+            self.memory.set(key, value)
+
+        if self.disk_dir is None or len(value) > self.max_disk_bytes:
+            return
+
+        path = self._get_path(key)
+        path_partial = path + '.' + str(threading.get_ident()) + '.part'
+        with open(path_partial, 'wb') as f:
+            f.write(value)
+
+        with self._mutex:
+            if os.path.exists(path):
+                self.disk_size -= os.path.getsize(path)
+            os.replace(path_partial, path)
+            self.disk_size += len(value)
+
+            if self.disk_size > self.max_disk_bytes:
+                self._evict_disk()
+
+
+    def _evict_disk(self):
+        entries = []
+        for filename in os.listdir(self.disk_dir):
+            if filename.endswith('.bin'):
+                stat = os.stat(os.path.join(self.disk_dir, filename))
+                entries.append((stat.st_mtime, stat.st_size, filename))
+
+        for _, size, filename in sorted(entries):
+            if self.disk_size <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, filename))
+            except FileNotFoundError:
+                continue
+            self.disk_size -= size
+
+
+    def stats(self) -> dict:
+        with self._mutex:
+            disk = {
+                'current_size': self.disk_size,
+                'max_size': self.max_disk_bytes,
+                'hits': self.disk_hits,
+                'misses': self.disk_misses
+            } if self.disk_dir is not None else None
+
+        return {
+            'memory': self.memory.stats() if self.memory is not None else None,
+            'disk': disk
+        }
+
+
+
+class DecodedChunkStore(zarr.storage.Store):
+    """Read-only Zarr store wrapper that keeps decoded chunks of selected arrays in an LRU cache
+
+    The wrapped arrays are presented to Zarr without compressor and filters, chunks of these arrays are
+    decompressed here once and then served from the cache as raw bytes. All other keys are passed through.
+
+    Args:
+        store (zarr.storage.BaseStore): The store of the Zarr archive
+        arrays (list): Paths of the arrays whose chunks should be cached, e.g. `calldata/GT`
+        cache (LRUCache): Cache for the decoded chunks, sized in bytes
+    """
+
+    def __init__(self, store, arrays: list, cache: LRUCache):
+        self._store = store
+        self._arrays = [zarr.storage.normalize_storage_path(path) for path in arrays]
+        self._codecs = {}
+        self._mutex = threading.Lock()
+        self.cache = cache
+
+
+    def _get_array_path(self, key: str):
+        for path in self._arrays:
+            if key.startswith(path + '/'):
+                return path
+        return None
+
+
+    def _get_codecs(self, path: str):
+        with self._mutex:
+            if path not in self._codecs:
+                meta = json.loads(ensure_bytes(self._store[path + '/.zarray']))
+                compressor = numcodecs.get_codec(meta['compressor']) if meta['compressor'] else None
+                filters = [numcodecs.get_codec(config) for config in (meta['filters'] or [])]
+                self._codecs[path] = (compressor, filters)
+            return self._codecs[path]
+
+
+    def __getitem__(self, key):
+        path = self._get_array_path(key)
+        if path is None:
+            return self._store[key]
+
+        name = key[len(path) + 1:]
+
+        if name == '.zarray':
+            meta = json.loads(ensure_bytes(self._store[key]))
+            meta['compressor'] = None
+            meta['filters'] = None
+            return json.dumps(meta).encode('ascii')
+
+        if name.startswith('.'):
+            return self._store[key]
+
+        chunk = self.cache.get(key)
+        if chunk is None:
+            compressor, filters = self._get_codecs(path)
+            chunk = self._store[key]
+            if compressor is not None:
+                chunk = compressor.decode(chunk)
+            for _filter in reversed(filters):
+                chunk = _filter.decode(chunk)
+            chunk = ensure_bytes(chunk)
+            self.cache.set(key, chunk)
+
+        return chunk
+
+
+    def __contains__(self, key):
+        return key in self._store
+
+
+    def __setitem__(self, key, value):
+        raise zarr.errors.ReadOnlyError()
+
+
+    def __delitem__(self, key):
+        raise zarr.errors.ReadOnlyError()
+
+
+    def __iter__(self):
+        return iter(self._store)
+
+
+    def __len__(self):
+        return len(self._store)
+
+
+    def keys(self):
+        return self._store.keys()
+
+
+    def listdir(self, path: str = ''):
+        return zarr.storage.listdir(self._store, path)
+
+
+    def getsize(self, path=None):
+        return zarr.storage.getsize(self._store, path)
+
+
+    def close(self):
+        if hasattr(self._store, 'close'):
+            self._store.close()
+
+
+
+def open_cached_callset(path_zarr: str, arrays: list, max_bytes: int):
+    """Opens a Zarr archive read-only, chunks of `arrays` are decoded through a shared LRU cache of `max_bytes` bytes
+
+    Returns:
+        zarr.hierarchy.Group: the opened Zarr group
+        LRUCache: the chunk cache or None if caching is disabled
+    """
+
+    if not max_bytes:
+        return zarr.open_group(path_zarr, mode='r'), None
+
+    log.debug("Decoded chunk cache with a budget of %d bytes for %s", max_bytes, ', '.join(arrays))
+    cache = LRUCache(max_bytes, getsizeof=len)
+    store = DecodedChunkStore(zarr.DirectoryStore(path_zarr), arrays=arrays, cache=cache)
+    return zarr.open_group(store, mode='r'), cache
@@ -0,0 +1,128 @@
+import base64
+
+import numpy as np
+from scipy.cluster.hierarchy import leaves_list
+from scipy.cluster.hierarchy import linkage as scipy_linkage
+from scipy.spatial.distance import squareform
+
+try:
+    import fastcluster
+except ImportError:
+    fastcluster = None
+
+
+LINKAGE_METHODS = ['single', 'complete', 'average', 'weighted']
+
+
+
+def condense_distance_matrix(distances: np.ndarray) -> np.ndarray:
+    """Returns the upper triangle of a symmetric distance matrix as condensed float64 vector in the order of `scipy.spatial.distance.squareform()`"""
+
+    return squareform(distances, checks=False).astype(np.float64, copy=False)
+
+
+
+def calc_linkage(distances: np.ndarray, method: str = 'average') -> np.ndarray:
+    """Hierarchical clustering of the samples from their pairwise distances
+
+    The linkage is calculated directly on the condensed distances, with `fastcluster` if it is installed
+    and with `scipy.cluster.hierarchy.linkage()` otherwise.
+
+    Args:
+        distances (numpy.ndarray): Symmetric distance matrix (samples x samples)
+        method (str): Linkage method, one of `LINKAGE_METHODS`
+
+    Returns:
+        numpy.ndarray: Linkage matrix of shape (samples - 1, 4) as defined by SciPy
+    """
+
+    if method not in LINKAGE_METHODS:
+        raise ValueError('Unknown linkage method '+str(method)+', available methods are: '+', '.join(LINKAGE_METHODS))
+
+    condensed = condense_distance_matrix(distances)
+
+    if fastcluster is not None:
+        return fastcluster.linkage(condensed, method=method, preserve_input=False)
+
+    return scipy_linkage(condensed, method=method)
+
+
+
+def downsample_matrix(matrix: np.ndarray, max_size: int) -> np.ndarray:
+    """Averages blocks of a square matrix, so that it has at most `max_size` rows and columns"""
+
+    size = matrix.shape[0]
+    if size <= max_size:
+        return matrix.astype(np.float64)
+
+    factor = -(-size // max_size)
+    borders = np.arange(0, size, factor)
+    counts = np.diff(np.append(borders, size))
+
+    sums = np.add.reduceat(np.add.reduceat(matrix.astype(np.float64), borders, axis=0), borders, axis=1)
+    return sums / np.outer(counts, counts)
+
+
+
+def quantize_matrix(matrix: np.ndarray):
+    """Scales a matrix linearly to the range 0-255
+
+    Returns:
+        numpy.ndarray: uint8 matrix
+        float: Value mapped to 0
+        float: Value mapped to 255
+    """
+
+    value_min = float(matrix.min()) if matrix.size > 0 else 0.0
+    value_max = float(matrix.max()) if matrix.size > 0 else 0.0
+    value_range = value_max - value_min if value_max > value_min else 1.0
+
+    quantized = np.rint((matrix - value_min) * (255 / value_range)).astype(np.uint8)
+    return quantized, value_min, value_max
+
+
+
+def calc_clustering_payload(distances: np.ndarray, sample_ids: list, method: str = 'average', max_size: int = 1024, palette: np.ndarray = None) -> dict:
+    """Clusters the samples and prepares a compact heatmap of the reordered distance matrix for client-side rendering
+
+    Binary arrays are base64-encoded and little-endian: the heatmap as uint8 row by row, the linkage matrix as float64.
+
+    Args:
+        distances (numpy.ndarray): Symmetric distance matrix (samples x samples)
+        sample_ids (list): Sample IDs in the order of the rows of the distance matrix
+        method (str): Linkage method, one of `LINKAGE_METHODS`
+        max_size (int): Maximum number of rows and columns of the heatmap, larger matrices are downsampled by averaging blocks
+        palette (numpy.ndarray): Optional uint8 array of shape (256, 3) mapping the quantized values to RGB colors
+
+    Returns:
+        dict: Dendrogram order, ordered sample IDs, linkage and heatmap
+    """
+
+    count_samples = distances.shape[0]
+
+    if count_samples > 1:
+        linkage = calc_linkage(distances, method=method)
+        order = leaves_list(linkage)
+    else:
+        linkage = np.empty((0, 4), dtype=np.float64)
+        order = np.arange(count_samples)
+
+    heatmap = downsample_matrix(distances[np.ix_(order, order)], max_size)
+    heatmap_quantized, value_min, value_max = quantize_matrix(heatmap)
+
+    payload = {
+        'order': order.tolist(),
+        'sample_ids': np.asarray(sample_ids)[order].tolist(),
+        'linkage_method': method,
+        'linkage': base64.b64encode(np.ascontiguousarray(linkage, dtype='<f8').tobytes()).decode('ascii'),
+        'heatmap': base64.b64encode(heatmap_quantized.tobytes()).decode('ascii'),
+        'heatmap_size': int(heatmap_quantized.shape[0]),
+        'samples_per_pixel': -(-count_samples // max(heatmap_quantized.shape[0], 1)),
+        'value_min': value_min,
+        'value_max': value_max
+    }
+
+    if palette is not None:
+        payload['palette'] = base64.b64encode(np.ascontiguousarray(palette, dtype=np.uint8).tobytes()).decode('ascii')
+
+    return payload
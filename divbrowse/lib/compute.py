@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from timeit import default_timer as timer
+
+
+
+class ComputeExecutor:
+    """Server-wide thread pool for the tiles of CPU-bound calculations like distance matrices
+
+    All requests share the same pool, so concurrent requests queue their tiles instead of starting threads
+    of their own and the number of busy cores never exceeds `max_workers`. NumPy releases the GIL in its
+    kernels, so threads run in parallel. Tasks must not submit tasks to the pool themselves.
+
+    Args:
+        max_workers (int): Number of threads, defaults to the number of CPUs
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or os.cpu_count()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.task_stats = {}
+        self._mutex = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='divbrowse-compute')
+
+
+    def _run(self, task_name: str, fn, item, submitted: float):
+        started = timer()
+        with self._mutex:
+            self.queued -= 1
+            self.running += 1
+
+        try:
+            return fn(item)
+
+        finally:
+            finished = timer()
+            with self._mutex:
+                self.running -= 1
+                self.completed += 1
+                stats = self.task_stats.setdefault(task_name, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'total_wait_seconds': 0.0})
+                stats['count'] += 1
+                stats['total_seconds'] += finished - started
+                stats['max_seconds'] = max(stats['max_seconds'], finished - started)
+                stats['total_wait_seconds'] += started - submitted
+
+
+    def map(self, fn, items, task_name: str = 'task') -> list:
+        """Runs `fn` for every item on the pool and returns the results in the order of the items"""
+
+        items = list(items)
+        submitted = timer()
+        with self._mutex:
+            self.queued += len(items)
+
+        futures = [self._executor.submit(self._run, task_name, fn, item, submitted) for item in items]
+        return [future.result() for future in futures]
+
+
+    def stats(self) -> dict:
+        with self._mutex:
+            return {
+                'workers': self.max_workers,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'tasks': {
+                    task_name: dict(stats, mean_seconds=stats['total_seconds'] / stats['count'] if stats['count'] else 0.0)
+                    for task_name, stats in self.task_stats.items()
+                }
+            }
@@ -0,0 +1,170 @@
+import os
+
+import numpy as np
+import zarr
+
+from divbrowse import log
+from divbrowse.lib.position_index import PositionIndex
+from divbrowse.lib.variants_stats import VARIANTS_STATS_GROUP, calc_variants_stats, has_variants_stats
+
+
+DENSITY_TRACKS_BIN_SIZES = [1000, 10000, 100000, 1000000]
+DENSITY_TRACKS_ARRAYS = ['count', 'mean_maf', 'missing_freq', 'heterozygosity_freq']
+
+
+
+def _accumulate(sums, bins, stats):
+    """Adds the per-variant statistics of a block of variants to the per-bin sums"""
+
+    minlength = sums['count'].shape[0]
+
+    sums['count'] += np.bincount(bins, minlength=minlength)
+
+    valid_maf = stats['maf'] >= 0
+    sums['maf'] += np.bincount(bins[valid_maf], weights=stats['maf'][valid_maf], minlength=minlength)
+    sums['count_maf'] += np.bincount(bins[valid_maf], minlength=minlength)
+
+    sums['missing_freq'] += np.bincount(bins, weights=stats['missing_freq'], minlength=minlength)
+
+    valid_het = ~np.isnan(stats['heterozygosity_freq'])
+    sums['heterozygosity_freq'] += np.bincount(bins[valid_het], weights=stats['heterozygosity_freq'][valid_het], minlength=minlength)
+    sums['count_het'] += np.bincount(bins[valid_het], minlength=minlength)
+
+
+
+def write_density_tracks(path_zarr: str, path_density_tracks: str, path_position_index: str, bin_sizes: list = None, block_size: int = 1000000, progress=None):
+    """Builds a multi-resolution pyramid of per-bin summary statistics for all chromosomes
+
+    For every chromosome and bin size the number of variants, mean MAF, mean missing frequency and mean
+    heterozygosity frequency per bin are saved in a separate Zarr archive. Precomputed per-variant statistics
+    from `divbrowse calcsumstats` are used if available, otherwise they are calculated from `calldata/GT`.
+
+    Args:
+        path_zarr (str): Path of the Zarr archive of the variant matrix
+        path_density_tracks (str): Path of the Zarr archive for the density tracks
+        path_position_index (str): Path prefix of the position index sidecar files
+        bin_sizes (list): Bin sizes in base pairs, defaults to 1 kb, 10 kb, 100 kb and 1 Mb
+        block_size (int): Number of variants of the precomputed statistics processed at once,
+            genotypes are decoded chunk by chunk
+        progress (callable): Optional callback receiving (ID of the processed chromosome, number of processed variants)
+    """
+
+    bin_sizes = bin_sizes or DENSITY_TRACKS_BIN_SIZES
+    callset = zarr.open_group(path_zarr, mode='r')
+    position_index = PositionIndex.load_or_create(path_position_index, callset)
+    use_variants_stats = has_variants_stats(callset)
+
+    # a block of genotypes of all samples is decoded at once, so it must not exceed a chunk of `calldata/GT`
+    step = block_size if use_variants_stats else callset['calldata/GT'].chunks[0]
+
+    density_tracks = zarr.open_group(path_density_tracks, mode='w')
+    density_tracks.attrs.update({'bin_sizes': bin_sizes, 'complete': False})
+
+    for _chr in position_index.list_chrom:
+        start, stop = position_index.chrom_range(_chr)
+        count_bins = {bin_size: int(position_index.pos[stop - 1]) // bin_size + 1 for bin_size in bin_sizes}
+        sums = {
+            bin_size: {key: np.zeros(count_bins[bin_size]) for key in ['count', 'maf', 'count_maf', 'missing_freq', 'heterozygosity_freq', 'count_het']}
+            for bin_size in bin_sizes
+        }
+
+        block_start = start
+        while block_start < stop:
+            # blocks are aligned to multiples of the step, i.e. to the chunks of `calldata/GT`
+            block_end = min((block_start // step + 1) * step, stop)
+            positions = np.asarray(position_index.pos[block_start:block_end], dtype=np.int64)
+
+            if use_variants_stats:
+                stats = {name: callset[VARIANTS_STATS_GROUP][name][block_start:block_end] for name in ['maf', 'missing_freq', 'heterozygosity_freq']}
+            else:
+                stats = calc_variants_stats(callset['calldata/GT'][block_start:block_end])
+
+            for bin_size in bin_sizes:
+                _accumulate(sums[bin_size], positions // bin_size, stats)
+
+            if progress is not None:
+                progress(_chr, block_end - start)
+
+            block_start = block_end
+
+        for bin_size in bin_sizes:
+            _sums = sums[bin_size]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = {
+                    'count': _sums['count'].astype(np.int32),
+                    'mean_maf': (_sums['maf'] / _sums['count_maf']).astype(np.float32),
+                    'missing_freq': (_sums['missing_freq'] / _sums['count']).astype(np.float32),
+                    'heterozygosity_freq': (_sums['heterozygosity_freq'] / _sums['count_het']).astype(np.float32)
+                }
+
+            group = density_tracks.require_group(str(_chr) + '/' + str(bin_size))
+            for name in DENSITY_TRACKS_ARRAYS:
+                group.array(name, result[name], chunks=(65536,), overwrite=True)
+
+    density_tracks.attrs['complete'] = True
+
+
+
+class DensityTracks:
+    """Read access to the precomputed multi-resolution density tracks"""
+
+    def __init__(self, path_density_tracks: str, max_bins: int = 2000):
+        self.group = zarr.open_group(path_density_tracks, mode='r')
+        self.bin_sizes = sorted(self.group.attrs['bin_sizes'])
+        self.max_bins = max_bins
+
+
+    @classmethod
+    def open(cls, path_density_tracks: str):
+        """Returns the density tracks or None if they have not been built (completely)"""
+
+        if not os.path.exists(path_density_tracks):
+            return None
+
+        density_tracks = cls(path_density_tracks)
+        if density_tracks.group.attrs.get('complete', False) is not True:
+            log.warning('Density tracks at %s are incomplete and will not be used', path_density_tracks)
+            return None
+
+        return density_tracks
+
+
+    def get_bins(self, chrom, startpos: int, endpos: int, resolution: int = None) -> dict:
+        """Returns the bins of a genomic region
+
+        Args:
+            chrom (str): ID of the chromosome
+            startpos (int): First position of the region
+            endpos (int): Last position of the region
+            resolution (int): Bin size, if not given the smallest bin size resulting in at most `max_bins` bins is chosen
+
+        Returns:
+            dict: Bin size, start positions of the bins and the statistics per bin
+        """
+
+        if startpos > endpos:
+            startpos, endpos = endpos, startpos
+
+        if resolution is None:
+            resolution = self.bin_sizes[-1]
+            for bin_size in self.bin_sizes:
+                if (endpos // bin_size) - (startpos // bin_size) + 1 <= self.max_bins:
+                    resolution = bin_size
+                    break
+
+        if resolution not in self.bin_sizes:
+            raise ValueError('Unknown resolution '+str(resolution)+', available resolutions are: '+', '.join(map(str, self.bin_sizes)))
+
+        group = self.group[str(chrom) + '/' + str(resolution)]
+        first_bin = max(startpos // resolution, 0)
+        last_bin = min(endpos // resolution, group['count'].shape[0] - 1)
+        bins = slice(first_bin, max(first_bin, last_bin + 1))
+
+        result = {
+            'bin_size': resolution,
+            'bin_start': (np.arange(bins.start, bins.stop, dtype=np.int64) * resolution).tolist()
+        }
+        for name in DENSITY_TRACKS_ARRAYS:
+            result[name] = group[name][bins].tolist()
+
+        return result
@@ -0,0 +1,265 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numcodecs
+import numpy as np
+import zarr
+
+
+NALT_ARRAY = 'calldata/NALT'
+MIXED_ALT_ARRAY = 'variants/NALT_MIXED_ALT'
+
+
+
+def calc_n_alt(gt: np.ndarray) -> np.ndarray:
+    """Counts the alternate alleles of each call, missing calls (any allele missing) are encoded as -1
+
+    Args:
+        gt (numpy.ndarray): Genotype calls of shape (variants, samples, ploidy)
+
+    Returns:
+        numpy.ndarray: int8 array of shape (variants, samples)
+    """
+
+    n_alt = np.count_nonzero(gt > 0, axis=2).astype(np.int8)
+    n_alt[np.any(gt < 0, axis=2)] = -1
+    return n_alt
+
+
+
+def calc_mixed_alt(gt: np.ndarray) -> np.ndarray:
+    """Flags the variants with at least one call made up of different alternate alleles only, e.g. 1/2
+
+    Such calls are heterozygous, but their number of alternate alleles equals the ploidy like for homozygous
+    alternate calls, so the heterozygosity of these variants can not be derived from `calldata/NALT`.
+
+    Args:
+        gt (numpy.ndarray): Genotype calls of shape (variants, samples, ploidy)
+
+    Returns:
+        numpy.ndarray: bool array of shape (variants,)
+    """
+
+    mixed = np.all(gt > 0, axis=2) & (gt.max(axis=2) != gt.min(axis=2))
+    return np.any(mixed, axis=1)
+
+
+
+def has_nalt(callset) -> bool:
+    """Checks if a Zarr archive contains a complete `calldata/NALT` array matching `calldata/GT`"""
+
+    if NALT_ARRAY not in callset or MIXED_ALT_ARRAY not in callset:
+        return False
+
+    nalt = callset[NALT_ARRAY]
+    shape = callset['calldata/GT'].shape[:2]
+    return nalt.attrs.get('complete', False) is True and nalt.shape == shape and callset[MIXED_ALT_ARRAY].shape == shape[:1]
+
+
+
+def _process_nalt_chunk(path_zarr: str, chunk_index: int) -> int:
+    """Converts one row of chunks along the variants axis, runs in a worker process"""
+
+    numcodecs.blosc.use_threads = False
+
+    callset = zarr.open_group(path_zarr, mode='r+')
+    nalt = callset[NALT_ARRAY]
+    chunk_size = nalt.chunks[0]
+    chunk_start = chunk_index * chunk_size
+    chunk_end = min(chunk_start + chunk_size, nalt.shape[0])
+
+    gt = callset['calldata/GT'][chunk_start:chunk_end]
+    nalt[chunk_start:chunk_end] = calc_n_alt(gt)
+    callset[MIXED_ALT_ARRAY][chunk_start:chunk_end] = calc_mixed_alt(gt)
+
+    return chunk_index
+
+
+
+def write_nalt(path_zarr: str, chunk_variants: int = None, chunk_samples: int = None, workers: int = None, overwrite: bool = False, progress=None):
+    """Saves the number of alternate alleles of all calls as `calldata/NALT` (int8) in the Zarr archive
+
+    Reading `calldata/NALT` instead of `calldata/GT` halves the volume to decompress for diploids and spares
+    the conversion of genotypes on every request. The variants with calls of different alternate alleles only
+    are flagged in `variants/NALT_MIXED_ALT`, see `calc_mixed_alt()`. Both arrays are processed in rows of
+    chunks along the variants axis by a pool of worker processes. Rows already converted are recorded in the
+    `chunks_done` attribute, so an interrupted run continues where it stopped.
+
+    Args:
+        path_zarr (str): Path of the Zarr archive
+        chunk_variants (int): Chunk length along the variants axis, defaults to the one of `calldata/GT`
+        chunk_samples (int): Chunk length along the samples axis, defaults to the one of `calldata/GT`
+        workers (int): Number of worker processes, defaults to the number of CPUs
+        overwrite (bool): Discard an existing `calldata/NALT` and start from scratch
+        progress (callable): Optional callback receiving (number of processed chunks, number of all chunks)
+    """
+
+    callset = zarr.open_group(path_zarr, mode='r+')
+    calldata = callset['calldata/GT']
+
+    if calldata.ndim != 3:
+        raise ValueError('calldata/GT is haploid, its calls already are the numbers of alternate alleles')
+
+    shape = calldata.shape[:2]
+    chunks = (chunk_variants or calldata.chunks[0], chunk_samples or calldata.chunks[1])
+    count_chunks = -(-shape[0] // chunks[0])
+
+    resumable = (
+        not overwrite
+        and NALT_ARRAY in callset
+        and callset[NALT_ARRAY].shape == shape
+        and callset[NALT_ARRAY].chunks == chunks
+        and MIXED_ALT_ARRAY in callset
+        and callset[MIXED_ALT_ARRAY].chunks == chunks[:1]
+    )
+
+    if resumable:
+        nalt = callset[NALT_ARRAY]
+    else:
+        # the flags share the chunk rows of `calldata/NALT`, so each worker writes whole chunks of both arrays
+        callset.create_dataset(MIXED_ALT_ARRAY, shape=shape[:1], chunks=chunks[:1], dtype=bool, fill_value=False, overwrite=True)
+        nalt = callset.create_dataset(NALT_ARRAY, shape=shape, chunks=chunks, dtype=np.int8, fill_value=-1, overwrite=True)
+        nalt.attrs.update({'complete': False, 'chunks_done': []})
+
+    chunks_done = set(nalt.attrs.get('chunks_done', []))
+    chunks_todo = [chunk_index for chunk_index in range(count_chunks) if chunk_index not in chunks_done]
+
+    if progress is not None:
+        progress(len(chunks_done), count_chunks)
+
+    if chunks_todo:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            futures = [executor.submit(_process_nalt_chunk, path_zarr, chunk_index) for chunk_index in chunks_todo]
+            for future in as_completed(futures):
+                chunks_done.add(future.result())
+                nalt.attrs['chunks_done'] = sorted(chunks_done)
+
+                if progress is not None:
+                    progress(len(chunks_done), count_chunks)
+
+    nalt.attrs['complete'] = True
+
+
+
+REPLICA_SUFFIX = '_RECHUNKED'
+
+
+
+def get_replica_path(source: str) -> str:
+    return source + REPLICA_SUFFIX
+
+
+
+def has_replica(callset, source: str) -> bool:
+    """Checks if a Zarr archive contains a complete rechunked replica of the array `source`"""
+
+    path = get_replica_path(source)
+    if path not in callset or source not in callset:
+        return False
+
+    replica = callset[path]
+    return replica.attrs.get('complete', False) is True and replica.shape == callset[source].shape
+
+
+
+def _process_replica_block(path_zarr: str, source: str, variants_range: tuple, samples_range: tuple) -> tuple:
+    """Copies one block of the source array into the replica, runs in a worker process"""
+
+    numcodecs.blosc.use_threads = False
+
+    callset = zarr.open_group(path_zarr, mode='r+')
+    block = (slice(*variants_range), slice(*samples_range))
+    callset[get_replica_path(source)][block] = callset[source][block]
+
+    return variants_range, samples_range
+
+
+
+def write_replica(path_zarr: str, source: str = 'calldata/GT', chunk_variants: int = 65536, chunk_samples: int = 16, max_block_bytes: int = 256 * 1024 * 1024, workers: int = None, overwrite: bool = False, progress=None):
+    """Saves a copy of a calldata array with narrow chunks along the samples axis and long chunks along the variants axis
+
+    Queries for a small subset of the samples then only need to decompress the few chunks containing these
+    samples. The copy is saved as `<source>_RECHUNKED` and processed in blocks of whole replica chunks by a
+    pool of worker processes. Blocks already copied are recorded in the `blocks_done` attribute, so an
+    interrupted run continues where it stopped.
+
+    Args:
+        path_zarr (str): Path of the Zarr archive
+        source (str): Path of the array to copy, e.g. `calldata/GT` or `calldata/NALT`
+        chunk_variants (int): Chunk length of the replica along the variants axis
+        chunk_samples (int): Chunk length of the replica along the samples axis
+        max_block_bytes (int): Maximum size of a block processed by a worker
+        workers (int): Number of worker processes, defaults to the number of CPUs
+        overwrite (bool): Discard an existing replica and start from scratch
+        progress (callable): Optional callback receiving (number of processed blocks, number of all blocks)
+    """
+
+    callset = zarr.open_group(path_zarr, mode='r+')
+    array = callset[source]
+    path = get_replica_path(source)
+    chunks = (chunk_variants, chunk_samples) + array.shape[2:]
+
+    resumable = (
+        not overwrite
+        and path in callset
+        and callset[path].shape == array.shape
+        and callset[path].chunks == chunks
+    )
+
+    if resumable:
+        replica = callset[path]
+    else:
+        replica = callset.create_dataset(path, shape=array.shape, chunks=chunks, dtype=array.dtype, fill_value=array.fill_value, overwrite=True)
+        replica.attrs.update({'complete': False, 'blocks_done': []})
+
+    # a block spans one replica chunk along the variants axis and as many replica chunks along the samples axis as fit into max_block_bytes
+    bytes_per_sample = chunk_variants * array.dtype.itemsize * int(np.prod(array.shape[2:], dtype=np.int64))
+    samples_per_block = max(1, max_block_bytes // (bytes_per_sample * chunk_samples)) * chunk_samples
+
+    blocks = []
+    for variants_start in range(0, array.shape[0], chunk_variants):
+        for samples_start in range(0, array.shape[1], samples_per_block):
+            blocks.append((
+                (variants_start, min(variants_start + chunk_variants, array.shape[0])),
+                (samples_start, min(samples_start + samples_per_block, array.shape[1]))
+            ))
+
+    blocks_done = set(tuple(map(tuple, block)) for block in replica.attrs.get('blocks_done', []))
+    blocks_todo = [block for block in blocks if block not in blocks_done]
+
+    if progress is not None:
+        progress(len(blocks_done), len(blocks))
+
+    if blocks_todo:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            futures = [executor.submit(_process_replica_block, path_zarr, source, *block) for block in blocks_todo]
+            for future in as_completed(futures):
+                blocks_done.add(future.result())
+                replica.attrs['blocks_done'] = sorted(blocks_done)
+
+                if progress is not None:
+                    progress(len(blocks_done), len(blocks))
+
+    replica.attrs['complete'] = True
+
+
+
+def count_chunks_touched(variants_selection, samples_mask: np.ndarray, chunks: tuple) -> int:
+    """Returns the number of chunks of an array that are read for an orthogonal selection
+
+    Args:
+        variants_selection (slice or numpy.ndarray): Selection along the variants axis
+        samples_mask (numpy.ndarray): Boolean mask of the selected samples
+        chunks (tuple): Chunk shape of the array
+    """
+
+    if isinstance(variants_selection, slice):
+        if variants_selection.stop <= variants_selection.start:
+            return 0
+        count_variant_chunks = (variants_selection.stop - 1) // chunks[0] - variants_selection.start // chunks[0] + 1
+    else:
+        count_variant_chunks = np.unique(np.asarray(variants_selection) // chunks[0]).shape[0]
+
+    count_sample_chunks = np.unique(np.flatnonzero(samples_mask) // chunks[1]).shape[0]
+
+    return int(count_variant_chunks) * int(count_sample_chunks)
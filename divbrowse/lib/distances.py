@@ -0,0 +1,180 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+
+# lookup table for the number of set bits of each byte, used if numpy.bitwise_count() is not available (NumPy < 2.0)
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+
+def popcount(words: np.ndarray, axis: int = -1) -> np.ndarray:
+    """Sums up the number of set bits of uint64 words along an axis"""
+
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=axis, dtype=np.int64)
+
+    as_bytes = words.view(np.uint8).reshape(words.shape[:-1] + (words.shape[-1] * 8,))
+    if axis not in (-1, words.ndim - 1):
+        raise ValueError('The lookup table fallback only supports the last axis')
+    return POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.int64)
+
+
+
+def pack_genotype_planes(numbers_of_alternate_alleles: np.ndarray, missing_mask: np.ndarray, means: np.ndarray, block_size: int = 8192) -> np.ndarray:
+    """Packs a matrix of alternate allele counts into bit planes of uint64 words
+
+    Every call is encoded as a small integer code: the number of alternate alleles for called genotypes. A missing
+    call gets the mean of its variant if that mean is integral (as mean imputation would yield the same value) or a
+    separate code otherwise, so that two calls have different codes exactly if their mean-imputed values differ.
+    Bit `p` of all codes of a sample is stored in plane `p`, 64 variants per word. For diploids these are two planes.
+
+    Args:
+        numbers_of_alternate_alleles (numpy.ndarray): int8 matrix (samples x variants), missing calls as -1
+        missing_mask (numpy.ndarray): Boolean mask of the missing calls
+        means (numpy.ndarray): Mean number of alternate alleles per variant, NaN if no sample is called
+        block_size (int): Number of variants encoded at once, must be a multiple of 64
+
+    Returns:
+        numpy.ndarray: uint64 array of shape (planes, samples, ceil(variants / 64))
+    """
+
+    count_samples, count_variants = numbers_of_alternate_alleles.shape
+    count_words = -(-count_variants // 64)
+
+    max_code = max(int(numbers_of_alternate_alleles.max(initial=0)), 0)
+    means = np.nan_to_num(means) # variants without any called sample are imputed with 0
+    missing_codes = np.where(means == np.round(means), np.round(means), max_code + 1).astype(np.uint8)
+    count_planes = max(int(max(max_code, int(missing_codes.max(initial=0)))).bit_length(), 1)
+
+    planes = np.zeros((count_planes, count_samples, count_words * 8), dtype=np.uint8)
+
+    for block_start in range(0, count_variants, block_size):
+        block_end = min(block_start + block_size, count_variants)
+        codes = numbers_of_alternate_alleles[:, block_start:block_end].astype(np.uint8)
+        np.copyto(codes, np.broadcast_to(missing_codes[block_start:block_end], codes.shape), where=missing_mask[:, block_start:block_end])
+
+        for plane in range(count_planes):
+            packed = np.packbits((codes >> plane) & 1, axis=1, bitorder='little')
+            planes[plane, :, block_start // 8:block_start // 8 + packed.shape[1]] = packed
+
+    return planes.view(np.uint64)
+
+
+
+MISSING_CALLS_HANDLING = ['impute', 'ignore', 'count']
+
+
+
+def count_non_reference_calls(numbers_of_alternate_alleles: np.ndarray, missing_mask: np.ndarray = None, missing: str = 'impute', block_size: int = 16384, executor=None) -> np.ndarray:
+    """Counts the variants of each sample with a non-reference call, i.e. the Hamming distance to the reference
+
+    The int8 matrix is reduced block by block along the variants axis, only boolean temporaries of one block
+    are allocated and no float copy of the matrix is made. With an executor the blocks are reduced in parallel.
+
+    Args:
+        numbers_of_alternate_alleles (numpy.ndarray): int8 matrix (samples x variants), missing calls as -1
+        missing_mask (numpy.ndarray): Boolean mask of the missing calls, derived from the -1 values if not given
+        missing (str): Handling of missing calls: `impute` counts them if the mean of their variant is not 0 (as mean
+            imputation would yield a non-reference value), i.e. if any called sample carries an alternate allele,
+            `ignore` never counts them and `count` always counts them
+        block_size (int): Number of variants reduced at once
+        executor (ComputeExecutor): Optional shared executor the blocks are distributed to
+
+    Returns:
+        numpy.ndarray: int32 array with the count of each sample
+    """
+
+    if missing not in MISSING_CALLS_HANDLING:
+        raise ValueError('Unknown handling of missing calls '+str(missing)+', available are: '+', '.join(MISSING_CALLS_HANDLING))
+
+    n_alt = numbers_of_alternate_alleles
+
+    def count_block(block_start):
+        block = slice(block_start, block_start + block_size)
+        non_reference = n_alt[:, block] > 0
+
+        if missing != 'ignore':
+            block_missing = missing_mask[:, block] if missing_mask is not None else n_alt[:, block] < 0
+            if missing == 'impute':
+                block_missing = block_missing & non_reference.any(axis=0)
+            non_reference |= block_missing
+
+        return np.count_nonzero(non_reference, axis=1).astype(np.int32)
+
+    block_starts = range(0, n_alt.shape[1], block_size)
+    counts = np.zeros(n_alt.shape[0], dtype=np.int32)
+
+    if executor is not None and len(block_starts) > 1:
+        partial_counts = executor.map(count_block, block_starts, task_name='count_non_reference_calls')
+    else:
+        partial_counts = map(count_block, block_starts)
+
+    for _counts in partial_counts:
+        counts += _counts
+
+    return counts
+
+
+
+def _hamming_tile(planes: np.ndarray, rows: slice, columns: slice, words_per_block: int) -> np.ndarray:
+    count_rows = rows.stop - rows.start
+    count_columns = columns.stop - columns.start
+    result = np.zeros((count_rows, count_columns), dtype=np.int64)
+
+    for word_start in range(0, planes.shape[2], words_per_block):
+        words = slice(word_start, min(word_start + words_per_block, planes.shape[2]))
+        differences = None
+        for plane in planes:
+            xor = np.bitwise_xor(plane[rows, np.newaxis, words], plane[np.newaxis, columns, words])
+            if differences is None:
+                differences = xor
+            else:
+                np.bitwise_or(differences, xor, out=differences)
+        result += popcount(differences)
+
+    return result
+
+
+
+def hamming_distance_matrix(planes: np.ndarray, tile_size: int = 128, tile_bytes: int = 16 * 1024 * 1024, n_jobs: int = None, executor=None) -> np.ndarray:
+    """Calculates the number of differing variants between all pairs of samples from packed bit planes
+
+    The matrix is computed in tiles of samples x samples x words that fit into the CPU cache, only tiles on and
+    above the diagonal are calculated. Tiles are processed by the shared executor of the server if given, otherwise
+    by a pool of threads of its own. NumPy releases the GIL for the XOR and popcount operations.
+
+    Args:
+        planes (numpy.ndarray): Bit planes as returned by `pack_genotype_planes()`
+        tile_size (int): Number of samples per tile side
+        tile_bytes (int): Maximum size of the intermediate XOR result of a tile
+        n_jobs (int): Number of threads of the own pool, defaults to the number of CPUs
+        executor (ComputeExecutor): Optional shared executor, `n_jobs` is ignored then
+
+    Returns:
+        numpy.ndarray: Symmetric int32 matrix (samples x samples)
+    """
+
+    count_samples = planes.shape[1]
+    words_per_block = max(1, tile_bytes // (tile_size * tile_size * 8))
+    result = np.zeros((count_samples, count_samples), dtype=np.int32)
+
+    tiles = []
+    for row_start in range(0, count_samples, tile_size):
+        for column_start in range(row_start, count_samples, tile_size):
+            tiles.append((slice(row_start, min(row_start + tile_size, count_samples)), slice(column_start, min(column_start + tile_size, count_samples))))
+
+    def process(tile):
+        rows, columns = tile
+        distances = _hamming_tile(planes, rows, columns, words_per_block)
+        result[rows, columns] = distances
+        result[columns, rows] = distances.T
+
+    if executor is not None:
+        executor.map(process, tiles, task_name='hamming_tile')
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+            list(pool.map(process, tiles))
+
+    return result
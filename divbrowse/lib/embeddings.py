@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import zarr
+
+from divbrowse import log
+from divbrowse.lib.analysis import calc_umap, streaming_pca
+
+
+
+def write_embeddings(gd, path_embeddings: str, chromosomes: list = None, n_components: int = 10, n_iter: int = 4, umap_n_neighbors: int = 15, with_umap: bool = True, overwrite: bool = False, progress=None):
+    """Calculates the PCA (and UMAP) embedding of all samples for whole chromosomes and saves it in a Zarr archive
+
+    The PCA is calculated with `streaming_pca()` over all variants of a chromosome without any variant filter,
+    UMAP is calculated on the principal components. Imputation and scaling use all samples, so that the
+    coordinates of a sample do not depend on the other samples of a query: a subset of the samples is projected
+    onto the stored axes by selecting its rows. Chromosomes already saved are skipped, unless `overwrite` is set.
+
+    Args:
+        gd (GenotypeData): The genotype data instance
+        path_embeddings (str): Path of the Zarr archive for the embeddings
+        chromosomes (list): IDs of the chromosomes, defaults to all chromosomes
+        n_components (int): Number of principal components
+        n_iter (int): Number of power iterations of the streaming PCA
+        umap_n_neighbors (int): `n_neighbors` parameter of umap.UMAP() method
+        with_umap (bool): Calculate UMAP as well
+        overwrite (bool): Recalculate chromosomes already saved
+        progress (callable): Optional callback receiving the ID of the processed chromosome
+    """
+
+    embeddings = zarr.open_group(path_embeddings, mode='a')
+
+    if embeddings.attrs.get('count_samples', None) != gd.count_samples:
+        # the samples changed, nothing of a previous run can be reused
+        embeddings = zarr.open_group(path_embeddings, mode='w')
+        embeddings.attrs['count_samples'] = gd.count_samples
+
+    for _chr in (chromosomes or gd.list_chrom):
+        _chr = str(_chr)
+
+        if not overwrite and _chr in embeddings and embeddings[_chr].attrs.get('complete', False) is True:
+            continue
+
+        start, stop = gd.position_index.chrom_range(_chr)
+        startpos, endpos = int(gd.pos[start]), int(gd.pos[stop - 1])
+
+        pca_result = streaming_pca(gd, _chr, startpos, endpos, samples = gd.samples, n_components = n_components, n_iter = n_iter, with_sample_ids = False)
+        if pca_result is False:
+            log.warning('Chromosome %s has too few variants for a PCA, no embedding saved', _chr)
+            continue
+
+        pca_coordinates, explained_variance_ratio = pca_result
+
+        group = embeddings.require_group(_chr)
+        group.attrs['complete'] = False
+        group.array('pca', pca_coordinates.astype(np.float32), overwrite=True)
+        group.array('explained_variance_ratio', np.asarray(explained_variance_ratio, dtype=np.float64), overwrite=True)
+
+        if with_umap:
+            group.array('umap', calc_umap(pca_coordinates, n_neighbors = umap_n_neighbors).astype(np.float32), overwrite=True)
+        elif 'umap' in group:
+            del group['umap']
+
+        group.attrs.update({
+            'startpos': startpos,
+            'endpos': endpos,
+            'count_variants': stop - start,
+            'n_iter': n_iter,
+            'umap_n_neighbors': umap_n_neighbors if with_umap else None,
+            'complete': True
+        })
+
+        if progress is not None:
+            progress(_chr)
+
+
+
+class Embeddings:
+    """Read access to the precomputed PCA and UMAP embeddings of whole chromosomes"""
+
+    def __init__(self, path_embeddings: str):
+        self.group = zarr.open_group(path_embeddings, mode='r')
+
+
+    @classmethod
+    def open(cls, path_embeddings: str, count_samples: int):
+        """Returns the embeddings or None if they have not been calculated for the current samples"""
+
+        if not os.path.exists(path_embeddings):
+            return None
+
+        embeddings = cls(path_embeddings)
+        if embeddings.group.attrs.get('count_samples', None) != count_samples:
+            log.warning('Embeddings at %s were calculated for other samples and will not be used', path_embeddings)
+            return None
+
+        return embeddings
+
+
+    def get(self, chrom, samples_mask: np.ndarray) -> dict:
+        """Returns the embedding of a subset of the samples or None if the chromosome has not been calculated
+
+        Args:
+            chrom (str): ID of the chromosome
+            samples_mask (numpy.ndarray): Boolean mask of the selected samples
+
+        Returns:
+            dict: PCA coordinates, explained variance ratio, UMAP coordinates (or None) and their `n_neighbors`
+        """
+
+        chrom = str(chrom)
+        if chrom not in self.group or self.group[chrom].attrs.get('complete', False) is not True:
+            return None
+
+        group = self.group[chrom]
+        return {
+            'pca': group['pca'].get_orthogonal_selection((samples_mask, slice(None))),
+            'explained_variance_ratio': group['explained_variance_ratio'][:],
+            'umap': group['umap'].get_orthogonal_selection((samples_mask, slice(None))) if 'umap' in group else None,
+            'umap_n_neighbors': group.attrs.get('umap_n_neighbors', None)
+        }
@@ -0,0 +1,392 @@
+import itertools
+import struct
+import zlib
+
+import numpy as np
+
+
+
+def iter_chunk_aligned_blocks(variants_indices: np.ndarray, chunk_size: int, max_block_size: int = None):
+    """Splits a sequence of variant indices into blocks that do not cross chunk borders of the variants axis
+
+    Consecutive indices within the same chunk form one block, so every chunk is read (and decompressed) only once per block.
+
+    Args:
+        variants_indices (numpy.ndarray): Variant indices in output order
+        chunk_size (int): Chunk length along the variants axis of the Zarr arrays
+        max_block_size (int): Optional maximum number of variants per block
+
+    Yields:
+        numpy.ndarray: Variant indices of one block
+    """
+
+    variants_indices = np.asarray(variants_indices, dtype=np.int64)
+    if variants_indices.size == 0:
+        return
+
+    chunk_ids = variants_indices // chunk_size
+    borders = np.flatnonzero(chunk_ids[1:] != chunk_ids[:-1]) + 1
+    borders = np.concatenate(([0], borders, [variants_indices.size]))
+
+    for block_start, block_end in zip(borders[:-1].tolist(), borders[1:].tolist()):
+        step = max_block_size or (block_end - block_start)
+        for _start in range(block_start, block_end, step):
+            yield variants_indices[_start:min(_start + step, block_end)]
+
+
+
+def lookup_byte_fields(table: list, codes: np.ndarray):
+    """Translates codes into the byte strings of a lookup table, as zero-padded bytes and a mask of the used bytes
+
+    Args:
+        table (list): Strings of the lookup table
+        codes (numpy.ndarray): Integer indices into the table
+
+    Returns:
+        numpy.ndarray: uint8 array of shape `codes.shape + (width,)` with the zero-padded bytes of each field
+        numpy.ndarray: Boolean mask of the same shape, False for the padding
+    """
+
+    encoded = [value.encode('utf-8') for value in table]
+    width = max((len(value) for value in encoded), default=0)
+
+    table_bytes = np.zeros((len(encoded), width), dtype=np.uint8)
+    for i, value in enumerate(encoded):
+        table_bytes[i, :len(value)] = np.frombuffer(value, dtype=np.uint8)
+
+    return np.take(table_bytes, codes, axis=0), np.take(table_bytes != 0, codes, axis=0)
+
+
+
+def genotypes_to_vcf_fields(gt: np.ndarray, max_table_size: int = 65536):
+    """Formats a block of genotype calls as tab-prefixed VCF GT fields like `\t0/1` or `\t./.`
+
+    Args:
+        gt (numpy.ndarray): Genotype calls of shape (variants, samples, ploidy) or (variants, samples) for haploids
+        max_table_size (int): Maximum number of allele combinations looked up as a whole, calls of more
+            combinations are looked up allele by allele
+
+    Returns:
+        tuple: Padded bytes and mask of shape (variants, samples, width) as returned by `lookup_byte_fields()`
+    """
+
+    if gt.ndim == 2:
+        gt = gt[:, :, np.newaxis]
+
+    ploidy = gt.shape[2]
+    max_allele = max(int(gt.max(initial=0)), 0)
+    alleles = ['.'] + [str(allele) for allele in range(max_allele + 1)]
+    count_alleles = len(alleles)
+
+    if count_alleles ** ploidy <= max_table_size:
+        # one lookup table for all combinations of alleles, missing calls (-1) are mapped to '.'
+        codes = np.zeros(gt.shape[:2], dtype=np.intp)
+        for i in range(ploidy):
+            codes *= count_alleles
+            codes += np.maximum(gt[:, :, i], -1)
+            codes += 1
+        table = ['\t' + '/'.join(combination) for combination in itertools.product(alleles, repeat=ploidy)]
+        return lookup_byte_fields(table, codes)
+
+    fields = [
+        lookup_byte_fields([('\t' if i == 0 else '/') + allele for allele in alleles], np.maximum(gt[:, :, i], -1).astype(np.intp) + 1)
+        for i in range(ploidy)
+    ]
+
+    return np.concatenate([field_bytes for field_bytes, _ in fields], axis=2), np.concatenate([mask for _, mask in fields], axis=2)
+
+
+
+def integers_to_vcf_fields(values: np.ndarray, prefix: str = ':', max_table_size: int = 65536):
+    """Formats a block of integer call values like DP as prefixed VCF fields, negative values as missing (`.`)
+
+    Values below `max_table_size` are looked up in a table of all values up to the maximum, larger ones in a table
+    of the distinct values of the block.
+
+    Returns:
+        tuple: Padded bytes and mask as returned by `lookup_byte_fields()`
+    """
+
+    max_value = max(int(values.max(initial=0)), 0)
+
+    if max_value < max_table_size:
+        codes = np.maximum(values, -1).astype(np.intp) + 1
+        return lookup_byte_fields([prefix + '.'] + [prefix + str(value) for value in range(max_value + 1)], codes)
+
+    # large values like a sentinel of 2^31-1: the lookup table only holds the distinct values
+    distinct_values, codes = np.unique(np.maximum(values, -1), return_inverse=True)
+    table = [prefix + ('.' if value < 0 else str(value)) for value in distinct_values.tolist()]
+
+    return lookup_byte_fields(table, codes.reshape(values.shape))
+
+
+
+def join_byte_fields(fields: list) -> bytes:
+    """Joins padded byte fields into rows, leaving out the padding
+
+    The fields of all rows are laid out next to each other in one buffer, their bytes are then selected with one
+    boolean mask in C order.
+
+    Args:
+        fields (list): Pairs of padded bytes and mask as returned by `lookup_byte_fields()`, all with the rows on the first axis
+
+    Returns:
+        bytes: The joined rows
+    """
+
+    count_rows = fields[0][0].shape[0]
+    buffer = np.concatenate([field_bytes.reshape(count_rows, -1) for field_bytes, _ in fields], axis=1)
+    mask = np.concatenate([field_mask.reshape(count_rows, -1) for _, field_mask in fields], axis=1)
+
+    return buffer[mask].tobytes()
+
+
+
+def get_vcf_header_lines(gd, samples_mask: np.ndarray) -> list:
+    """Returns the VCF meta-information lines and the column header line for a selection of samples
+
+    Args:
+        gd (GenotypeData): The genotype data instance
+        samples_mask (numpy.ndarray): Boolean mask of the samples to export
+
+    Returns:
+        list: Header lines without line breaks
+    """
+
+    vcf_lines_header = gd.get_vcf_header()
+    if vcf_lines_header == None:
+        # No VCF header files available: fallback to minimal VCF header
+        vcf_lines_header = [
+            '##fileformat=VCFv4.3',
+            '##FILTER=<ID=PASS,Description="All filters passed">',
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">'
+        ]
+
+        if 'DP' in gd.available_calldata:
+            vcf_lines_header.append('##FORMAT=<ID=DP,Number=.,Type=Integer,Description="Read depth">')
+
+    mapped_sample_ids, _ = gd.map_vcf_sample_ids_to_input_sample_ids(gd.samples[samples_mask].astype(str).tolist())
+    vcf_line_variants_header = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + mapped_sample_ids
+    vcf_lines_header.append("\t".join(vcf_line_variants_header))
+
+    return vcf_lines_header
+
+
+
+def generate_vcf_records(gd, chrom, variants_indices: np.ndarray, samples_mask: np.ndarray, with_dp: bool = False, max_block_calls: int = 2097152):
+    """Generates the VCF records of a selection of variants and samples
+
+    Genotypes (and read depths) are read in chunk-aligned blocks with one Zarr selection per block. A block is
+    formatted without any per-row Python code: the fixed columns are joined column-wise, the calls are translated
+    into padded byte fields with lookup tables and all fields are compacted into one buffer, see `join_byte_fields()`.
+
+    Args:
+        gd (GenotypeData): The genotype data instance
+        chrom (str): ID of the chromosome
+        variants_indices (numpy.ndarray): Indices of the variants to export
+        samples_mask (numpy.ndarray): Boolean mask of the samples to export
+        with_dp (bool): Add DP values to the FORMAT column
+        max_block_calls (int): Maximum number of calls formatted at once
+
+    Yields:
+        str: VCF records of one block of variants, separated by newlines
+    """
+
+    format_column = 'GT:DP' if with_dp else 'GT'
+    count_samples = max(int(np.count_nonzero(samples_mask)), 1)
+
+    # the original genotypes or their rechunked replica, whichever is cheaper to read for the selection
+    calldata = gd.get_calldata_array('calldata/GT', np.asarray(variants_indices), samples_mask)
+
+    for block_indices in iter_chunk_aligned_blocks(variants_indices, calldata.chunks[0], max_block_size=max(1, max_block_calls // count_samples)):
+
+        ref = gd.reference_allele.get_orthogonal_selection(block_indices)
+        alts = gd.alternate_alleles.get_orthogonal_selection(block_indices)
+        qual = gd.variants_qual.get_orthogonal_selection(block_indices)
+        positions = gd.pos[block_indices]
+
+        if alts.ndim == 1:
+            alts = alts[:, np.newaxis]
+
+        # fixed columns CHROM to FORMAT, joined column by column
+        alts = alts.astype(str).astype(object)
+        alt_column = alts[:, 0]
+        for i in range(1, alts.shape[1]):
+            alt_column = np.where(alts[:, i] != '', alt_column + ',' + alts[:, i], alt_column)
+
+        fixed_columns = (
+            (str(chrom) + '\t') + positions.astype(str).astype(object)
+            + '\t.\t' + ref.astype(str).astype(object)
+            + '\t' + alt_column
+            + '\t' + qual.astype(str).astype(object)
+            + ('\tNA\t\t' + format_column)
+        )
+        fixed_columns = np.char.encode(fixed_columns.astype(str), 'utf-8')
+        fixed_columns_bytes = fixed_columns.view(np.uint8).reshape(fixed_columns.shape[0], fixed_columns.dtype.itemsize)
+        fixed_columns_mask = np.arange(fixed_columns.dtype.itemsize) < np.char.str_len(fixed_columns)[:, np.newaxis]
+
+        calls_bytes, calls_mask = genotypes_to_vcf_fields(calldata.get_orthogonal_selection((block_indices, samples_mask)))
+
+        if with_dp:
+            # the DP field of a call follows its GT field
+            dp_bytes, dp_mask = integers_to_vcf_fields(gd.callset['calldata/DP'].get_orthogonal_selection((block_indices, samples_mask)))
+            calls_bytes = np.concatenate([calls_bytes, dp_bytes], axis=2)
+            calls_mask = np.concatenate([calls_mask, dp_mask], axis=2)
+
+        newlines = np.full((block_indices.shape[0], 1), ord('\n'), dtype=np.uint8)
+
+        yield join_byte_fields([
+            (fixed_columns_bytes, fixed_columns_mask),
+            (calls_bytes, calls_mask),
+            (newlines, np.ones(newlines.shape, dtype=bool))
+        ]).decode('utf-8')
+
+
+
+IUPAC_AMBIGUITY_CODES = {
+    frozenset(('A', 'G')): 'R',
+    frozenset(('C', 'T')): 'Y',
+    frozenset(('G', 'C')): 'S',
+    frozenset(('A', 'T')): 'W',
+    frozenset(('G', 'T')): 'K',
+    frozenset(('A', 'C')): 'M'
+}
+
+
+
+def create_nucleotides_lookup_table(ref: np.ndarray, alts: np.ndarray) -> np.ndarray:
+    """Creates the per-variant lookup table translating numbers of alternate alleles into nucleotides
+
+    Args:
+        ref (numpy.ndarray): Reference alleles of the variants
+        alts (numpy.ndarray): Alternate alleles of the variants, only the first alternate allele is used
+
+    Returns:
+        numpy.ndarray: bytes array of shape (variants, 4) with the columns homozygous reference, heterozygous (IUPAC
+            ambiguity code or `N` if there is none for the two alleles), homozygous alternate and missing (`.`)
+    """
+
+    ref = np.asarray(ref).astype(str)
+    alts = np.asarray(alts).astype(str)
+    alt = alts[:, 0] if alts.ndim == 2 else alts
+
+    het = [IUPAC_AMBIGUITY_CODES.get(frozenset((_ref, _alt)), 'N') for _ref, _alt in zip(ref.tolist(), alt.tolist())]
+
+    table = np.empty((ref.shape[0], 4), dtype=object)
+    table[:, 0] = ref
+    table[:, 1] = het
+    table[:, 2] = alt
+    table[:, 3] = '.'
+
+    return np.char.encode(table.astype(str), 'ascii')
+
+
+
+def generate_nucleotide_rows(numbers_of_alternate_alleles: np.ndarray, lookup_table: np.ndarray, row_labels: list, block_size: int = 256):
+    """Generates tab-separated rows of nucleotides, one row per sample
+
+    The numbers of alternate alleles of a block of samples are translated with one fancy indexing
+    operation into the lookup table. If all nucleotides are single characters, the tab separators and
+    line breaks are interleaved into the same `|S1` array, so that a block is serialized with `tobytes()`.
+
+    Args:
+        numbers_of_alternate_alleles (numpy.ndarray): Numbers of alternate alleles of shape (samples, variants), missing calls as -1
+        lookup_table (numpy.ndarray): Lookup table as returned by `create_nucleotides_lookup_table()`
+        row_labels (list): Label of each row, e.g. the sample IDs
+        block_size (int): Number of rows translated at once
+
+    Yields:
+        bytes: Rows of one block of samples
+    """
+
+    n_alt = np.asarray(numbers_of_alternate_alleles)
+    count_variants = lookup_table.shape[0]
+    variant_indices = np.arange(count_variants)
+    single_chars = lookup_table.dtype.itemsize == 1
+
+    for block_start in range(0, n_alt.shape[0], block_size):
+        block = n_alt[block_start:block_start + block_size]
+        labels = [str(label).encode('utf-8') for label in row_labels[block_start:block_start + block_size]]
+
+        codes = np.where((block >= 0) & (block <= 2), block, 3)
+        nucleotides = lookup_table[variant_indices, codes]
+
+        if single_chars:
+            # every row is laid out as `\t<nucleotide>\t<nucleotide>...\n` with a fixed length
+            row_length = 2 * count_variants + 1
+            buffer = np.full((block.shape[0], row_length), b'\t', dtype='|S1')
+            buffer[:, 1:-1:2] = nucleotides
+            buffer[:, -1] = b'\n'
+            raw = buffer.tobytes()
+            yield b''.join([label + raw[i * row_length:(i + 1) * row_length] for i, label in enumerate(labels)])
+        else:
+            yield b''.join([b'\t'.join([label] + row) + b'\n' for label, row in zip(labels, nucleotides.tolist())])
+
+
+
+def gzip_stream(chunks, compresslevel: int = 6):
+    """Compresses a stream of byte strings into a gzip stream on the fly"""
+
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+
+BGZF_EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+
+class BgzfWriter:
+    """Minimal writer for BGZF, the blocked gzip format of bgzip, tabix and htslib
+
+    Data is split into blocks of at most 64 kB uncompressed, each block is written as a separate gzip
+    member with the BGZF extra field. The result can be decompressed with any gzip implementation.
+
+    Args:
+        fileobj: Binary file object to write to
+        compresslevel (int): zlib compression level
+    """
+
+    BLOCK_SIZE = 65280
+
+    def __init__(self, fileobj, compresslevel: int = 6):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self._buffer = bytearray()
+
+
+    def _write_block(self, data: bytes):
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+        trailer = struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+        self.fileobj.write(header + compressed + trailer)
+
+
+    def write(self, data: bytes):
+        self._buffer += data
+        while len(self._buffer) >= self.BLOCK_SIZE:
+            self._write_block(bytes(self._buffer[:self.BLOCK_SIZE]))
+            del self._buffer[:self.BLOCK_SIZE]
+
+
+    def close(self):
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        self.fileobj.write(BGZF_EOF_BLOCK)
+        self.fileobj.flush()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
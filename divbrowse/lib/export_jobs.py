@@ -0,0 +1,275 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import gzip
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from divbrowse import log
+from divbrowse.lib.export import (
+    BgzfWriter,
+    create_nucleotides_lookup_table,
+    generate_nucleotide_rows,
+    generate_vcf_records,
+    get_vcf_header_lines
+)
+
+
+EXPORT_FORMATS = {
+    'vcf': ('.vcf.gz', 'application/gzip'),
+    'csv': ('.csv.gz', 'application/gzip')
+}
+
+
+
+@dataclass
+class ExportJob:
+
+    job_id: str
+    format: str
+    params: dict
+    status: str = 'queued'
+    processed_variants: int = 0
+    total_variants: int = 0
+    progress: float = 0.0
+    error: str = None
+    created: float = field(default_factory=time.time)
+    finished: float = None
+
+
+    @property
+    def filename(self) -> str:
+        return 'export_' + self.job_id + EXPORT_FORMATS[self.format][0]
+
+
+    @property
+    def mimetype(self) -> str:
+        return EXPORT_FORMATS[self.format][1]
+
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'format': self.format,
+            'status': self.status,
+            'processed_variants': self.processed_variants,
+            'total_variants': self.total_variants,
+            'progress': round(self.progress, 4),
+            'error': self.error,
+            'filename': self.filename
+        }
+
+
+
+class ExportJobs:
+    """Runs VCF and CSV exports of arbitrary size in background threads and keeps the resulting files for download
+
+    Exports are processed in blocks of variants via `GenotypeData.iter_variant_call_blocks()` and written
+    compressed to the jobs directory: VCF files with BGZF (bgzip compatible), CSV files with gzip.
+    Files of finished jobs are removed after `max_age_hours`.
+
+    Args:
+        gd (GenotypeData): The genotype data instance
+        jobs_dir (str): Directory for the export files
+        max_workers (int): Number of exports running at the same time
+        max_age_hours (float): Hours after which finished jobs and their files are removed
+        block_size (int): Number of variants processed at once
+    """
+
+    def __init__(self, gd, jobs_dir: str, max_workers: int = 2, max_age_hours: float = 24, block_size: int = None):
+        self.gd = gd
+        self.jobs_dir = jobs_dir
+        self.max_age_seconds = max_age_hours * 3600
+        self.block_size = block_size
+        self.jobs = {}
+        self._mutex = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='divbrowse-export')
+
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+        # files of previous runs can not be assigned to jobs anymore
+        for filename in os.listdir(self.jobs_dir):
+            if filename.startswith('export_'):
+                path = os.path.join(self.jobs_dir, filename)
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+
+    def submit(self, format: str, params: dict) -> ExportJob:
+        """Queues a new export job
+
+        Args:
+            format (str): `vcf` or `csv`
+            params (dict): Processed request variables: chrom, startpos, endpos, positions, samples and variant_filter_settings
+
+        Returns:
+            ExportJob: The queued job
+        """
+
+        if format not in EXPORT_FORMATS:
+            raise ValueError('Unknown export format '+str(format)+', available formats are: '+', '.join(EXPORT_FORMATS.keys()))
+
+        self._remove_expired_jobs()
+
+        job = ExportJob(job_id=uuid.uuid4().hex, format=format, params=params)
+        with self._mutex:
+            self.jobs[job.job_id] = job
+
+        self._executor.submit(self._run, job)
+        return job
+
+
+    def get(self, job_id: str) -> ExportJob:
+        with self._mutex:
+            return self.jobs.get(job_id, None)
+
+
+    def get_path(self, job: ExportJob) -> str:
+        return os.path.join(self.jobs_dir, job.filename)
+
+
+    def _remove_expired_jobs(self):
+        now = time.time()
+        with self._mutex:
+            expired = [job for job in self.jobs.values() if job.finished is not None and now - job.finished > self.max_age_seconds]
+            for job in expired:
+                del self.jobs[job.job_id]
+
+        for job in expired:
+            path = self.get_path(job)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+    def _iter_blocks(self, job: ExportJob, with_genotypes: bool):
+        params = job.params
+        return self.gd.iter_variant_call_blocks(
+            chrom = params['chrom'],
+            startpos = params.get('startpos', None),
+            endpos = params.get('endpos', None),
+            positions = params.get('positions', None),
+            samples = params.get('samples', None),
+            variant_filter_settings = params.get('variant_filter_settings', None),
+            with_genotypes = with_genotypes,
+            block_size = self.block_size
+        )
+
+
+    def _run(self, job: ExportJob):
+        path = self.get_path(job)
+        path_partial = path + '.part'
+        job.status = 'running'
+        start = time.time()
+
+        try:
+            if job.format == 'vcf':
+                self._write_vcf(job, path_partial)
+            else:
+                self._write_csv(job, path_partial)
+
+            os.replace(path_partial, path)
+            job.progress = 1.0
+            job.status = 'finished'
+            log.debug("==== export job %s => calculation time: %f", job.job_id, time.time() - start)
+
+        except Exception as error:
+            log.exception('Export job %s failed', job.job_id)
+            job.status = 'failed'
+            job.error = getattr(error, 'message', str(error))
+            if os.path.exists(path_partial):
+                os.remove(path_partial)
+
+        finally:
+            job.finished = time.time()
+
+
+    def _write_vcf(self, job: ExportJob, path: str):
+        chrom = job.params['chrom']
+        with_dp = 'DP' in self.gd.available_calldata
+
+        with open(path, 'wb') as f, BgzfWriter(f) as writer:
+            header_written = False
+
+            for processed, total, block in self._iter_blocks(job, with_genotypes=False):
+                if not header_written:
+                    writer.write(("\n".join(get_vcf_header_lines(self.gd, block.samples_mask)) + "\n").encode('utf-8'))
+                    header_written = True
+
+                for records in generate_vcf_records(self.gd, chrom, block.filtered_positions_indices, block.samples_mask, with_dp=with_dp):
+                    writer.write(records.encode('utf-8'))
+
+                job.processed_variants, job.total_variants = processed, total
+                job.progress = processed / max(total, 1)
+
+            if not header_written:
+                samples_mask, _ = self.gd.get_samples_mask(job.params.get('samples', None) or self.gd.samples)
+                writer.write(("\n".join(get_vcf_header_lines(self.gd, samples_mask)) + "\n").encode('utf-8'))
+
+
+    def _write_csv(self, job: ExportJob, path: str):
+        """Writes the CSV export in two passes, because rows are samples and columns are variants
+
+        The first pass saves the numbers of alternate alleles of each block in a temporary file, the second pass
+        reads them back for a group of samples at a time and writes the rows.
+        """
+
+        gd = self.gd
+        tmp_dir = path + '.blocks'
+        os.makedirs(tmp_dir)
+
+        try:
+            block_files = []
+            positions, refs, alts = [], [], []
+
+            for processed, total, block in self._iter_blocks(job, with_genotypes=True):
+                indices = block.filtered_positions_indices
+                if indices.shape[0] > 0:
+                    block_file = os.path.join(tmp_dir, str(len(block_files)) + '.npy')
+                    np.save(block_file, np.asarray(block.numbers_of_alternate_alleles, dtype=np.int8))
+                    block_files.append(block_file)
+                    positions.append(gd.pos[indices])
+                    refs.append(gd.reference_allele.get_orthogonal_selection(indices))
+                    alts.append(gd.alternate_alleles.get_orthogonal_selection(indices))
+
+                job.processed_variants, job.total_variants = processed, total
+                job.progress = 0.5 * processed / max(total, 1)
+
+            samples_mask, _ = gd.get_samples_mask(job.params.get('samples', None) or gd.samples)
+            mapped_sample_ids, _ = gd.map_vcf_sample_ids_to_input_sample_ids(gd.samples[samples_mask].astype(str).tolist())
+
+            positions = np.concatenate(positions) if positions else np.array([], dtype=np.int64)
+            refs = np.concatenate(refs) if refs else np.array([], dtype=object)
+            alts = np.concatenate(alts) if alts else np.empty((0, 1), dtype=object)
+            nucleotides_lookup_table = create_nucleotides_lookup_table(refs, alts)
+
+            _chrom = gd.chromosome_labels[str(job.params['chrom'])]
+
+            with gzip.open(path, 'wb', compresslevel=6) as f:
+                f.write(('CHROM' + ('\t' + _chrom) * positions.shape[0] + '\n').encode('utf-8'))
+                f.write(('\t'.join(['POS'] + positions.astype(str).tolist()) + '\n').encode('utf-8'))
+                f.write(('\t'.join(['REF'] + refs.astype(str).tolist()) + '\n').encode('utf-8'))
+
+                samples_block_size = 256
+                count_samples = len(mapped_sample_ids)
+                block_arrays = [np.load(block_file, mmap_mode='r') for block_file in block_files]
+
+                for samples_start in range(0, count_samples, samples_block_size):
+                    samples_end = min(samples_start + samples_block_size, count_samples)
+
+                    if block_arrays:
+                        n_alt = np.concatenate([block_array[samples_start:samples_end] for block_array in block_arrays], axis=1)
+                    else:
+                        n_alt = np.empty((samples_end - samples_start, 0), dtype=np.int8)
+
+                    for rows in generate_nucleotide_rows(n_alt, nucleotides_lookup_table, mapped_sample_ids[samples_start:samples_end]):
+                        f.write(rows)
+
+                    job.progress = 0.5 + 0.5 * samples_end / max(count_samples, 1)
+
+                del block_arrays
+
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
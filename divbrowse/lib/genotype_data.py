@@ -14,8 +14,15 @@ from sklearn.preprocessing import RobustScaler
 import umap
 
 from divbrowse import log
+from divbrowse.lib.cache import LRUCache, open_cached_callset
+from divbrowse.lib.density_tracks import DensityTracks
+from divbrowse.lib.derived_calldata import MIXED_ALT_ARRAY, NALT_ARRAY, count_chunks_touched, get_replica_path, has_nalt, has_replica
+from divbrowse.lib.embeddings import Embeddings
+from divbrowse.lib.export import iter_chunk_aligned_blocks
+from divbrowse.lib.position_index import PositionIndex
 from divbrowse.lib.utils import ApiError
 from divbrowse.lib.variant_calls_slice import VariantCallsSlice
+from divbrowse.lib.variants_stats import VARIANTS_STATS_ARRAYS, VARIANTS_STATS_GROUP, calc_variants_stats, calc_variants_stats_from_n_alt, has_variants_stats
 
 
 
@@ -38,19 +45,34 @@ class GenotypeData:
             exit('ERROR: the configured path for the Zarr-archive of variants does not exist or is not accessible')
 
         log.debug("GenotypeData::zarr.open_group()")
-        self.callset = zarr.open_group(path_zarr_variants, mode='r')
+        chunk_cache_size_mb = config.get('cache', {}).get('chunk_cache_size_mb', 512)
+        self.callset, self.chunk_cache = open_cached_callset(
+            path_zarr_variants,
+            arrays = ['calldata/GT', NALT_ARRAY, get_replica_path('calldata/GT'), get_replica_path(NALT_ARRAY), 'calldata/DP', 'calldata/DV'],
+            max_bytes = int(chunk_cache_size_mb * 1024 * 1024)
+        )
         log.debug(self.callset.tree(expand=True))
 
+        summary_stats_cache_size = config.get('cache', {}).get('summary_stats_cache_max_variants', 5000000)
+        self.summary_stats_cache = LRUCache(summary_stats_cache_size, getsizeof=lambda stats: len(stats['maf']))
+
+        self.max_slice_memory = int(config.get('limits', {}).get('max_slice_memory_mb', 4096) * 1024 * 1024)
+
         self.available = {
             'snpeff': False,
-            'sample_id_mapping': False
+            'sample_id_mapping': False,
+            'variants_stats': False,
+            'nalt': False,
+            'density_tracks': False,
+            'embeddings': False
         }
 
+        self._create_chrom_indices()
         self._load_data()
         self._setup_sample_id_mapping()
-        self._create_chrom_indices()
         self._create_list_of_chromosomes()
-        self._free_mem()
+        self._load_density_tracks()
+        self._load_embeddings()
     
 
     def _load_data(self):
@@ -64,16 +86,10 @@ class GenotypeData:
         self.variants_qual = self.callset['variants/QUAL']
         self.calldata = self.callset['calldata/GT']
 
-        # convert chrom, pos and samples from zarr.core.Array to numpy ndarray
-        self.chrom = self.callset['variants/CHROM'][:]
-        self.pos = self.callset['variants/POS'][:]
+        # positions are served from the (memory-mapped) position index, samples are converted from zarr.core.Array to numpy ndarray
+        self.pos = self.position_index.pos
         self.samples = self.callset['samples'][:]
 
-        #print('----------------------------------------------------------')
-        #print(self.chrom.nbytes)
-        #print(self.pos.nbytes)
-        #print(self.samples.nbytes)
-
         self.count_variants = len(self.pos)
         self.count_samples = len(self.samples)
 
@@ -84,15 +100,27 @@ class GenotypeData:
         if 'ANN' in self.available_variants_metadata:
             self.available['snpeff'] = True
 
+        # check if per-variant statistics over all samples have been precomputed via `divbrowse calcsumstats`
+        if has_variants_stats(self.callset):
+            self.available['variants_stats'] = True
+
+        # check if the numbers of alternate alleles have been precomputed via `divbrowse calcnalt`
+        if self.ploidy > 1 and has_nalt(self.callset):
+            self.available['nalt'] = True
+            self.nalt = self.callset[NALT_ARRAY]
+
+        # rechunked replicas with narrow sample chunks, written via `divbrowse rechunk`
+        self.calldata_replicas = {}
+        for source in ['calldata/GT', NALT_ARRAY]:
+            if has_replica(self.callset, source):
+                self.calldata_replicas[source] = self.callset[get_replica_path(source)]
+
         # Derive distinct chromosome ID's from variant matrix
-        self.list_chrom = pd.unique(self.chrom).tolist()
+        self.list_chrom = self.position_index.list_chrom
 
         # Create index for samples
         self.idx_samples = allel.UniqueIndex(self.samples)
 
-        # Create combined index for variant positions
-        self.idx_pos = allel.ChromPosIndex(self.chrom, self.pos)
-
         self.samples_dict = dict(zip(self.samples.tolist(), list(range(0, self.samples.shape[0]))))
 
 
@@ -123,24 +151,7 @@ class GenotypeData:
 
 
     def _create_chrom_indices(self):
-
-        chrom_indices = {}
-        for _chr in self.list_chrom:
-            cached_index_path = self.datadir + '____pandas_index_chromosome_' + str(_chr) + '_.hdf5'
-            try:
-                chrom_indices[_chr] = pd.read_hdf(cached_index_path, key='s')
-                log.debug("++++ Loaded Pandas index for chromosome %s", str(_chr))
-                #print(chrom_indices[_chr].memory_usage(index=True))
-                #print(chrom_indices[_chr].info())
-
-            except FileNotFoundError:
-                log.debug("++++ Creating Pandas index for chromosome %s", str(_chr))
-                chrom_range = self.idx_pos.locate_key(_chr)
-                chrom_indices[_chr] = pd.Series(data=np.arange(chrom_range.start, chrom_range.stop), index=self.pos[chrom_range])
-                chrom_indices[_chr].to_hdf(cached_index_path, key='s', mode='w', complevel=5, complib='blosc:zstd')
-                #print(chrom_indices[_chr].memory_usage(index=True))
-        
-        self.chrom_indices = chrom_indices
+        self.position_index = PositionIndex.load_or_create(self.datadir + '____position_index____', self.callset)
 
 
 
@@ -160,7 +171,7 @@ class GenotypeData:
             log.debug("++++ Need to create chromosome metadata on thy fly")
             self.list_of_chromosomes = []
             for _chr in self.list_chrom:
-                _region = self.idx_pos.locate_range(_chr)
+                _region = slice(*self.position_index.chrom_range(_chr))
                 self.list_of_chromosomes.append({
                     'id': _chr,
                     'label': self.chromosome_labels[str(_chr)],
@@ -174,10 +185,15 @@ class GenotypeData:
 
 
 
-    def _free_mem(self):
-        del self.idx_pos
-        del self.chrom
+    def _load_density_tracks(self):
+        self.density_tracks = DensityTracks.open(self.datadir + '____density_tracks____.zarr')
+        self.available['density_tracks'] = self.density_tracks is not None
+
+
 
+    def _load_embeddings(self):
+        self.embeddings = Embeddings.open(self.datadir + '____embeddings____.zarr', self.count_samples)
+        self.available['embeddings'] = self.embeddings is not None
 
 
 
@@ -274,48 +290,188 @@ class GenotypeData:
         return samples_mask, samples_mapped
 
 
+    def get_precomputed_variants_stats(self, variants_selection) -> dict:
+        """Returns the precomputed per-variant statistics over all samples for a selection of variants
+
+        Args:
+            variants_selection (slice or numpy.ndarray): Selection along the variants axis
+
+        Returns:
+            dict: Arrays of `maf`, `missing_freq` and `heterozygosity_freq` values
+        """
+
+        result = {}
+        for name in VARIANTS_STATS_ARRAYS:
+            result[name] = self.callset[VARIANTS_STATS_GROUP][name].get_orthogonal_selection(variants_selection)
+
+        return result
+
+
+    def get_calldata_array(self, source: str, variants_selection, samples_mask: np.ndarray):
+        """Returns the array to read a selection of `calldata/GT` or `calldata/NALT` from
+
+        If a rechunked replica of the array exists, the one with the fewest bytes to decompress for the
+        selection (number of chunks touched times the size of a chunk) is chosen.
+
+        Args:
+            source (str): `calldata/GT` or `calldata/NALT`
+            variants_selection (slice or numpy.ndarray): Selection along the variants axis
+            samples_mask (numpy.ndarray): Boolean mask of the selected samples
+
+        Returns:
+            zarr.core.Array: The original array or its replica
+        """
+
+        array = self.callset[source]
+        if source not in self.calldata_replicas:
+            return array
+
+        def cost(candidate):
+            return count_chunks_touched(variants_selection, samples_mask, candidate.chunks) * int(np.prod(candidate.chunks, dtype=np.int64))
+
+        replica = self.calldata_replicas[source]
+        if cost(replica) < cost(array):
+            log.debug("Reading %s from the rechunked replica", source)
+            return replica
+
+        return array
+
+
+
+    def calc_variants_summary_stats_chunked(self, variants_selection, samples_mask: np.ndarray) -> dict:
+        """Calculates per-variant statistics for a selection of variants and samples chunk by chunk
+
+        Only one chunk of genotypes is held in memory at a time, the result has the same keys as
+        `get_precomputed_variants_stats()`.
+
+        Args:
+            variants_selection (slice or numpy.ndarray): Selection along the variants axis
+            samples_mask (numpy.ndarray): Boolean mask of the selected samples
+
+        Returns:
+            dict: Arrays of `maf`, `missing_freq` and `heterozygosity_freq` values
+        """
+
+        if isinstance(variants_selection, slice):
+            variants_indices = np.arange(variants_selection.start, variants_selection.stop)
+        else:
+            variants_indices = np.asarray(variants_selection)
+
+        # blocks are aligned to the chunks of the array that is read
+        source = self.get_calldata_array(NALT_ARRAY if self.available['nalt'] else 'calldata/GT', variants_selection, samples_mask)
+
+        parts = {name: [] for name in VARIANTS_STATS_ARRAYS}
+        for block_indices in iter_chunk_aligned_blocks(variants_indices, source.chunks[0]):
+            if block_indices[-1] - block_indices[0] + 1 == block_indices.shape[0]:
+                # contiguous block: plain slices are faster than integer indices
+                block_selection = slice(int(block_indices[0]), int(block_indices[-1]) + 1)
+            else:
+                block_selection = block_indices
+            if self.available['nalt']:
+                stats = calc_variants_stats_from_n_alt(source.get_orthogonal_selection((block_selection, samples_mask)), self.ploidy)
+                self.correct_mixed_alt_heterozygosity(block_selection, samples_mask, stats['heterozygosity_freq'])
+            else:
+                stats = calc_variants_stats(source.get_orthogonal_selection((block_selection, samples_mask)))
+            for name in VARIANTS_STATS_ARRAYS:
+                parts[name].append(stats[name])
+
+        result = {}
+        for name in VARIANTS_STATS_ARRAYS:
+            result[name] = np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=np.float32)
+
+        return result
+
+
+
+    def correct_mixed_alt_heterozygosity(self, variants_selection, samples_mask: np.ndarray, heterozygosity_freq: np.ndarray):
+        """Takes the heterozygosity frequencies of the variants flagged in `variants/NALT_MIXED_ALT` from the genotypes
+
+        Calls of different alternate alleles only (e.g. 1/2) are heterozygous, but can not be told apart from
+        homozygous alternate calls by their number of alternate alleles. Only the genotypes of the flagged
+        variants are read.
+
+        Args:
+            variants_selection (slice or numpy.ndarray): Selection along the variants axis the frequencies belong to
+            samples_mask (numpy.ndarray): Boolean mask of the selected samples
+            heterozygosity_freq (numpy.ndarray): Heterozygosity frequencies of the selected variants, modified in place
+        """
+
+        if isinstance(variants_selection, slice):
+            variants_indices = np.arange(variants_selection.start, variants_selection.stop)
+        else:
+            variants_indices = np.asarray(variants_selection)
+
+        mixed_alt = self.callset[MIXED_ALT_ARRAY].get_orthogonal_selection(variants_selection)
+        if not mixed_alt.any():
+            return
+
+        mixed_alt_indices = variants_indices[mixed_alt]
+        calldata = self.get_calldata_array('calldata/GT', mixed_alt_indices, samples_mask)
+        gt = calldata.get_orthogonal_selection((mixed_alt_indices, samples_mask))
+        heterozygosity_freq[mixed_alt] = calc_variants_stats(gt)['heterozygosity_freq']
+
+
+
+    def check_slice_memory(self, count_variants: int, count_samples: int, with_call_metadata: bool = False, from_nalt: bool = False):
+        """Raises an ApiError with HTTP status 413 if a slice would exceed the configured memory ceiling
+
+        The estimate covers the genotype calls, the alternate allele counts and their filtered copy, and the
+        call metadata (DP, DV) including its transposed copy.
+
+        Args:
+            count_variants (int): Number of variants of the slice
+            count_samples (int): Number of samples of the slice
+            with_call_metadata (bool): The call metadata is loaded as well
+            from_nalt (bool): The numbers of alternate alleles are read from `calldata/NALT` instead of the genotypes
+        """
+
+        if not self.max_slice_memory:
+            return
+
+        bytes_per_call = (1 if from_nalt else self.calldata.dtype.itemsize * max(self.ploidy, 1)) + 2
+        if with_call_metadata:
+            for name in ['DP', 'DV']:
+                if name in self.available_calldata:
+                    bytes_per_call += 2 * self.callset['calldata/' + name].dtype.itemsize
+
+        estimated = int(count_variants) * int(count_samples) * bytes_per_call
+        if estimated > self.max_slice_memory:
+            raise ApiError(
+                'The requested slice of '+str(count_variants)+' variants and '+str(count_samples)+' samples would need about '
+                +str(estimated // (1024 * 1024))+' MB of memory, which exceeds the limit of '+str(self.max_slice_memory // (1024 * 1024))+' MB. '
+                +'Please decrease the size of the genomic window or the number of samples.',
+                status_code = 413
+            )
+
+
+
     def get_posidx_by_genome_coordinate(self, chrom, pos, method='nearest') -> Tuple[int, str]:
         """Returns array coordinates for given physical position on a given chromosome
 
         Args:
             chrom (str): ID of the chromosome
             pos (int): Physical position on the chromosome
+            method (str): Fuzzy search method if the position does not exist: 'nearest', 'pad' or 'backfill'
 
         Returns:
             lookup (int) Array coordinate of the found physical position on the chromosome
             lookup_type (str): Type of the lookup, could be either 'direct_lookup' or 'nearest_lookup'
         """
-        
-        pd_series = self.chrom_indices[chrom]
-        try:
-            lookup = pd_series.at[pos]
-            return lookup, 'direct_lookup'
-        except KeyError:
-            # do fuzzy search via nearest neighbor search
-            nearest = pd_series.index.get_indexer([pos], method=method)[0]
-            lookup = pd_series.iloc[nearest]
-            return lookup, 'nearest_lookup'
 
+        return self.position_index.locate(chrom, pos, method=method)
 
-    def get_posidx_by_genome_coordinates(self, chrom, positions, method='nearest') -> Tuple[int, str]:
 
-        pd_series = self.chrom_indices[chrom]
+    def get_posidx_by_genome_coordinates(self, chrom, positions, method='nearest') -> Tuple[int, str]:
 
-        positions = [int(x) for x in positions]
-                
         start = timer()
-        diff = pd.Index(positions).difference(pd_series.index)
-        log.debug("============ diff = pd.Index(positions).difference(pd_series.index) => calculation time: %f", timer() - start)
+        found, lookup = self.position_index.locate_many(chrom, [int(x) for x in positions])
+        log.debug("============ self.position_index.locate_many() => calculation time: %f", timer() - start)
 
-        if diff.size > 0:
-            return False, None, diff.values
-        
-        else:
-            start = timer()
-            lookup = pd_series.loc[positions]
-            log.debug("============ lookup = pd_series.loc[positions] => calculation time: %f", timer() - start)
-            return True, lookup.values, None
+        if not found.all():
+            positions_not_found = np.unique(np.asarray(positions, dtype=np.int64)[~found])
+            return False, None, positions_not_found
 
+        return True, lookup, None
 
 
 
@@ -332,20 +488,23 @@ class GenotypeData:
 
         """
 
-        if startpos > endpos:
-            startpos, endpos = endpos, startpos
+        return int(self.count_variants_in_windows([chrom], [startpos], [endpos])[0])
 
-        location_start, lookup_type_start = self.get_posidx_by_genome_coordinate(chrom, startpos)
-        location_end, lookup_type_end = self.get_posidx_by_genome_coordinate(chrom, endpos)
-        location_end = location_end + 1
-        positions = self.pos[location_start:location_end]
 
-        count = 0
-        for i in range(positions.shape[0]):
-            if positions[i] >= startpos and positions[i] <= endpos:
-                count = count + 1
-        
-        return count
+    def count_variants_in_windows(self, chroms, startpos, endpos) -> np.ndarray:
+        """Counts number of variants in many genomic regions at once
+
+        Args:
+            chroms (array_like): The chromosome of each genomic region.
+            startpos (array_like): The first position of each genomic region.
+            endpos (array_like): The last position of each genomic region.
+
+        Returns:
+            numpy.ndarray: Number of variants in each genomic region
+
+        """
+
+        return self.position_index.count_in_windows(chroms, startpos, endpos)
 
 
 
@@ -360,6 +519,7 @@ class GenotypeData:
             variant_filter_settings = None,
             with_call_metadata = False,
             calc_summary_stats = False,
+            with_genotypes = True,
             flanking_region_include = False,
             flanking_region_length = 1500,
             flanking_region_direction = 'both'
@@ -367,19 +527,61 @@ class GenotypeData:
 
         start = timer()
 
-        lookup_type_start = False
-        lookup_type_end = False
-        type_of_slice = 'range'
-        positions_not_found = None
-
         if samples is None:
             samples = self.samples
 
         samples_mask, samples_selected_mapped = self.get_samples_mask(samples)
 
         log.debug("============ self.get_samples_mask() => calculation time: %f", timer() - start)
+
+        selection = self._resolve_variants_selection(
+            chrom = chrom,
+            startpos = startpos,
+            endpos = endpos,
+            positions = positions,
+            count = count,
+            flanking_region_include = flanking_region_include,
+            flanking_region_length = flanking_region_length,
+            flanking_region_direction = flanking_region_direction
+        )
+
+        return self._create_variant_calls_slice(
+            selection = selection,
+            samples_mask = samples_mask,
+            samples_selected_mapped = samples_selected_mapped,
+            variant_filter_settings = variant_filter_settings,
+            with_call_metadata = with_call_metadata,
+            calc_summary_stats = calc_summary_stats,
+            with_genotypes = with_genotypes
+        )
+
+
+
+    def _resolve_variants_selection(
+            self,
+            chrom,
+            startpos = None,
+            endpos = None,
+            positions = None,
+            count = None,
+            flanking_region_include = False,
+            flanking_region_length = 1500,
+            flanking_region_direction = 'both'
+        ) -> SimpleNamespace:
+        """Resolves a genomic range, a number of variants or a list of positions to indices of the variant matrix
+
+        Returns:
+            SimpleNamespace: type of the slice, the selection for Zarr (a slice or indices), positions, indices of the
+                positions, positions not found and the first and last location of the range
+        """
+
         start = timer()
 
+        lookup_type_start = False
+        lookup_type_end = False
+        type_of_slice = 'range'
+        positions_not_found = None
+
         if count is None:
 
             #print("++++++++++++++++++++++++++++++++++++++++++++")
@@ -447,12 +649,46 @@ class GenotypeData:
             positions = self.pos[slice_variant_calls]
             positions_indices = np.array(list(range(location_start, location_end)))
 
+        return SimpleNamespace(
+            type_of_slice = type_of_slice,
+            slice_variant_calls = slice_variant_calls,
+            positions = positions,
+            positions_indices = positions_indices,
+            positions_not_found = positions_not_found,
+            location_start = location_start,
+            location_end = location_end
+        )
+
 
 
+    def _create_variant_calls_slice(
+            self,
+            selection: SimpleNamespace,
+            samples_mask: np.ndarray,
+            samples_selected_mapped: list,
+            variant_filter_settings = None,
+            with_call_metadata = False,
+            calc_summary_stats = False,
+            with_genotypes = True
+        ) -> VariantCallsSlice:
+        """Loads the genotypes (and call metadata) of a resolved selection of variants and samples into a VariantCallsSlice"""
 
-        # get the variant slice from Zarr dataset
+        slice_variant_calls = selection.slice_variant_calls
+
+        # get the variant slice from Zarr dataset, it is skipped if only statistics are needed, these are
+        # then read from the precomputed statistics or calculated chunk by chunk
+        # if the full genotypes are not needed, the precomputed numbers of alternate alleles are read instead
         start = timer()
-        sliced_variant_calls = self.calldata.get_orthogonal_selection((slice_variant_calls, samples_mask))
+        sliced_variant_calls = None
+        sliced_numbers_of_alternate_alleles = None
+        if with_call_metadata or (with_genotypes and not self.available['nalt']):
+            self.check_slice_memory(len(selection.positions_indices), int(np.count_nonzero(samples_mask)), with_call_metadata)
+            calldata = self.get_calldata_array('calldata/GT', slice_variant_calls, samples_mask)
+            sliced_variant_calls = calldata.get_orthogonal_selection((slice_variant_calls, samples_mask))
+        elif with_genotypes:
+            self.check_slice_memory(len(selection.positions_indices), int(np.count_nonzero(samples_mask)), from_nalt=True)
+            nalt = self.get_calldata_array(NALT_ARRAY, slice_variant_calls, samples_mask)
+            sliced_numbers_of_alternate_alleles = nalt.get_orthogonal_selection((slice_variant_calls, samples_mask))
         log.debug("============ self.calldata.get_orthogonal_selection() section => calculation time: %f", timer() - start)
 
 
@@ -483,14 +719,15 @@ class GenotypeData:
         start = timer()
         variant_calls_slice = VariantCallsSlice(
             gd = self,
-            type_of_slice = type_of_slice,
+            type_of_slice = selection.type_of_slice,
             #positional_lookup_success = positional_lookup_success,
             sliced_variant_calls = sliced_variant_calls,
-            positions = positions,
-            positions_indices = positions_indices,
-            positions_not_found = positions_not_found,
-            location_start = location_start,
-            location_end = location_end,
+            sliced_numbers_of_alternate_alleles = sliced_numbers_of_alternate_alleles,
+            positions = selection.positions,
+            positions_indices = selection.positions_indices,
+            positions_not_found = selection.positions_not_found,
+            location_start = selection.location_start,
+            location_end = selection.location_end,
             samples_mask = samples_mask,
             samples_selected_mapped = samples_selected_mapped,
             variant_filter_settings = variant_filter_settings,
@@ -499,4 +736,99 @@ class GenotypeData:
         )
         log.debug("============ variant_calls_slice = VariantCallsSlice() section => calculation time: %f", timer() - start)
 
-        return variant_calls_slice
\ No newline at end of file
+        return variant_calls_slice
+
+
+
+    def iter_variant_call_blocks(
+            self,
+            chrom,
+            startpos = None,
+            endpos = None,
+            positions = None,
+            samples = None,
+            variant_filter_settings = None,
+            with_genotypes = True,
+            block_size = None
+        ):
+        """Iterates over a genomic region or a list of positions in consecutive blocks of variants
+
+        Every block is a separate VariantCallsSlice with the variant filters applied, so that only one block
+        of genotypes is held in memory at a time. Blocks of a genomic region are aligned to the chunks of `calldata/GT`.
+
+        Args:
+            chrom (str): ID of the chromosome
+            startpos (int): First position of the genomic region
+            endpos (int): Last position of the genomic region
+            positions (list): List of positions, used instead of the genomic region if given
+            samples (list): List of sample IDs, defaults to all samples
+            variant_filter_settings (dict): Variant filter settings as for `get_slice_of_variant_calls()`
+            with_genotypes (bool): Load the genotypes of each block
+            block_size (int): Number of variants per block, rounded up to a multiple of the chunk length of `calldata/GT`
+
+        Yields:
+            int: Number of variants of the selection processed so far
+            int: Number of all variants of the selection
+            VariantCallsSlice: The current block
+        """
+
+        if samples is None:
+            samples = self.samples
+
+        samples_mask, samples_selected_mapped = self.get_samples_mask(samples)
+        selection = self._resolve_variants_selection(chrom, startpos = startpos, endpos = endpos, positions = positions)
+
+        if selection.type_of_slice == 'positions' and selection.slice_variant_calls is False:
+            raise ApiError('The following positions could not be found: '+', '.join(map(str, selection.positions_not_found.tolist())))
+
+        # round the block size up to a multiple of the chunk length
+        chunk_size = self.calldata.chunks[0]
+        block_size = -(-(block_size or chunk_size) // chunk_size) * chunk_size
+
+        if selection.type_of_slice == 'positions':
+            count_variants = len(selection.positions_indices)
+            block_borders = list(range(0, count_variants, block_size)) + [count_variants]
+        else:
+            count_variants = selection.location_end - selection.location_start
+            # the first block ends at a chunk border, so that all following blocks start at one
+            first_block_end = min(selection.location_end, (selection.location_start // chunk_size + 1) * chunk_size)
+            block_borders = [selection.location_start] + list(range(first_block_end, selection.location_end, block_size)) + [selection.location_end]
+            if count_variants <= 0:
+                block_borders = [selection.location_start]
+
+        processed = 0
+        for block_start, block_end in zip(block_borders[:-1], block_borders[1:]):
+
+            if selection.type_of_slice == 'positions':
+                block_indices = selection.positions_indices[block_start:block_end]
+                block_selection = SimpleNamespace(
+                    type_of_slice = 'positions',
+                    slice_variant_calls = block_indices,
+                    positions = self.pos[block_indices],
+                    positions_indices = block_indices,
+                    positions_not_found = None,
+                    location_start = 0,
+                    location_end = 0
+                )
+            else:
+                block_selection = SimpleNamespace(
+                    type_of_slice = 'range',
+                    slice_variant_calls = slice(block_start, block_end, None),
+                    positions = self.pos[block_start:block_end],
+                    positions_indices = np.arange(block_start, block_end),
+                    positions_not_found = None,
+                    location_start = block_start,
+                    location_end = block_end
+                )
+
+            block = self._create_variant_calls_slice(
+                selection = block_selection,
+                samples_mask = samples_mask,
+                samples_selected_mapped = samples_selected_mapped,
+                variant_filter_settings = variant_filter_settings,
+                calc_summary_stats = True,
+                with_genotypes = with_genotypes
+            )
+
+            processed += block_end - block_start
+            yield processed, count_variants, block
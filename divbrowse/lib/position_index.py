@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from divbrowse import log
+
+
+
+def get_pos_fingerprint(callset) -> dict:
+    """Identifies the POS array of a Zarr archive by its metadata and, for archives on disk, the size and modification time of its files"""
+
+    pos = callset['variants/POS']
+    fingerprint = {
+        'count_variants': int(pos.shape[0]),
+        'zarray': hashlib.blake2b(pos.store[pos.path + '/.zarray'], digest_size=16).hexdigest()
+    }
+
+    # unwrap caching stores down to the DirectoryStore
+    store = pos.store
+    while not hasattr(store, 'path') and hasattr(store, '_store'):
+        store = store._store
+
+    if isinstance(getattr(store, 'path', None), str):
+        path_pos = os.path.join(store.path, pos.path)
+        stats = [os.stat(os.path.join(path_pos, filename)) for filename in os.listdir(path_pos)]
+        fingerprint['mtime_ns'] = max(stat.st_mtime_ns for stat in stats)
+        fingerprint['size'] = sum(stat.st_size for stat in stats)
+
+    return fingerprint
+
+
+
+class PositionIndex:
+    """Compact index of variant positions
+
+    All positions of the variant matrix are kept in one contiguous array that is sorted within each chromosome.
+    A chromosome is addressed by its (start, stop) offsets into that array, so every lookup is a `numpy.searchsorted()`
+    on a view without any per-chromosome copy.
+    """
+
+    def __init__(self, pos: np.ndarray, offsets: dict):
+        self.pos = pos
+        self.offsets = offsets
+        self.list_chrom = list(offsets.keys())
+
+
+    @classmethod
+    def from_chrom_pos(cls, chrom: np.ndarray, pos: np.ndarray) -> 'PositionIndex':
+        """Creates the index from the CHROM and POS arrays of the variant matrix
+
+        Args:
+            chrom (numpy.ndarray): Chromosome of each variant, chromosomes have to be stored contiguously
+            pos (numpy.ndarray): Physical position of each variant, sorted within each chromosome
+
+        Returns:
+            PositionIndex: the created index
+        """
+
+        if pos.size > 0 and int(pos.max()) < np.iinfo(np.int32).max:
+            pos = pos.astype(np.int32, copy=False)
+        else:
+            pos = pos.astype(np.int64, copy=False)
+
+        boundaries = np.flatnonzero(chrom[1:] != chrom[:-1]) + 1
+        starts = np.concatenate(([0], boundaries)) if chrom.size > 0 else np.array([], dtype=np.int64)
+        stops = np.concatenate((boundaries, [chrom.size])) if chrom.size > 0 else np.array([], dtype=np.int64)
+
+        offsets = {}
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            _chr = chrom[start]
+            if _chr in offsets:
+                raise ValueError('Variants of chromosome '+str(_chr)+' are not stored contiguously in the variant matrix')
+            if np.any(np.diff(pos[start:stop]) < 0):
+                raise ValueError('Positions of chromosome '+str(_chr)+' are not sorted in the variant matrix')
+            offsets[_chr] = (start, stop)
+
+        return cls(pos, offsets)
+
+
+    @classmethod
+    def load_or_create(cls, path_prefix: str, callset) -> 'PositionIndex':
+        """Loads the index from its sidecar files or creates (and saves) it from the Zarr archive
+
+        The positions are saved as `<path_prefix>.npy` and memory-mapped on load, the chromosome offsets are
+        saved as `<path_prefix>.json`. The cache is rebuilt if the POS array of the Zarr archive changed,
+        see `get_pos_fingerprint()`.
+
+        Args:
+            path_prefix (str): Path of the sidecar files without extension
+            callset (zarr.hierarchy.Group): The Zarr group of the variant matrix
+
+        Returns:
+            PositionIndex: the loaded or created index
+        """
+
+        path_npy = path_prefix + '.npy'
+        path_json = path_prefix + '.json'
+        pos_fingerprint = get_pos_fingerprint(callset)
+
+        try:
+            with open(path_json) as f:
+                meta = json.loads(f.read())
+
+            if meta.get('pos_fingerprint', None) == pos_fingerprint:
+                pos = np.load(path_npy, mmap_mode='r')
+                offsets = {_chr: tuple(_range) for _chr, _range in meta['offsets']}
+                log.debug("++++ Loaded position index from %s", path_npy)
+                return cls(pos, offsets)
+
+            log.debug("++++ Position index on disk is outdated")
+
+        except FileNotFoundError:
+            pass
+
+        log.debug("++++ Creating position index")
+        index = cls.from_chrom_pos(callset['variants/CHROM'][:], callset['variants/POS'][:])
+
+        np.save(path_npy, index.pos)
+        with open(path_json, 'w') as outfile:
+            json.dump({
+                'pos_fingerprint': pos_fingerprint,
+                'offsets': [[_chr, list(_range)] for _chr, _range in index.offsets.items()]
+            }, outfile)
+
+        return index
+
+
+    def chrom_range(self, chrom) -> Tuple[int, int]:
+        """Returns the (start, stop) array coordinates of a chromosome"""
+        return self.offsets[chrom]
+
+
+    def locate(self, chrom, pos: int, method: str = 'nearest') -> Tuple[int, str]:
+        """Returns the array coordinate for a physical position on a chromosome
+
+        Args:
+            chrom (str): ID of the chromosome
+            pos (int): Physical position on the chromosome
+            method (str): Fallback if the position does not exist: 'nearest', 'pad' (previous variant) or 'backfill' (next variant)
+
+        Returns:
+            int: Array coordinate of the found physical position
+            str: Type of the lookup, either 'direct_lookup' or 'nearest_lookup'
+        """
+
+        start, stop = self.offsets[chrom]
+        pos_chrom = self.pos[start:stop]
+        last = pos_chrom.shape[0] - 1
+
+        i = int(np.searchsorted(pos_chrom, pos, side='left'))
+        if i <= last and pos_chrom[i] == pos:
+            return start + i, 'direct_lookup'
+
+        if method == 'pad':
+            i = i - 1
+        elif method == 'nearest':
+            # ties are resolved to the next variant, like pandas.Index.get_indexer(method='nearest')
+            if i > last or (i > 0 and pos - pos_chrom[i - 1] < pos_chrom[i] - pos):
+                i = i - 1
+        elif method != 'backfill':
+            raise ValueError('Unknown lookup method: '+str(method))
+
+        i = min(max(i, 0), last)
+        return start + i, 'nearest_lookup'
+
+
+    def locate_many(self, chrom, positions) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact lookup of many physical positions on a chromosome
+
+        Args:
+            chrom (str): ID of the chromosome
+            positions (array_like): Physical positions on the chromosome
+
+        Returns:
+            numpy.ndarray: Boolean mask, True for positions that exist in the variant matrix
+            numpy.ndarray: Array coordinates of the positions (only valid where the mask is True)
+        """
+
+        start, stop = self.offsets[chrom]
+        pos_chrom = self.pos[start:stop]
+        positions = np.asarray(positions, dtype=np.int64)
+
+        idx = np.searchsorted(pos_chrom, positions, side='left')
+        idx_clipped = np.minimum(idx, max(pos_chrom.shape[0] - 1, 0))
+        found = (idx < pos_chrom.shape[0]) & (pos_chrom[idx_clipped] == positions)
+
+        return found, idx_clipped + start
+
+
+    def locate_range(self, chrom, startpos: int, endpos: int) -> slice:
+        """Returns a slice of array coordinates covering all variants with startpos <= POS <= endpos"""
+
+        start, stop = self.offsets[chrom]
+        pos_chrom = self.pos[start:stop]
+        lo = int(np.searchsorted(pos_chrom, startpos, side='left'))
+        hi = int(np.searchsorted(pos_chrom, endpos, side='right'))
+
+        return slice(start + lo, start + max(lo, hi), None)
+
+
+    def count_in_windows(self, chroms, startpos, endpos) -> np.ndarray:
+        """Counts the variants in many genomic regions at once
+
+        Regions are grouped by chromosome, each group is resolved with two `numpy.searchsorted()` calls.
+        Start and end of a region are swapped if necessary, regions on unknown chromosomes have a count of 0.
+
+        Args:
+            chroms (array_like): Chromosome of each region
+            startpos (array_like): First position of each region
+            endpos (array_like): Last position of each region
+
+        Returns:
+            numpy.ndarray: Number of variants per region
+        """
+
+        chroms = np.asarray(chroms)
+        startpos = np.asarray(startpos, dtype=np.int64)
+        endpos = np.asarray(endpos, dtype=np.int64)
+        startpos, endpos = np.minimum(startpos, endpos), np.maximum(startpos, endpos)
+
+        counts = np.zeros(chroms.shape[0], dtype=np.int64)
+        for _chr in pd.unique(chroms):
+            if _chr not in self.offsets:
+                continue
+            start, stop = self.offsets[_chr]
+            pos_chrom = self.pos[start:stop]
+            mask = chroms == _chr
+            lo = np.searchsorted(pos_chrom, startpos[mask], side='left')
+            hi = np.searchsorted(pos_chrom, endpos[mask], side='right')
+            counts[mask] = np.maximum(hi - lo, 0)
+
+        return counts
@@ -40,4 +40,4 @@ class ORJSONEncoder:
 
     def encode(self, obj):
         # decode back to str, as orjson returns bytes
-        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
\ No newline at end of file
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
\ No newline at end of file
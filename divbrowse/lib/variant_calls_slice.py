@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+import hashlib
 from icecream import ic
 import allel
 import numpy as np
@@ -7,6 +8,7 @@ import pandas as pd
 
 from timeit import default_timer as timer
 from divbrowse import log
+from divbrowse.lib.variants_stats import calc_variant_filter_mask, calc_variants_stats_from_counts, count_n_alt_values, get_active_variant_filters
 
 
 def with_gd():
@@ -25,6 +27,7 @@ class VariantCallsSlice:
     type_of_slice: str = 'range'
     positional_lookup_success: bool = True
     sliced_variant_calls: np.ndarray = None
+    sliced_numbers_of_alternate_alleles: np.ndarray = None
     positions: np.ndarray = None
     positions_indices: np.ndarray = None
     positions_not_found: np.ndarray = None
@@ -40,7 +43,7 @@ class VariantCallsSlice:
     def __post_init__(self):
         self.slice_variant_calls = slice(self.location_start, self.location_end, None)
 
-        self.ploidy = int(self.sliced_variant_calls.ndim) - 1
+        self.ploidy = self.gd.ploidy
 
         start = timer()
         self.count_alternate_alleles()
@@ -48,9 +51,13 @@ class VariantCallsSlice:
 
         if self.calc_summary_stats and self.positions_not_found is None: # if self.positions_not_found is not None:
             start = timer()
-            #self.calc_variants_summary_stats_numpy()
-            self.calc_variants_summary_stats_scikitallel()
-            log.debug("//////////////// __post_init__ calc_variants_summary_stats_scikitallel => %f", timer() - start)
+            if self.gd.available['variants_stats'] and self.samples_mask.all():
+                self.variants_summary_stats = self.gd.get_precomputed_variants_stats(self.get_variants_selection())
+                log.debug("//////////////// __post_init__ get_precomputed_variants_stats => %f", timer() - start)
+            else:
+                #self.calc_variants_summary_stats_numpy()
+                self.calc_variants_summary_stats_cached()
+                log.debug("//////////////// __post_init__ calc_variants_summary_stats_cached => %f", timer() - start)
 
         start = timer()
         self.apply_variant_filter_settings()
@@ -62,26 +69,41 @@ class VariantCallsSlice:
 
 
     @staticmethod
-    def calculate_mean(slice_of_variant_calls: np.ndarray) -> np.ndarray:
+    def calculate_mean(slice_of_variant_calls: np.ndarray, missing_mask: np.ndarray = None) -> np.ndarray:
         """Calculate the mean for each variant of a variant matrix array holding the number of alternate alleles
 
         Note:
-            Missing variant calls are excluded from the mean calculation
+            Missing variant calls are excluded from the mean calculation. The means are calculated from integer
+            sums and counts, no floating point copy of the variant matrix is created.
 
         Args:
             slice_of_variant_calls (numpy.ndarray): Numpy array representing a variant matrix holding the number of alternate allele calls
+            missing_mask (numpy.ndarray): Boolean mask of missing calls, derived from the -1 values if not given
 
         Returns:
-            numpy.ndarray: Numpy array holding the means per variant
+            numpy.ndarray: Numpy array holding the means per variant, NaN for variants without any called sample
         """
 
-        slice_of_variant_calls_missing_values_to_nan = np.where(slice_of_variant_calls == -1, np.nan, slice_of_variant_calls)
-        return np.nanmean(slice_of_variant_calls_missing_values_to_nan, axis=0) #, keepdims=True
+        if missing_mask is None:
+            missing_mask = slice_of_variant_calls == -1
+
+        count_missing = np.count_nonzero(missing_mask, axis=0)
+        count_called = slice_of_variant_calls.shape[0] - count_missing
+
+        # missing calls are encoded as -1, adding the number of missing calls removes them from the sum
+        sums = np.sum(slice_of_variant_calls, axis=0, dtype=np.int64) + count_missing
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / count_called
 
 
 
     def count_alternate_alleles(self):
-        """Returns a tupel consisting of a boolean mask for found sample Ids and a list of mapped sample IDs
+        """Counts the alternate alleles of each call of the sliced variant matrix
+
+        The result is a C-contiguous int8 matrix in sample-major order (samples x variants) with missing calls
+        encoded as -1, together with a boolean mask of the missing calls of the same shape. Both are created
+        once here and shared by all consumers (statistics, filters, imputation and exports).
 
         Args:
             sliced_variant_calls (numpy.ndarray): variant matrix array holding the allele calls (0/0  0/1  1/1)
@@ -91,15 +113,42 @@ class VariantCallsSlice:
         """
 
         self.numbers_of_alternate_alleles = None
+        self.missing_mask = None
+
+        # genotypes were not loaded, but the precomputed numbers of alternate alleles from `calldata/NALT`
+        if self.sliced_variant_calls is None and self.sliced_numbers_of_alternate_alleles is not None:
+            self.numbers_of_alternate_alleles = np.ascontiguousarray(self.sliced_numbers_of_alternate_alleles.T, dtype=np.int8)
+            self.missing_mask = self.numbers_of_alternate_alleles < 0
+            return self.numbers_of_alternate_alleles
+
+        # genotypes were not loaded, e.g. because only precomputed statistics are needed
+        if self.sliced_variant_calls is None:
+            return
+
+        # transposed view with samples in the 1st dimension, the results below are allocated in C order
+        calls = np.swapaxes(np.asarray(self.sliced_variant_calls), 0, 1)
 
         # monoploid / haploid
-        if self.sliced_variant_calls.ndim == 2:
-            self.numbers_of_alternate_alleles = allel.HaplotypeArray(self.sliced_variant_calls).T
+        if calls.ndim == 2:
+            n_alt = np.empty(calls.shape, dtype=np.int8)
+            np.copyto(n_alt, calls, casting='unsafe')
+            missing_mask = n_alt < 0
 
-        # diploid
-        if self.sliced_variant_calls.ndim == 3:
-            # Transform each genotype call into the number of non-reference alleles and then transpose it via .T to row-major order
-            self.numbers_of_alternate_alleles = allel.GenotypeArray(self.sliced_variant_calls).to_n_alt(fill=-1).T
+        # diploid (and higher ploidies)
+        if calls.ndim == 3:
+            # Transform each genotype call into the number of non-reference alleles, a call is missing if any of its alleles is missing
+            n_alt = np.zeros(calls.shape[:2], dtype=np.int8)
+            missing_mask = np.zeros(calls.shape[:2], dtype=bool)
+            for i in range(calls.shape[2]):
+                alleles = calls[:, :, i]
+                np.add(n_alt, alleles > 0, out=n_alt, casting='unsafe')
+                np.logical_or(missing_mask, alleles < 0, out=missing_mask)
+            n_alt[missing_mask] = -1
+
+        self.numbers_of_alternate_alleles = n_alt
+        self.missing_mask = missing_mask
+
+        return n_alt
 
 
 
@@ -111,12 +160,12 @@ class VariantCallsSlice:
         """
 
         if self.ploidy == 1:
-            means = VariantCallsSlice.calculate_mean(self.numbers_of_alternate_alleles)
+            means = VariantCallsSlice.calculate_mean(self.numbers_of_alternate_alleles, self.missing_mask)
             maf = np.where(means < 0.5, means, 1 - means)
             return np.nan_to_num(maf, nan=-1).tolist()
 
         if self.ploidy == 2:
-            means_halfed = VariantCallsSlice.calculate_mean(self.numbers_of_alternate_alleles) / 2
+            means_halfed = VariantCallsSlice.calculate_mean(self.numbers_of_alternate_alleles, self.missing_mask) / 2
             maf = np.where(means_halfed < 0.5, means_halfed, 1 - means_halfed)
             return np.nan_to_num(maf, nan=-1).tolist()
 
@@ -201,23 +250,24 @@ class VariantCallsSlice:
         result = {}
         result['maf'] = self.calculate_minor_allele_freq()
 
-        num_samples = self.sliced_variant_calls.shape[1]
-        g = allel.GenotypeArray(self.sliced_variant_calls)
-        
-        miss = g.count_missing(axis=1)
-        #print(miss)
-        #print(miss.shape)
+        num_samples = self.numbers_of_alternate_alleles.shape[0]
+
+        miss = np.count_nonzero(self.missing_mask, axis=0)
         result['missing_freq'] = (miss / num_samples).tolist()
 
-        called = g.count_called(axis=1)
-        #print(called)
-        #print(called.shape)
+        called = num_samples - miss
 
-        het = g.count_het(axis=1)
-        #print(het)
-        #print(het.shape)
+        if self.sliced_variant_calls is not None and self.sliced_variant_calls.ndim == 3:
+            het = allel.GenotypeArray(self.sliced_variant_calls).count_het(axis=1)
+        elif self.ploidy > 1:
+            # only the numbers of alternate alleles are available
+            n_alt = self.numbers_of_alternate_alleles
+            het = np.count_nonzero((n_alt > 0) & (n_alt < self.ploidy), axis=0)
+        else:
+            het = np.zeros(called.shape[0], dtype=np.int64)
 
-        het_freq = het / called
+        with np.errstate(divide='ignore', invalid='ignore'):
+            het_freq = het / called
         #print(het_freq)
         result['heterozygosity_freq'] = het_freq.tolist()
 
@@ -226,51 +276,118 @@ class VariantCallsSlice:
         return result
 
 
+    def calc_variants_summary_stats_fused(self):
+        """Calculates MAF, missing and heterozygosity frequencies in a single pass over the alternate allele counts
+
+        See `count_n_alt_values()`. Yields the same values as `calc_variants_summary_stats_scikitallel()`: if the
+        genotypes contain calls of two different alternate alleles, heterozygosity is taken from the genotypes.
+        This also holds if only `calldata/NALT` was loaded, see `GenotypeData.correct_mixed_alt_heterozygosity()`.
+        """
+
+        counts = count_n_alt_values(self.numbers_of_alternate_alleles, self.ploidy, variants_axis=1)
+        stats = calc_variants_stats_from_counts(counts, self.ploidy)
+
+        if self.sliced_variant_calls is not None and self.sliced_variant_calls.ndim == 3 and self.sliced_variant_calls.max(initial=0) > 1:
+            called = self.numbers_of_alternate_alleles.shape[0] - counts[:, 0]
+            het = allel.GenotypeArray(self.sliced_variant_calls).count_het(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats['heterozygosity_freq'] = het / called
+        elif self.sliced_variant_calls is None and self.sliced_numbers_of_alternate_alleles is not None:
+            self.gd.correct_mixed_alt_heterozygosity(self.get_variants_selection(), self.samples_mask, stats['heterozygosity_freq'])
+
+        result = {
+            'maf': stats['maf'],
+            'missing_freq': stats['missing_freq'],
+            'heterozygosity_freq': stats['heterozygosity_freq']
+        }
+
+        self.variants_summary_stats = result
+
+        return result
+
+
+    def get_variants_selection(self):
+        """Returns the selection of this slice along the variants axis, usable for Zarr selections"""
+
+        if self.type_of_slice == 'positions':
+            return self.positions_indices
+
+        return self.slice_variant_calls
+
+
+    def get_summary_stats_cache_key(self) -> tuple:
+        """Returns a key identifying the variants and samples of this slice for the summary stats cache"""
+
+        if self.type_of_slice == 'positions':
+            positions_indices = np.ascontiguousarray(self.positions_indices, dtype=np.int64)
+            variants_key = hashlib.blake2b(positions_indices.tobytes(), digest_size=16).hexdigest()
+        else:
+            variants_key = (int(self.location_start), int(self.location_end))
+
+        samples_key = hashlib.blake2b(np.packbits(self.samples_mask).tobytes(), digest_size=16).hexdigest()
+
+        return (self.type_of_slice, variants_key, samples_key)
+
+
+    def calc_variants_summary_stats_cached(self):
+        """Takes the per-variant summary statistics from the summary stats cache of GenotypeData or calculates and caches them"""
+
+        cache_key = self.get_summary_stats_cache_key()
+        cached = self.gd.summary_stats_cache.get(cache_key)
+
+        if cached is None:
+            if self.numbers_of_alternate_alleles is None:
+                # genotypes were not loaded for this slice, stream them chunk by chunk
+                cached = self.gd.calc_variants_summary_stats_chunked(self.get_variants_selection(), self.samples_mask)
+            else:
+                cached = self.calc_variants_summary_stats_fused()
+            self.gd.summary_stats_cache.set(cache_key, dict(cached))
+
+        # shallow copy, callers add further keys (e.g. `vcf_qual`) to the dict of this slice
+        self.variants_summary_stats = dict(cached)
+
+        return self.variants_summary_stats
+
+
     @with_gd()
     def apply_variant_filter_settings(self):
+        """Removes the variants failing the active variant filters from this slice
+
+        The filters are combined into one boolean mask over the per-variant statistics by `calc_variant_filter_mask()`,
+        the alternate allele counts and the missing mask are compacted once with it.
+        """
 
         self.filtered_positions_indices = self.positions_indices
 
         if self.variant_filter_settings is None:
             return False
 
-        fs = self.variant_filter_settings
-
-        if 'QUAL' in gd.available_variants_metadata:
-            sliced_qual = gd.variants_qual.get_coordinate_selection(self.positions_indices)
-            self.variants_summary_stats['vcf_qual'] = sliced_qual.tolist()
-        
-        #self.variants_summary_stats['positions_indices'] = list(range(0, self.positions_indices.shape[0]))
-        self.variants_summary_stats['positions_indices'] = self.positions_indices.tolist()
-        df = pd.DataFrame(self.variants_summary_stats)
-
-        log.debug(df)
-
-        if 'filterByMaf' in fs and fs['filterByMaf'] == True:
-            df = df[ df['maf'].between(fs['maf'][0], fs['maf'][1]) ]
-
-        if 'filterByMissingFreq' in fs and fs['filterByMissingFreq'] == True:
-            df = df[ df['missing_freq'].between(fs['missingFreq'][0], fs['missingFreq'][1]) ]
+        if 'filterByVcfQual' in get_active_variant_filters(self.variant_filter_settings) and 'QUAL' in gd.available_variants_metadata:
+            self.variants_summary_stats['vcf_qual'] = gd.variants_qual.get_coordinate_selection(self.positions_indices)
 
-        if 'filterByHeteroFreq' in fs and fs['filterByHeteroFreq'] == True:
-            df = df[ df['heterozygosity_freq'].between(fs['heteroFreq'][0], fs['heteroFreq'][1]) ]
+        mask = calc_variant_filter_mask(self.variants_summary_stats, self.variant_filter_settings)
+        if mask is None or mask.all():
+            return self.numbers_of_alternate_alleles, self.filtered_positions_indices
 
-        if 'filterByVcfQual' in fs and fs['filterByVcfQual'] == True and 'QUAL' in gd.available_variants_metadata:
-            df = df[ df['vcf_qual'].between(fs['vcfQual'][0], fs['vcfQual'][1]) ]
+        columns = np.flatnonzero(mask)
 
-        if self.numbers_of_alternate_alleles[:, df.index.values].shape[1] > 0:
-            self.numbers_of_alternate_alleles = self.numbers_of_alternate_alleles[:, df.index.values]
+        # np.take() along the variants axis keeps the filtered matrices C-contiguous
+        if self.numbers_of_alternate_alleles is not None and columns.shape[0] > 0:
+            self.numbers_of_alternate_alleles = np.take(self.numbers_of_alternate_alleles, columns, axis=1)
+            self.missing_mask = np.take(self.missing_mask, columns, axis=1)
 
-        log.debug(df)
-        self.filtered_positions_indices = df['positions_indices'].values
+        self.filtered_positions_indices = self.positions_indices[columns]
 
-        return self.numbers_of_alternate_alleles, df['positions_indices'].values
+        return self.numbers_of_alternate_alleles, self.filtered_positions_indices
 
 
 
     def add_stats(self):
         self.number_of_variants_in_window = int(self.positions.shape[0])
-        self.number_of_variants_in_window_filtered = int(self.numbers_of_alternate_alleles.shape[1])
+        if self.numbers_of_alternate_alleles is not None:
+            self.number_of_variants_in_window_filtered = int(self.numbers_of_alternate_alleles.shape[1])
+        else:
+            self.number_of_variants_in_window_filtered = int(self.filtered_positions_indices.shape[0])
         self.startpos = int(self.positions[0])
         self.endpos = int(self.positions[-1])
 
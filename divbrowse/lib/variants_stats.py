@@ -0,0 +1,400 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import allel
+import numcodecs
+import numpy as np
+import zarr
+
+
+VARIANTS_STATS_GROUP = 'variants_stats'
+VARIANTS_STATS_ARRAYS = ['maf', 'missing_freq', 'heterozygosity_freq']
+
+# switch of each variant filter in the frontend's filter settings, the key of its range and the filtered statistic
+VARIANT_FILTERS = {
+    'filterByMaf': 'maf',
+    'filterByMissingFreq': 'missingFreq',
+    'filterByHeteroFreq': 'heteroFreq',
+    'filterByVcfQual': 'vcfQual'
+}
+VARIANT_FILTERS_STATS = {
+    'filterByMaf': 'maf',
+    'filterByMissingFreq': 'missing_freq',
+    'filterByHeteroFreq': 'heterozygosity_freq',
+    'filterByVcfQual': 'vcf_qual'
+}
+
+SAMPLES_STATS_GROUP = 'samples_stats'
+SAMPLES_STATS_PARTIAL_ARRAYS = ['partial_count_called', 'partial_count_het']
+
+
+
+def calc_variants_stats(gt: np.ndarray, max_allele: int = None) -> dict:
+    """Calculates per-variant summary statistics over all samples of a block of genotype calls
+
+    Args:
+        gt (numpy.ndarray): Genotype calls of shape (variants, samples, ploidy) or (variants, samples) for haploids
+        max_allele (int): Highest allele index to count, if given the allele counts are calculated as well
+
+    Returns:
+        dict: float32 arrays `maf` (-1 if no sample is called), `missing_freq` and `heterozygosity_freq` (NaN if no sample is called),
+            int32 array `allele_counts` of shape (variants, max_allele + 1) if `max_allele` is given,
+            int32 arrays `count_called` and `count_het` per sample
+    """
+
+    num_samples = gt.shape[1]
+
+    if gt.ndim == 2:
+        ploidy = 1
+        n_alt = np.asarray(gt)
+        is_missing = n_alt < 0
+        is_het = np.zeros(gt.shape, dtype=bool)
+    else:
+        ploidy = gt.shape[2]
+        g = allel.GenotypeArray(gt)
+        n_alt = g.to_n_alt(fill=-1)
+        is_missing = ~g.is_called()
+        is_het = g.is_het()
+
+    missing = np.count_nonzero(is_missing, axis=1)
+    het = np.count_nonzero(is_het, axis=1)
+    called = num_samples - missing
+    sum_alt = np.sum(n_alt, axis=1, dtype=np.int64) + missing # missing calls are encoded as -1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sum_alt / called / ploidy
+        heterozygosity_freq = het / called
+
+    maf = np.where(means < 0.5, means, 1 - means)
+
+    result = {
+        'maf': np.nan_to_num(maf, nan=-1).astype(np.float32),
+        'missing_freq': (missing / num_samples).astype(np.float32),
+        'heterozygosity_freq': heterozygosity_freq.astype(np.float32),
+        'count_called': (gt.shape[0] - np.count_nonzero(is_missing, axis=0)).astype(np.int32),
+        'count_het': np.count_nonzero(is_het, axis=0).astype(np.int32)
+    }
+
+    if max_allele is not None:
+        if gt.ndim == 2:
+            allele_counts = np.stack([np.count_nonzero(gt == allele, axis=1) for allele in range(max_allele + 1)], axis=1)
+        else:
+            allele_counts = g.count_alleles(max_allele=max_allele)
+        result['allele_counts'] = np.asarray(allele_counts, dtype=np.int32)
+
+    return result
+
+
+
+def count_n_alt_values(n_alt: np.ndarray, ploidy: int, variants_axis: int = 0, tile_variants: int = 2048) -> np.ndarray:
+    """Counts how often each number of alternate alleles (-1 for missing calls up to the ploidy) occurs per variant
+
+    All counts are obtained in a single pass over the int8 matrix: it is processed in tiles of at most 255 samples,
+    which stay in the CPU cache while they are compared with every value and summed up in uint8 accumulators.
+    No wider copy of the matrix is made.
+
+    Args:
+        n_alt (numpy.ndarray): Numbers of alternate alleles, missing calls as -1
+        ploidy (int): Ploidy of the calls
+        variants_axis (int): Axis of the variants, 0 for (variants, samples) and 1 for (samples, variants)
+        tile_variants (int): Number of variants per tile
+
+    Returns:
+        numpy.ndarray: int64 array of shape (variants, ploidy + 2), column `k + 1` counts the calls with `k` alternate alleles
+    """
+
+    n_alt = np.asarray(n_alt)
+    if variants_axis == 0:
+        n_alt = n_alt.T
+
+    count_samples, count_variants = n_alt.shape
+    tile_samples = 255 # uint8 accumulators must not overflow
+    counts = np.zeros((count_variants, ploidy + 2), dtype=np.int64)
+
+    equal = np.empty((min(tile_samples, count_samples), min(tile_variants, count_variants)), dtype=np.bool_)
+    # tiles of a (variants, samples) matrix are transposed into a buffer first, strided comparisons are slow
+    transposed = np.empty(equal.shape, dtype=n_alt.dtype) if variants_axis == 0 else None
+    accumulator = np.empty(equal.shape[1], dtype=np.uint8)
+
+    for variants_start in range(0, count_variants, tile_variants):
+        variants = slice(variants_start, min(variants_start + tile_variants, count_variants))
+        width = variants.stop - variants.start
+
+        for samples_start in range(0, count_samples, tile_samples):
+            tile = n_alt[samples_start:samples_start + tile_samples, variants]
+            if transposed is not None:
+                buffer = transposed[:tile.shape[0], :width]
+                np.copyto(buffer, tile)
+                tile = buffer
+            tile_equal = equal[:tile.shape[0], :width]
+
+            for value in range(-1, ploidy + 1):
+                if value == 0:
+                    continue # derived from the other counts
+                np.equal(tile, value, out=tile_equal)
+                np.add.reduce(tile_equal.view(np.uint8), axis=0, out=accumulator[:width])
+                counts[variants, value + 1] += accumulator[:width]
+
+    counts[:, 1] = count_samples - counts.sum(axis=1)
+
+    return counts
+
+
+
+def calc_variants_stats_from_counts(counts: np.ndarray, ploidy: int) -> dict:
+    """Derives the per-variant summary statistics from the counts of `count_n_alt_values()`
+
+    Heterozygous calls are those with at least one but not all alleles being alternate alleles,
+    i.e. calls of two different alternate alleles are not counted as heterozygous.
+
+    Returns:
+        dict: float64 arrays `maf` (-1 if no sample is called), `missing_freq` and `heterozygosity_freq` (NaN if no sample is called),
+            int64 array `allele_counts` of shape (variants, 2) with the numbers of reference and alternate alleles
+    """
+
+    num_samples = counts.sum(axis=1)
+    missing = counts[:, 0]
+    called = num_samples - missing
+    sum_alt = counts[:, 1:] @ np.arange(ploidy + 1, dtype=np.int64)
+    het = counts[:, 2:ploidy + 1].sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sum_alt / called / ploidy
+        heterozygosity_freq = het / called
+        missing_freq = missing / num_samples
+
+    maf = np.where(means < 0.5, means, 1 - means)
+
+    return {
+        'maf': np.nan_to_num(maf, nan=-1),
+        'missing_freq': missing_freq,
+        'heterozygosity_freq': heterozygosity_freq,
+        'allele_counts': np.stack((called * ploidy - sum_alt, sum_alt), axis=1)
+    }
+
+
+
+def calc_variants_stats_from_n_alt(n_alt: np.ndarray, ploidy: int) -> dict:
+    """Calculates per-variant summary statistics from the numbers of alternate alleles of a block of calls
+
+    Heterozygous calls are those with at least one but not all alleles being alternate alleles,
+    i.e. calls of two different alternate alleles are not counted as heterozygous.
+
+    Args:
+        n_alt (numpy.ndarray): Numbers of alternate alleles of shape (variants, samples), missing calls as -1
+        ploidy (int): Ploidy of the calls
+
+    Returns:
+        dict: float32 arrays `maf`, `missing_freq` and `heterozygosity_freq` as returned by `calc_variants_stats()`
+    """
+
+    stats = calc_variants_stats_from_counts(count_n_alt_values(n_alt, ploidy, variants_axis=0), ploidy)
+
+    return {name: stats[name].astype(np.float32) for name in VARIANTS_STATS_ARRAYS}
+
+
+
+def get_active_variant_filters(variant_filter_settings: dict) -> dict:
+    """Returns the ranges of the variant filters that are switched on, keyed by their switch"""
+
+    if not variant_filter_settings:
+        return {}
+
+    return {
+        flag: variant_filter_settings.get(range_key, None)
+        for flag, range_key in VARIANT_FILTERS.items()
+        if variant_filter_settings.get(flag, False) == True
+    }
+
+
+
+def has_active_variant_filter(variant_filter_settings: dict) -> bool:
+    """Checks if any variant filter of the frontend's filter settings is switched on"""
+
+    return len(get_active_variant_filters(variant_filter_settings)) > 0
+
+
+
+def calc_variant_filter_mask(stats: dict, variant_filter_settings: dict) -> np.ndarray:
+    """Combines the active variant filters into one boolean mask over the variants
+
+    Every filter keeps the variants whose statistic lies within its range, bounds included. Variants with a NaN
+    value fail the filter. Filters of statistics missing in `stats` (e.g. `vcf_qual` without QUAL data) are skipped.
+
+    Args:
+        stats (dict): Per-variant statistics (`maf`, `missing_freq`, `heterozygosity_freq` and optionally `vcf_qual`)
+        variant_filter_settings (dict): Variant filter settings of the frontend
+
+    Returns:
+        numpy.ndarray: Boolean mask of the variants passing all filters, None if no filter applies
+    """
+
+    mask = None
+
+    for flag, value_range in get_active_variant_filters(variant_filter_settings).items():
+        values = stats.get(VARIANT_FILTERS_STATS[flag], None)
+        if values is None:
+            continue
+
+        values = np.asarray(values)
+        passed = values >= value_range[0]
+        passed &= values <= value_range[1]
+
+        if mask is None:
+            mask = passed
+        else:
+            mask &= passed
+
+    return mask
+
+
+
+def has_variants_stats(callset) -> bool:
+    """Checks if a Zarr archive contains complete precomputed per-variant statistics"""
+
+    if VARIANTS_STATS_GROUP not in callset:
+        return False
+
+    group = callset[VARIANTS_STATS_GROUP]
+    if group.attrs.get('complete', False) is not True:
+        return False
+
+    count_variants = callset['variants/POS'].shape[0]
+    return all(name in group and group[name].shape[0] == count_variants for name in VARIANTS_STATS_ARRAYS)
+
+
+
+def _get_max_allele(callset) -> int:
+    alt = callset['variants/ALT']
+    return int(alt.shape[1]) if alt.ndim == 2 else 1
+
+
+
+def _prepare_stats_arrays(callset, overwrite: bool) -> np.ndarray:
+    """Creates the result arrays if necessary and returns the boolean array of already processed chunks"""
+
+    calldata = callset['calldata/GT']
+    count_variants, count_samples = calldata.shape[0], calldata.shape[1]
+    chunk_size = calldata.chunks[0]
+    count_chunks = -(-count_variants // chunk_size)
+    max_allele = _get_max_allele(callset)
+
+    variants_group = callset.require_group(VARIANTS_STATS_GROUP)
+    samples_group = callset.require_group(SAMPLES_STATS_GROUP)
+
+    resumable = (
+        not overwrite
+        and variants_group.attrs.get('chunk_size', None) == chunk_size
+        and variants_group.attrs.get('count_variants', None) == count_variants
+        and 'chunks_done' in variants_group
+        and all(name in samples_group for name in SAMPLES_STATS_PARTIAL_ARRAYS)
+    )
+
+    if resumable:
+        return variants_group['chunks_done'][:]
+
+    variants_group.attrs.update({'complete': False, 'chunk_size': chunk_size, 'count_variants': count_variants})
+    samples_group.attrs['complete'] = False
+
+    for name in VARIANTS_STATS_ARRAYS:
+        variants_group.create_dataset(name, shape=(count_variants,), chunks=(chunk_size,), dtype=np.float32, fill_value=np.nan, overwrite=True)
+
+    variants_group.create_dataset('allele_counts', shape=(count_variants, max_allele + 1), chunks=(chunk_size, max_allele + 1), dtype=np.int32, fill_value=0, overwrite=True)
+    variants_group.create_dataset('chunks_done', shape=(count_chunks,), chunks=(count_chunks,), dtype=bool, fill_value=False, overwrite=True)
+
+    for name in SAMPLES_STATS_PARTIAL_ARRAYS:
+        samples_group.create_dataset(name, shape=(count_chunks, count_samples), chunks=(1, count_samples), dtype=np.int32, fill_value=0, overwrite=True)
+
+    return np.zeros(count_chunks, dtype=bool)
+
+
+
+def _process_chunk(path_zarr: str, chunk_index: int) -> int:
+    """Calculates and saves the statistics of one chunk of `calldata/GT`, runs in a worker process"""
+
+    numcodecs.blosc.use_threads = False
+
+    callset = zarr.open_group(path_zarr, mode='r+')
+    calldata = callset['calldata/GT']
+    chunk_size = calldata.chunks[0]
+    chunk_start = chunk_index * chunk_size
+    chunk_end = min(chunk_start + chunk_size, calldata.shape[0])
+
+    stats = calc_variants_stats(calldata[chunk_start:chunk_end], max_allele=_get_max_allele(callset))
+
+    variants_group = callset[VARIANTS_STATS_GROUP]
+    for name in VARIANTS_STATS_ARRAYS + ['allele_counts']:
+        variants_group[name][chunk_start:chunk_end] = stats[name]
+
+    samples_group = callset[SAMPLES_STATS_GROUP]
+    samples_group['partial_count_called'][chunk_index] = stats['count_called']
+    samples_group['partial_count_het'][chunk_index] = stats['count_het']
+
+    return chunk_index
+
+
+
+def _reduce_samples_stats(callset):
+    """Sums up the per-chunk counts of each sample and saves call rate and heterozygosity per sample"""
+
+    samples_group = callset[SAMPLES_STATS_GROUP]
+    count_variants = callset['calldata/GT'].shape[0]
+    partial_count_called = samples_group['partial_count_called']
+    partial_count_het = samples_group['partial_count_het']
+
+    count_called = np.zeros(partial_count_called.shape[1], dtype=np.int64)
+    count_het = np.zeros(partial_count_het.shape[1], dtype=np.int64)
+
+    block_size = 256
+    for block_start in range(0, partial_count_called.shape[0], block_size):
+        count_called += partial_count_called[block_start:block_start + block_size].sum(axis=0, dtype=np.int64)
+        count_het += partial_count_het[block_start:block_start + block_size].sum(axis=0, dtype=np.int64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        heterozygosity_freq = count_het / count_called
+
+    samples_group.array('count_called', count_called, overwrite=True)
+    samples_group.array('count_het', count_het, overwrite=True)
+    samples_group.array('call_rate', (count_called / max(count_variants, 1)).astype(np.float32), overwrite=True)
+    samples_group.array('heterozygosity_freq', heterozygosity_freq.astype(np.float32), overwrite=True)
+    samples_group.attrs['complete'] = True
+
+
+
+def write_variants_stats(path_zarr: str, workers: int = None, overwrite: bool = False, progress=None):
+    """Calculates per-variant and per-sample summary statistics over all samples and saves them in the Zarr archive
+
+    The genotype matrix is processed chunk by chunk along the variants axis by a pool of worker processes, so it is never
+    loaded completely into memory. Per-variant results are written to `variants_stats/<statistic>` with the same variant
+    chunking as `calldata/GT`, per-sample results to `samples_stats/<statistic>`. Processed chunks are recorded in
+    `variants_stats/chunks_done`, so an interrupted run continues where it stopped.
+
+    Args:
+        path_zarr (str): Path of the Zarr archive
+        workers (int): Number of worker processes, defaults to the number of CPUs
+        overwrite (bool): Discard already calculated results and start from scratch
+        progress (callable): Optional callback receiving (number of processed chunks, number of all chunks)
+    """
+
+    callset = zarr.open_group(path_zarr, mode='r+')
+    chunks_done = _prepare_stats_arrays(callset, overwrite)
+    variants_group = callset[VARIANTS_STATS_GROUP]
+
+    count_chunks = chunks_done.shape[0]
+    chunks_todo = np.flatnonzero(~chunks_done).tolist()
+
+    if progress is not None:
+        progress(count_chunks - len(chunks_todo), count_chunks)
+
+    if chunks_todo:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            futures = [executor.submit(_process_chunk, path_zarr, chunk_index) for chunk_index in chunks_todo]
+            for future in as_completed(futures):
+                chunks_done[future.result()] = True
+                variants_group['chunks_done'][:] = chunks_done
+
+                if progress is not None:
+                    progress(int(np.count_nonzero(chunks_done)), count_chunks)
+
+    _reduce_samples_stats(callset)
+    variants_group.attrs['complete'] = True
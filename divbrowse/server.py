@@ -3,20 +3,26 @@ __version__ = '0.1.0'
 import json
 from timeit import default_timer as timer
 
-from flask import Flask, Response, jsonify, request
+from flask import Flask, Response, jsonify, request, send_file
 
-import allel
 import numpy as np
-import pandas as pd
 from bioblend.galaxy import GalaxyInstance
 from bioblend.galaxy.tools.inputs import inputs
+import orjson
 from sklearn.metrics import pairwise_distances
 import yaml
 
 from divbrowse import log
 from divbrowse.lib.annotation_data import AnnotationData
 from divbrowse.lib.genotype_data import GenotypeData
-from divbrowse.lib.analysis import Analysis
+from divbrowse.lib.analysis import Analysis, calc_umap, streaming_pca
+from divbrowse.lib.cache import ResultCache, canonical_hash
+from divbrowse.lib.clustering import LINKAGE_METHODS, calc_clustering_payload, calc_linkage
+from divbrowse.lib.compute import ComputeExecutor
+from divbrowse.lib.distances import MISSING_CALLS_HANDLING
+from divbrowse.lib.export import create_nucleotides_lookup_table, generate_nucleotide_rows, generate_vcf_records, get_vcf_header_lines, gzip_stream
+from divbrowse.lib.export_jobs import EXPORT_FORMATS, ExportJobs
+from divbrowse.lib.variants_stats import get_active_variant_filters, has_active_variant_filter
 
 from divbrowse.lib.utils import ApiError
 from divbrowse.lib.utils import ORJSONEncoder
@@ -56,6 +62,40 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
     ad = AnnotationData(config, gd)
 
     
+    export_max_variants = int(config.get('export', {}).get('max_variants', 100000))
+
+    # regions whose PCA would need more memory are analyzed block by block with streaming_pca()
+    max_in_memory_pca = int(config.get('analysis', {}).get('max_in_memory_pca_mb', 1024) * 1024 * 1024)
+    streaming_pca_iterations = int(config.get('analysis', {}).get('streaming_pca_iterations', 4))
+
+    result_cache = ResultCache(
+        max_memory_bytes = int(config.get('cache', {}).get('result_cache_size_mb', 256) * 1024 * 1024),
+        disk_dir = config.get('cache', {}).get('result_cache_dir', None),
+        max_disk_bytes = int(config.get('cache', {}).get('result_cache_disk_size_mb', 2048) * 1024 * 1024)
+    )
+
+    # results of the disk tier must not be reused for another variant matrix or after derived arrays have been added
+    dataset_fingerprint = canonical_hash({
+        'version': __version__,
+        'zarr_dir': config['datadir'] + config['variants']['zarr_dir'],
+        'count_variants': gd.count_variants,
+        'count_samples': gd.count_samples,
+        'available': gd.available
+    })
+
+    # shared by all requests, so that concurrent distance calculations do not oversubscribe the CPUs
+    compute_executor = ComputeExecutor(max_workers = config.get('analysis', {}).get('compute_workers', None) or None)
+
+    clustermap_max_size = int(config.get('analysis', {}).get('clustermap_max_size', 1024))
+    viridis_palette = np.rint(np.array(sns.color_palette('viridis', 256)) * 255).astype(np.uint8)
+
+    export_jobs = ExportJobs(
+        gd,
+        jobs_dir = config.get('export', {}).get('jobs_dir', None) or config['datadir'] + '____export_jobs____',
+        max_workers = int(config.get('export', {}).get('jobs_workers', 2)),
+        max_age_hours = float(config.get('export', {}).get('jobs_max_age_hours', 24))
+    )
+
     brapi_active = config.get('brapi', {}).get('active', False)
     if brapi_active:
         from divbrowse.brapi.v2.blueprint import get_brapi_blueprint
@@ -114,6 +154,24 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
             raise ApiError('Some input data is missing.')
 
 
+    def get_analysis_cache_key(method, input, params = None):
+        """Returns the result cache key of an analysis of the resolved variant range, the set of samples and the active variant filters"""
+
+        location_start, _ = gd.get_posidx_by_genome_coordinate(input['chrom'], input['startpos'])
+        location_end, _ = gd.get_posidx_by_genome_coordinate(input['chrom'], input['endpos'])
+        samples = input['samples'] if input.get('samples', None) is not None else gd.samples
+
+        return canonical_hash({
+            'dataset': dataset_fingerprint,
+            'method': method,
+            'chrom': str(input['chrom']),
+            'location': [int(location_start), int(location_end)],
+            'samples': sorted(map(str, samples)),
+            'variant_filters': get_active_variant_filters(input['variant_filter_settings']),
+            'params': params or {}
+        })
+
+
 
 
     @app.route("/genomic_window_summary", methods = ['GET', 'POST', 'OPTIONS'])
@@ -131,7 +189,8 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
             positions = input['positions'],
             samples = input['samples'],
             variant_filter_settings = input['variant_filter_settings'],
-            calc_summary_stats = True
+            calc_summary_stats = True,
+            with_genotypes = False
         )
 
         result = variant_calls_slice.get_stats_dict()
@@ -140,6 +199,36 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
 
 
 
+    @app.route("/density_tracks", methods = ['GET', 'POST', 'OPTIONS'])
+    def __density_tracks():
+
+        payload = request.get_json(silent=True)
+
+        if request.method == 'POST':
+            input = process_request_vars(payload)
+        else:
+            return 'ERROR'
+
+        if not gd.available['density_tracks']:
+            raise ApiError('No density tracks available. Please create them via `divbrowse calcdensitytracks`.')
+
+        if input['chrom'] not in gd.list_chrom:
+            raise ApiError('The provided chromosome number '+str(input['chrom'])+' is not included in the variant matrix.')
+
+        if input['startpos'] is None or input['endpos'] is None:
+            raise ApiError('Please provide startpos and endpos of the region.')
+
+        resolution = payload.get('resolution', None)
+
+        try:
+            result = gd.density_tracks.get_bins(input['chrom'], input['startpos'], input['endpos'], int(resolution) if resolution else None)
+        except ValueError as error_msg:
+            raise ApiError(str(error_msg))
+
+        return jsonify(result)
+
+
+
     @app.route("/pca", methods = ['GET', 'POST', 'OPTIONS'])
     def __pca():
 
@@ -153,6 +242,85 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
         umap_n_neighbors = int(payload['umap_n_neighbors'])
         methods = payload['methods']
 
+        pca_cache_key = get_analysis_cache_key('pca', input)
+        umap_cache_key = get_analysis_cache_key('umap', input, {'n_neighbors': umap_n_neighbors})
+
+        cached_pca = result_cache.get(pca_cache_key)
+        cached_umap = result_cache.get(umap_cache_key) if 'umap' in methods else None
+        if cached_pca is not None and ('umap' not in methods or cached_umap is not None):
+            result = orjson.loads(cached_pca)
+            result['umap_result'] = orjson.loads(cached_umap) if cached_umap is not None else None
+            return jsonify(result)
+
+        result = calc_pca_and_umap(input, methods, umap_n_neighbors)
+
+        result_cache.set(pca_cache_key, orjson.dumps({key: value for key, value in result.items() if key != 'umap_result'}))
+        if result['umap_result'] is not None:
+            result_cache.set(umap_cache_key, orjson.dumps(result['umap_result']))
+
+        return jsonify(result)
+
+
+    no_variants_for_pca_message = 'There are no variants in the selected region that pass the variant filters, a PCA is not possible.'
+
+    def calc_pca_and_umap(input, methods, umap_n_neighbors):
+
+        samples = input['samples'] if input.get('samples', None) is not None else gd.samples
+        count_variants = gd.count_variants_in_window(input['chrom'], input['startpos'], input['endpos'])
+
+        # whole chromosomes without variant filters are answered from the embeddings precomputed via `divbrowse calcembeddings`
+        embedding = None
+        if gd.embeddings is not None and input['chrom'] in gd.list_chrom and not has_active_variant_filter(input['variant_filter_settings']):
+            chrom_start, chrom_stop = gd.position_index.chrom_range(input['chrom'])
+            if count_variants == chrom_stop - chrom_start:
+                samples_mask, samples_selected_mapped = gd.get_samples_mask(samples)
+                embedding = gd.embeddings.get(input['chrom'], samples_mask)
+
+        if embedding is not None:
+            sample_ids = np.array(samples_selected_mapped).reshape((-1, 1))
+
+            umap_result = None
+            if 'umap' in methods:
+                if embedding['umap'] is not None and embedding['umap_n_neighbors'] == umap_n_neighbors:
+                    umap_coordinates = embedding['umap']
+                else:
+                    umap_coordinates = calc_umap(embedding['pca'], n_neighbors = umap_n_neighbors)
+                umap_result = np.concatenate((sample_ids, umap_coordinates), axis=1).tolist()
+
+            return {
+                'pca_result': np.concatenate((sample_ids, embedding['pca']), axis=1).tolist(),
+                'pca_explained_variance': embedding['explained_variance_ratio'].tolist(),
+                'umap_result': umap_result,
+                'precomputed': True
+            }
+
+        # int8 calls and missing mask, float32 imputed, scaled and centered copies
+        if count_variants * len(samples) * 14 > max_in_memory_pca:
+            streaming_pca_result = streaming_pca(
+                gd,
+                chrom = input['chrom'],
+                startpos = input['startpos'],
+                endpos = input['endpos'],
+                samples = samples,
+                variant_filter_settings = input['variant_filter_settings'],
+                n_iter = streaming_pca_iterations
+            )
+            if streaming_pca_result is False:
+                raise ApiError(no_variants_for_pca_message)
+
+            pca_result, pca_explained_variance = streaming_pca_result
+
+            umap_result = None
+            if 'umap' in methods:
+                # the variant matrix is not held in memory, UMAP is calculated on the principal components instead
+                umap_result = calc_umap(pca_result[:, 1:].astype(np.float32), pca_result[:, 0].tolist(), n_neighbors = umap_n_neighbors).tolist()
+
+            return {
+                'pca_result': pca_result.tolist(),
+                'pca_explained_variance': pca_explained_variance.tolist(),
+                'umap_result': umap_result,
+            }
+
         variant_calls_slice = gd.get_slice_of_variant_calls(
             chrom = input['chrom'],
             startpos = input['startpos'],
@@ -162,7 +330,10 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
             calc_summary_stats = True
         )
 
-        analysis = Analysis(variant_calls_slice)
+        if variant_calls_slice.filtered_positions_indices.shape[0] == 0:
+            raise ApiError(no_variants_for_pca_message)
+
+        analysis = Analysis(variant_calls_slice, executor = compute_executor)
 
         pca_result, pca_explained_variance = analysis.pca()
 
@@ -170,14 +341,12 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
         if 'umap' in methods:
             umap_result = analysis.umap(n_neighbors = umap_n_neighbors).tolist()
 
-        result = {
+        return {
             'pca_result': pca_result.tolist(),
             'pca_explained_variance': pca_explained_variance.tolist(),
             'umap_result': umap_result,
         }
 
-        return jsonify(result)
-
 
     @app.route("/clustermap", methods = ['GET', 'POST', 'OPTIONS'])
     def __clustermap():
@@ -188,7 +357,30 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
         else:
             return 'ERROR'
 
-        fontscale = float(payload['fontscale'])
+        # `heatmap` returns the clustering and a quantized distance matrix for client-side rendering, `png` a rendered seaborn clustermap
+        render = payload.get('render', 'png')
+        if render not in ['heatmap', 'png']:
+            raise ApiError('Unknown value for render: '+str(render)+', use heatmap or png')
+
+        linkage_method = payload.get('linkage_method', 'average')
+        if linkage_method not in LINKAGE_METHODS:
+            raise ApiError('Unknown linkage method '+str(linkage_method)+', available methods are: '+', '.join(LINKAGE_METHODS))
+
+        if render == 'heatmap':
+            try:
+                max_size = int(payload.get('max_size', clustermap_max_size))
+            except (TypeError, ValueError):
+                max_size = 0
+            if max_size < 1:
+                raise ApiError('Invalid value for max_size: '+str(payload.get('max_size'))+', use a positive integer')
+            params = {'render': render, 'linkage_method': linkage_method, 'max_size': min(max_size, clustermap_max_size)}
+        else:
+            params = {'render': render, 'linkage_method': linkage_method, 'fontscale': float(payload['fontscale'])}
+
+        cache_key = get_analysis_cache_key('clustermap', input, params)
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            return Response(cached, mimetype='application/json')
 
         variant_calls_slice = gd.get_slice_of_variant_calls(
             chrom = input['chrom'],
@@ -199,22 +391,38 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
             calc_summary_stats = True
         )
 
-        analysis = Analysis(variant_calls_slice)
+        analysis = Analysis(variant_calls_slice, executor = compute_executor)
         distances = analysis.calc_distance_matrix(samples = gd.samples)
 
-        sns.set(font_scale=fontscale)
+        if render == 'heatmap':
+            start = timer()
+            result = orjson.dumps(calc_clustering_payload(
+                distances,
+                sample_ids = variant_calls_slice.samples_selected_mapped,
+                method = linkage_method,
+                max_size = params['max_size'],
+                palette = viridis_palette
+            ))
+            log.debug("==== calc_clustering_payload() calculation time: %f", timer() - start)
+            result_cache.set(cache_key, result)
+            return Response(result, mimetype='application/json')
+
+        sns.set(font_scale=params['fontscale'])
         cmap = sns.color_palette('viridis', as_cmap=True)
 
-        clustergrid = sns.clustermap(distances, figsize=(20, 20), cmap = cmap, xticklabels=False, yticklabels=False)
+        # the same linkage for rows and columns, seaborn would otherwise cluster the rows of the distance matrix twice
+        linkage = calc_linkage(distances, method=linkage_method) if distances.shape[0] > 1 else None
+        clustergrid = sns.clustermap(distances, figsize=(20, 20), cmap = cmap, xticklabels=False, yticklabels=False, row_linkage=linkage, col_linkage=linkage)
         buffer = BytesIO()
         clustergrid.savefig(buffer, format='png')
         data = base64.b64encode(buffer.getbuffer()).decode('ascii')
 
-        result = {
+        result = orjson.dumps({
             'clustermap': data
-        }
+        })
+        result_cache.set(cache_key, result)
 
-        return jsonify(result)
+        return Response(result, mimetype='application/json')
 
 
     @app.route("/variant_calls", methods = ['GET', 'POST', 'OPTIONS'])
@@ -269,11 +477,17 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
         start_all = timer()
 
         if request.method == 'POST':
-            input = process_request_vars(request.get_json(silent=True))
+            payload = request.get_json(silent=True)
+            input = process_request_vars(payload)
         else:
             #raise ApiError('Method not allowed', status_code=405)
             return ''
 
+        # handling of missing calls for the distances to the reference: impute, ignore or count
+        distance_missing_handling = payload.get('distance_missing_handling', 'impute')
+        if distance_missing_handling not in MISSING_CALLS_HANDLING:
+            raise ApiError('Unknown value for distance_missing_handling: '+str(distance_missing_handling)+', use one of: '+', '.join(MISSING_CALLS_HANDLING))
+
         if input['chrom'] not in gd.list_chrom:
             return jsonify({
                 'success': False, 
@@ -296,8 +510,8 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
         log.debug("==== gd.get_slice_of_variant_calls() => calculation time: %f", timer() - start)
 
         start = timer()
-        analysis = Analysis(slice)
-        distances = analysis.calc_distance_to_reference(samples = gd.samples)
+        analysis = Analysis(slice, executor = compute_executor)
+        distances = analysis.calc_distance_to_reference(samples = gd.samples, missing = distance_missing_handling)
         log.debug("==== Analysis() + analysis.calc_distance_to_reference() => calculation time: %f", timer() - start)
 
         # Get the reference nucleotides (as letters ATCG)
@@ -324,13 +538,13 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
 
 
         #### QUAL #########################
-        if 'QUAL' in gd.available_variants_metadata:
-            sliced_qual = gd.variants_qual.get_basic_selection(slice.slice_variant_calls)
-            slice.variants_summary_stats['vcf_qual'] = sliced_qual.tolist()
+        if 'QUAL' in gd.available_variants_metadata and 'vcf_qual' not in slice.variants_summary_stats:
+            slice.variants_summary_stats['vcf_qual'] = gd.variants_qual.get_basic_selection(slice.slice_variant_calls)
 
 
 
-        result['per_variant_stats'] = slice.variants_summary_stats
+        # the statistics are kept as arrays up to here
+        result['per_variant_stats'] = {key: values.tolist() if isinstance(values, np.ndarray) else values for key, values in slice.variants_summary_stats.items()}
 
         #### SNPEFF #######################
         if gd.available['snpeff']:
@@ -355,11 +569,7 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
             curr_end = int(gd.pos[slice.location_end - 1])
 
             start = timer()
-            genes_within_slice = ad.genes.loc[ ( ad.genes['start'] <= curr_start) & (ad.genes['end'] >= curr_end ) ]
-            genes_starting_in_slice = ad.genes.loc[ ( ad.genes['start'] >= curr_start) & (ad.genes['start'] <= curr_end ) ]
-            genes_ending_in_slice = ad.genes.loc[ ( ad.genes['end'] >= curr_start) & (ad.genes['end'] <= curr_end ) ]
-            genes_all_in_slice = pd.concat([genes_within_slice, genes_starting_in_slice, genes_ending_in_slice]).drop_duplicates().reset_index(drop=True)
-            genes_all_in_slice = genes_all_in_slice.loc[ (genes_all_in_slice['seqid'] == ad.chrom_gff3_map[input['chrom']]) ]
+            genes_all_in_slice = ad.get_features_in_region(input['chrom'], curr_start, curr_end)
             result['features'] = genes_all_in_slice.to_dict(orient='records')
 
             #### Nearest gene ##############################
@@ -400,14 +610,15 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
             count = input['count'],
             samples = input['samples'],
             variant_filter_settings = input['variant_filter_settings'],
-            calc_summary_stats = True
+            calc_summary_stats = True,
+            with_genotypes = False
         )
 
-        if slice.number_of_variants_in_window_filtered > 5000:
+        if slice.number_of_variants_in_window_filtered > export_max_variants:
             return jsonify({
                 'success': False, 
                 'status': 'error_snp_window_too_big', 
-                'message': 'The requested genomic window size is bigger than 5000 variants and is therefore too big. Please decrease the window size to not exceed 5000 variants.'
+                'message': 'The requested genomic window size is bigger than '+str(export_max_variants)+' variants and is therefore too big. Please decrease the window size to not exceed '+str(export_max_variants)+' variants.'
             })
 
         return jsonify({
@@ -440,99 +651,23 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
             positions = input['positions'],
             samples = input['samples'],
             variant_filter_settings = input['variant_filter_settings'],
-            calc_summary_stats = True
+            calc_summary_stats = True,
+            with_genotypes = False
         )
 
-        vcf_lines_header = gd.get_vcf_header()
-        if vcf_lines_header == None:
-            # No VCF header files available: fallback to minimal VCF header
-            vcf_lines_header = [
-                '##fileformat=VCFv4.3',
-                #'##fileDate=20190225',
-                #'##source=SeqArray_Format_v1.0',
-                #'##reference=Morex v2',
-                '##FILTER=<ID=PASS,Description="All filters passed">',
-                '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
-                #'##FORMAT=<ID=DP,Number=.,Type=Integer,Description="Read depth">',
-                #'##FORMAT=<ID=DV,Number=.,Type=Integer,Description="Read depth of the alternative allele">'
-            ]
-
-            if 'DP' in gd.available_calldata:
-                vcf_lines_header.append('##FORMAT=<ID=DP,Number=.,Type=Integer,Description="Read depth">')
-
-        vcf_columns = {
-            'FORMAT': ['GT']
-        }
-
-        # check for DP values and add to FORMAT column
-        if 'DP' in gd.available_calldata:
-            vcf_columns['FORMAT'].append('DP')
-
-        mapped_sample_ids, _ = gd.map_vcf_sample_ids_to_input_sample_ids(gd.samples[slice.samples_mask].astype(str).tolist())
-        vcf_line_variants_header = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + mapped_sample_ids
-        vcf_lines_header.append("\t".join(vcf_line_variants_header))
-
-        ref = gd.reference_allele.get_orthogonal_selection( (slice.filtered_positions_indices) )
-        alts = gd.alternate_alleles.get_orthogonal_selection( (slice.filtered_positions_indices) )
-        qual = gd.callset['variants/QUAL'].get_orthogonal_selection( (slice.filtered_positions_indices) )
-        #mq = callset['variants/MQ'].get_orthogonal_selection( (slice.filtered_positions_indices) )
-
-
-
-
+        vcf_lines_header = get_vcf_header_lines(gd, slice.samples_mask)
 
         def __generate():
             
             yield "\n".join(vcf_lines_header) + "\n"
 
-            i = 0
-            for pos_idx in slice.filtered_positions_indices.tolist():
-
-                vcf_line = [
-                    str(input['chrom']),
-                    str(gd.pos[pos_idx]),
-                    '.',
-                    str(ref[i]),
-                    ','.join([ _alt for _alt in (alts[i].astype(str).tolist()) if _alt != '' ]), #','.join([ _alt for _alt in (alts[i].astype(str).tolist()) if _alt != '' ]),
-                    str(qual[i]),
-                    'NA',
-                    '', #'MQ='+str(mq[i]),
-                    ":".join(vcf_columns['FORMAT'])
-                ]
-
-                if 'samples' in input:
-                    #gt_slice = gd.callset['calldata/GT'].get_orthogonal_selection( ([pos_idx], samples_mask, slice(None)) )
-                    gt_slice = gd.callset['calldata/GT'].get_orthogonal_selection( ([pos_idx], slice.samples_mask) )
-
-                    if 'DP' in vcf_columns['FORMAT']:
-                        dp_slice = gd.callset['calldata/DP'].get_orthogonal_selection( ([pos_idx], slice.samples_mask) )
-
-                else:
-                    gt_slice = gd.callset['calldata/GT'].get_orthogonal_selection( ([pos_idx], slice(None), slice(None)) )
-
-
-                # haploid
-                if gt_slice.ndim == 2:
-                    ga = allel.HaplotypeArray(gt_slice)
-                    gt = ga.to_genotypes(1, copy=True).to_gt()
-
-                # diploid
-                if gt_slice.ndim == 3:
-                    # Transform each genotype call into the number of non-reference alleles
-                    ga = allel.GenotypeArray(gt_slice)
-                    gt = ga.to_gt()
-
-                gt = gt[0].astype(str).tolist()
-                
-                if 'DP' in vcf_columns['FORMAT']:
-                    dp = dp_slice[0].astype(str).tolist()
-                    combined = [call+":"+str(dp[i]) for i, call in enumerate(gt)]
-                    gt = combined
-                
-                vcf_line = vcf_line + gt
-
-                yield "\t".join(vcf_line)+"\n"
-                i = i + 1
+            yield from generate_vcf_records(
+                gd,
+                chrom = input['chrom'],
+                variants_indices = slice.filtered_positions_indices,
+                samples_mask = slice.samples_mask,
+                with_dp = 'DP' in gd.available_calldata
+            )
 
         return Response(__generate(), mimetype='text/csv', headers={"Content-Disposition":"attachment; filename=custom_export.vcf"})
 
@@ -574,7 +709,7 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
         _chrom = gd.chromosome_labels[str(input['chrom'])]
         csv_line_chroms = ['CHROM'] + [_chrom] * slice.filtered_positions_indices.shape[0]
 
-        _positions = [str(gd.pos[pos_idx]) for pos_idx in slice.filtered_positions_indices.tolist()]
+        _positions = gd.pos[slice.filtered_positions_indices].astype(str).tolist()
         csv_line_positions = ['POS'] + _positions
         csv_line_refs = ['REF'] + ref.astype(str).tolist()
 
@@ -583,54 +718,77 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
         csv_lines.append("\t".join(csv_line_positions))
         csv_lines.append("\t".join(csv_line_refs))
 
-        nucleotides_ambiguity = {
-            ('A', 'G'): 'R',
-            ('G', 'A'): 'R',
-            ('C', 'T'): 'Y',
-            ('T', 'C'): 'Y',
-            ('G', 'C'): 'S',
-            ('C', 'G'): 'S',
-            ('C', 'T'): 'Y',
-            ('T', 'C'): 'Y',
-            ('A', 'T'): 'W',
-            ('T', 'A'): 'W',
-            ('G', 'T'): 'K',
-            ('T', 'G'): 'K',
-            ('A', 'C'): 'M',
-            ('C', 'A'): 'M',
-        }
-
-        def get_nucleotide(num_of_alternate_alleles, i):
-            nuc = ''
-            if num_of_alternate_alleles == '0':
-                nuc = str(ref[i])
-            elif num_of_alternate_alleles == '1':
-                nuc = nucleotides_ambiguity[ (str(ref[i]), str(alts[i][0])) ]
-            elif num_of_alternate_alleles == '2':
-                nuc = str(alts[i][0])
-            else:
-                nuc = '.'
-            
-            return nuc
-
+        nucleotides_lookup_table = create_nucleotides_lookup_table(ref, alts)
 
         def __generate():
             
-            yield "\n".join(csv_lines) + "\n"
+            yield ("\n".join(csv_lines) + "\n").encode('utf-8')
 
-            i = 0
-            for sample_id in mapped_sample_ids:
-                calls_for_sample = slice.numbers_of_alternate_alleles[i].astype(str).tolist()
-                nucleotides_for_sample = [get_nucleotide(num_alt, i) for i, num_alt in enumerate(calls_for_sample)]
-                csv_line = [str(sample_id)] + nucleotides_for_sample
-                yield "\t".join(csv_line)+"\n"
-                i = i + 1
+            yield from generate_nucleotide_rows(slice.numbers_of_alternate_alleles, nucleotides_lookup_table, mapped_sample_ids)
+
+        if request.form.get('compression', None) == 'gzip':
+            return Response(gzip_stream(__generate()), mimetype='application/gzip', headers={"Content-Disposition":"attachment; filename=custom_export.csv.gz"})
 
         return Response(__generate(), mimetype='text/csv', headers={"Content-Disposition":"attachment; filename=custom_export.csv"})
 
 
 
 
+    @app.route("/export_jobs", methods = ['GET', 'POST', 'OPTIONS'])
+    def __export_jobs_submit():
+
+        if request.method == 'POST':
+            payload = request.get_json(silent=True)
+            input = process_request_vars(payload)
+        else:
+            return ''
+
+        if input['chrom'] not in gd.list_chrom:
+            raise ApiError('The provided chromosome number '+str(input['chrom'])+' is not included in the variant matrix.')
+
+        format = str(payload.get('format', 'vcf'))
+        if format not in EXPORT_FORMATS:
+            raise ApiError('Unknown export format '+format+', available formats are: '+', '.join(EXPORT_FORMATS.keys()))
+
+        job = export_jobs.submit(format, input)
+
+        return jsonify({
+            'success': True,
+            'job': job.to_dict()
+        })
+
+
+
+    @app.route("/export_jobs/<job_id>", methods = ['GET', 'OPTIONS'])
+    def __export_jobs_status(job_id):
+
+        job = export_jobs.get(job_id)
+        if job is None:
+            raise ApiError('The export job '+str(job_id)+' does not exist or has expired.', status_code=404)
+
+        return jsonify({
+            'success': True,
+            'job': job.to_dict()
+        })
+
+
+
+    @app.route("/export_jobs/<job_id>/download", methods = ['GET', 'OPTIONS'])
+    def __export_jobs_download(job_id):
+
+        job = export_jobs.get(job_id)
+        if job is None:
+            raise ApiError('The export job '+str(job_id)+' does not exist or has expired.', status_code=404)
+
+        if job.status != 'finished':
+            raise ApiError('The export job '+str(job_id)+' is not finished yet.', status_code=409)
+
+        # conditional responses answer HTTP Range requests, so interrupted downloads can be resumed
+        return send_file(export_jobs.get_path(job), mimetype=job.mimetype, as_attachment=True, download_name=job.filename, conditional=True)
+
+
+
+
     @app.route("/gff3_export", methods = ['GET', 'POST', 'OPTIONS'])
     def __gff3_export():
 
@@ -650,13 +808,7 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
         curr_start = input['startpos']
         curr_end = input['endpos']
 
-        genes_within_slice = ad.genes.loc[ ( ad.genes['start'] <= curr_start) & (ad.genes['end'] >= curr_end ) ]
-        genes_starting_in_slice = ad.genes.loc[ ( ad.genes['start'] >= curr_start) & (ad.genes['start'] <= curr_end ) ]
-        genes_ending_in_slice = ad.genes.loc[ ( ad.genes['end'] >= curr_start) & (ad.genes['end'] <= curr_end ) ]
-        genes_all_in_slice = pd.concat([genes_within_slice, genes_starting_in_slice, genes_ending_in_slice]).drop_duplicates().reset_index(drop=True)
-        genes_all_in_slice = genes_all_in_slice.loc[ (genes_all_in_slice['seqid'] == ad.chrom_gff3_map[input['chrom']]) ]
-
-        genes_all_in_slice = genes_all_in_slice.sort_values('start')
+        genes_all_in_slice = ad.get_features_in_region(input['chrom'], curr_start, curr_end)
         
         '''
         key_confidence = 'primary_confidence_class'
@@ -783,10 +935,17 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
                     'start_of_alignment_in_subject': line_parts[8],
                     'end_of_alignment_in_subject': line_parts[9],
                     'e_value': line_parts[10],
-                    'bit_score': line_parts[11],
-                    'snp_count': gd.count_variants_in_window(_chromosome_vcf, int(line_parts[8]), int(line_parts[9]))
+                    'bit_score': line_parts[11]
                 }
                 blast_result_json.append(_single_blast_hit)
+
+        snp_counts = gd.count_variants_in_windows(
+            [hit['chromosome'] for hit in blast_result_json],
+            [int(hit['start_of_alignment_in_subject']) for hit in blast_result_json],
+            [int(hit['end_of_alignment_in_subject']) for hit in blast_result_json]
+        )
+        for hit, snp_count in zip(blast_result_json, snp_counts.tolist()):
+            hit['snp_count'] = snp_count
         
         return jsonify({
             'success': True,
@@ -841,6 +1000,20 @@ def create_app(filename_config_yaml = 'divbrowse.config.yml', config_runtime=Non
         
 
 
+    @app.route("/server_stats", methods = ['GET', 'POST', 'OPTIONS'])
+    def __server_stats():
+
+        result = {
+            'chunk_cache': gd.chunk_cache.stats() if gd.chunk_cache is not None else None,
+            'summary_stats_cache': gd.summary_stats_cache.stats(),
+            'result_cache': result_cache.stats(),
+            'compute_executor': compute_executor.stats()
+        }
+
+        return jsonify(result)
+
+
+
     @app.route("/", methods = ['GET', 'POST', 'OPTIONS'])
     def __home():
         return 'Divbrowse server is running'
@@ -314,6 +314,10 @@ export default class Controller {
             fontscale: params['fontscale']
         };
 
+        if (params['render'] !== undefined) {
+            payload['render'] = params['render'];
+        }
+
         if (params['variantFilterSettings'] !== undefined && typeof params['variantFilterSettings'] === 'object') {
             payload['variant_filter_settings'] = params['variantFilterSettings'];
         }
@@ -0,0 +1,48 @@
+"""Checks the prefix-sum interval containment against a brute-force scan over all pairs of intervals"""
+
+import numpy as np
+import pytest
+
+from divbrowse.lib.annotation_data import sum_over_contained_intervals
+
+
+
+def make_intervals(rng, count: int, max_length: int):
+    starts = rng.integers(0, 10000, count)
+    ends = starts + rng.integers(0, max_length, count)
+    return starts, ends
+
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_sum_over_contained_intervals(seed):
+    rng = np.random.default_rng(seed)
+    outer_starts, outer_ends = make_intervals(rng, 300, 2000)
+    inner_starts, inner_ends = make_intervals(rng, 1000, 300)
+    inner_weights = rng.integers(0, 50, 1000)
+
+    expected = [
+        inner_weights[(inner_starts >= outer_start) & (inner_ends <= outer_end)].sum()
+        for outer_start, outer_end in zip(outer_starts, outer_ends)
+    ]
+
+    result = sum_over_contained_intervals(outer_starts, outer_ends, inner_starts, inner_ends, inner_weights)
+    assert np.array_equal(result, expected)
+
+
+
+def test_sum_over_contained_intervals_borders():
+    # inner intervals on the borders of the outer interval are contained, those reaching beyond are not
+    result = sum_over_contained_intervals(
+        np.array([100]), np.array([200]),
+        np.array([100, 150, 200, 199, 99]), np.array([200, 160, 200, 201, 150]),
+        np.array([1, 2, 4, 8, 16])
+    )
+    assert result.tolist() == [7]
+
+
+
+def test_sum_over_contained_intervals_without_inner_intervals():
+    empty = np.array([], dtype=np.int64)
+    result = sum_over_contained_intervals(np.array([0, 10]), np.array([5, 20]), empty, empty, empty)
+    assert result.tolist() == [0, 0]
@@ -0,0 +1,107 @@
+"""Checks the caches against a plain reference model and the stability of the cache keys"""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from divbrowse.lib.cache import LRUCache, ResultCache, canonical_hash
+
+
+
+def test_lru_cache_matches_reference_model():
+    rng = np.random.default_rng(0)
+    cache = LRUCache(100, getsizeof=len)
+    reference = OrderedDict()
+
+    for _ in range(5000):
+        key = int(rng.integers(0, 30))
+        if rng.random() < 0.5:
+            value = 'x' * int(rng.integers(0, 120))
+            cache.set(key, value)
+            if len(value) <= 100:
+                reference.pop(key, None)
+                while reference and sum(map(len, reference.values())) + len(value) > 100:
+                    reference.popitem(last=False)
+                reference[key] = value
+        else:
+            expected = reference.get(key, None)
+            if expected is not None:
+                reference.move_to_end(key)
+            assert cache.get(key) == expected
+
+        assert cache.current_size == sum(map(len, reference.values()))
+        assert cache.current_size <= 100
+
+    stats = cache.stats()
+    assert stats['entries'] == len(reference)
+    assert stats['hits'] + stats['misses'] > 0
+
+
+
+def test_lru_cache_counts_hits_and_misses():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    # 'b' was the least recently used entry
+    assert cache.get('b', 'missing') == 'missing'
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats() == {'entries': 2, 'current_size': 2, 'max_size': 2, 'hits': 3, 'misses': 1}
+
+    cache.clear()
+    assert cache.get('a') is None
+    assert cache.current_size == 0
+
+
+
+def test_canonical_hash():
+    assert canonical_hash({'a': 1, 'b': [1, 2]}) == canonical_hash({'b': [1, 2], 'a': 1})
+    assert canonical_hash({'a': 1, 'b': [1, 2]}) != canonical_hash({'a': 1, 'b': [2, 1]})
+    assert canonical_hash({'a': 1}) != canonical_hash({'a': '1 '})
+    assert len(canonical_hash(None)) == 40
+
+
+
+def test_result_cache_memory_and_disk(tmp_path):
+    disk_dir = str(tmp_path / 'results')
+    cache = ResultCache(max_memory_bytes=10, disk_dir=disk_dir, max_disk_bytes=1000)
+
+    cache.set('small', b'12345')
+    cache.set('large', b'x' * 100)
+
+    assert cache.get('small') == b'12345'
+    # too large for the memory tier, read from disk
+    assert cache.get('large') == b'x' * 100
+    assert cache.stats()['disk']['hits'] == 1
+    assert cache.get('unknown') is None
+    assert cache.stats()['disk']['misses'] == 1
+
+    # the disk tier survives a restart, interrupted writes are removed
+    open(os.path.join(disk_dir, 'broken.bin.1.part'), 'wb').close()
+    restarted = ResultCache(max_memory_bytes=1000, disk_dir=disk_dir, max_disk_bytes=1000)
+    assert restarted.disk_size == 105
+    assert restarted.get('large') == b'x' * 100
+    assert not any(filename.endswith('.part') for filename in os.listdir(disk_dir))
+
+
+
+def test_result_cache_evicts_least_recently_used_files(tmp_path):
+    disk_dir = str(tmp_path / 'results')
+    cache = ResultCache(max_memory_bytes=0, disk_dir=disk_dir, max_disk_bytes=250)
+
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.set(key, bytes([i]) * 100)
+        os.utime(os.path.join(disk_dir, key + '.bin'), (i, i))
+
+    assert cache.disk_size <= 250
+    assert cache.get('a') is None
+    assert cache.get('b') == bytes([1]) * 100
+    assert cache.get('c') == bytes([2]) * 100
+
+    # values larger than the disk budget are not written at all
+    cache.set('huge', b'x' * 300)
+    assert cache.get('huge') is None
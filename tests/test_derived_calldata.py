@@ -0,0 +1,122 @@
+"""Checks the derived calldata arrays against the genotypes and the resumption of interrupted runs"""
+
+import numpy as np
+import zarr
+
+from divbrowse.lib.derived_calldata import (
+    MIXED_ALT_ARRAY,
+    NALT_ARRAY,
+    calc_mixed_alt,
+    calc_n_alt,
+    count_chunks_touched,
+    get_replica_path,
+    has_nalt,
+    has_replica,
+    write_nalt,
+    write_replica
+)
+
+
+
+def make_archive(path_zarr: str, count_variants: int = 1000, count_samples: int = 30, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    gt = rng.integers(-1, 4, size=(count_variants, count_samples, 2)).astype(np.int8)
+    callset = zarr.open_group(path_zarr, mode='w')
+    callset.create_dataset('calldata/GT', data=gt, chunks=(128, 16, 2))
+    return gt
+
+
+
+def test_calc_n_alt_and_mixed_alt():
+    gt = np.array([[[0, 0], [0, 1], [1, 1]], [[1, 2], [-1, 1], [2, 0]], [[2, 2], [0, -1], [3, 3]]], dtype=np.int8)
+
+    expected_n_alt = [[sum(allele > 0 for allele in call) if min(call) >= 0 else -1 for call in row] for row in gt.tolist()]
+    assert calc_n_alt(gt).tolist() == expected_n_alt
+    # only the 1/2 call consists of different alternate alleles
+    assert calc_mixed_alt(gt).tolist() == [False, True, False]
+
+
+
+def test_write_nalt_resumes_interrupted_run(tmp_path):
+    path_zarr = str(tmp_path / 'variants.zarr')
+    gt = make_archive(path_zarr)
+
+    write_nalt(path_zarr, chunk_variants=100, workers=1)
+    callset = zarr.open_group(path_zarr, mode='r+')
+    assert has_nalt(callset)
+    assert np.array_equal(callset[NALT_ARRAY][:], calc_n_alt(gt))
+    assert np.array_equal(callset[MIXED_ALT_ARRAY][:], calc_mixed_alt(gt))
+
+    # interrupt after chunks 0 and 2: the other chunks are lost, chunk 0 is marked as done but altered
+    nalt = callset[NALT_ARRAY]
+    nalt.attrs.update({'complete': False, 'chunks_done': [0, 2]})
+    nalt[100:200] = -1
+    nalt[300:] = -1
+    nalt[0:100] = 7
+    assert not has_nalt(callset)
+
+    progress = []
+    write_nalt(path_zarr, chunk_variants=100, workers=1, progress=lambda done, total: progress.append((done, total)))
+
+    assert has_nalt(callset)
+    assert progress[0] == (2, 10) and progress[-1] == (10, 10)
+    assert np.all(nalt[0:100] == 7)
+    assert np.array_equal(nalt[100:], calc_n_alt(gt[100:]))
+
+    # a different chunking is not resumed
+    write_nalt(path_zarr, chunk_variants=200, workers=1)
+    assert np.array_equal(callset[NALT_ARRAY][:], calc_n_alt(gt))
+
+
+
+def test_nalt_without_mixed_alt_flags_is_not_used(tmp_path):
+    path_zarr = str(tmp_path / 'variants.zarr')
+    make_archive(path_zarr)
+
+    write_nalt(path_zarr, workers=1)
+    callset = zarr.open_group(path_zarr, mode='r+')
+    del callset[MIXED_ALT_ARRAY]
+    assert not has_nalt(callset)
+
+    # the flags are missing, so the array is written again instead of resumed
+    write_nalt(path_zarr, workers=1)
+    assert has_nalt(callset)
+
+
+
+def test_write_replica_resumes_interrupted_run(tmp_path):
+    path_zarr = str(tmp_path / 'variants.zarr')
+    gt = make_archive(path_zarr)
+
+    write_replica(path_zarr, chunk_variants=256, chunk_samples=4, max_block_bytes=256 * 4 * 2 * 2, workers=1)
+    callset = zarr.open_group(path_zarr, mode='r+')
+    replica = callset[get_replica_path('calldata/GT')]
+    assert has_replica(callset, 'calldata/GT')
+    assert replica.chunks == (256, 4, 2)
+    assert np.array_equal(replica[:], gt)
+
+    blocks_done = replica.attrs['blocks_done']
+    lost_block = blocks_done[-1]
+    replica.attrs.update({'complete': False, 'blocks_done': blocks_done[:-1]})
+    replica[slice(*lost_block[0]), slice(*lost_block[1])] = -2
+
+    write_replica(path_zarr, chunk_variants=256, chunk_samples=4, max_block_bytes=256 * 4 * 2 * 2, workers=1)
+    assert has_replica(callset, 'calldata/GT')
+    assert np.array_equal(replica[:], gt)
+
+
+
+def test_count_chunks_touched():
+    rng = np.random.default_rng(1)
+    chunks = (100, 8)
+
+    for _ in range(200):
+        samples_mask = rng.random(50) < 0.2
+        variants_indices = np.sort(rng.choice(1000, int(rng.integers(1, 50)), replace=False))
+
+        touched = {(variant // chunks[0], sample // chunks[1]) for variant in variants_indices.tolist() for sample in np.flatnonzero(samples_mask).tolist()}
+        assert count_chunks_touched(variants_indices, samples_mask, chunks) == len(touched)
+
+        start, stop = sorted(rng.integers(0, 1000, 2).tolist())
+        touched = {(variant // chunks[0], sample // chunks[1]) for variant in range(start, stop) for sample in np.flatnonzero(samples_mask).tolist()}
+        assert count_chunks_touched(slice(start, stop), samples_mask, chunks) == len(touched)
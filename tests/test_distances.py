@@ -0,0 +1,103 @@
+"""Checks the bit-plane distances against brute-force calculations on the mean-imputed alternate allele counts"""
+
+import numpy as np
+import pytest
+
+from divbrowse.lib.clustering import condense_distance_matrix
+from divbrowse.lib.distances import count_non_reference_calls, hamming_distance_matrix, pack_genotype_planes, popcount
+
+
+
+def make_n_alt(count_samples: int, count_variants: int, missing_rate: float, seed: int, ploidy: int = 2):
+    rng = np.random.default_rng(seed)
+    n_alt = rng.integers(0, ploidy + 1, size=(count_samples, count_variants), dtype=np.int8)
+    n_alt[rng.random(n_alt.shape) < missing_rate] = -1
+    if count_variants >= 2:
+        # a variant without any called sample and one with only reference calls
+        n_alt[:, 0] = -1
+        n_alt[:, 1] = np.where(n_alt[:, 1] < 0, -1, 0)
+    return n_alt
+
+
+
+def calc_means(n_alt: np.ndarray) -> np.ndarray:
+    called = np.where(n_alt >= 0, n_alt, 0).sum(axis=0)
+    count_called = np.count_nonzero(n_alt >= 0, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return called / count_called
+
+
+
+def impute(n_alt: np.ndarray, means: np.ndarray) -> np.ndarray:
+    return np.where(n_alt < 0, np.nan_to_num(means)[np.newaxis, :], n_alt)
+
+
+
+@pytest.mark.parametrize('count_samples, count_variants, ploidy', [(37, 1000, 2), (130, 200, 2), (20, 65, 4), (50, 1, 2)])
+def test_hamming_distance_matrix(count_samples, count_variants, ploidy):
+    n_alt = make_n_alt(count_samples, count_variants, 0.1, seed=count_samples, ploidy=ploidy)
+    missing_mask = n_alt < 0
+    means = calc_means(n_alt)
+
+    planes = pack_genotype_planes(n_alt, missing_mask, means, block_size=128)
+    distances = hamming_distance_matrix(planes, tile_size=16, n_jobs=2)
+
+    imputed = impute(n_alt, means)
+    expected = (imputed[:, np.newaxis, :] != imputed[np.newaxis, :, :]).sum(axis=2)
+
+    assert np.array_equal(distances, expected)
+
+
+
+def test_pack_genotype_planes_missing_codes():
+    # missing calls are encoded by the mean of their variant if it is integral, otherwise by a separate code
+    n_alt = np.array([[0, 1, 2], [0, 1, 1], [-1, -1, -1]], dtype=np.int8)
+    means = calc_means(n_alt)
+
+    planes = pack_genotype_planes(n_alt, n_alt < 0, means)
+    codes = [
+        [sum(int((planes[plane, sample, 0] >> np.uint64(variant)) & np.uint64(1)) << plane for plane in range(planes.shape[0])) for variant in range(3)]
+        for sample in range(3)
+    ]
+
+    assert planes.shape == (2, 3, 1)
+    assert codes == [[0, 1, 2], [0, 1, 1], [0, 1, 3]]
+    assert popcount(planes[0]).tolist() == [1, 2, 2]
+
+
+
+@pytest.mark.parametrize('missing', ['impute', 'ignore', 'count'])
+def test_count_non_reference_calls(missing):
+    n_alt = make_n_alt(50, 3000, 0.1, seed=3)
+    missing_mask = n_alt < 0
+    means = calc_means(n_alt)
+
+    if missing == 'impute':
+        expected = np.count_nonzero(impute(n_alt, means) > 0, axis=1)
+    elif missing == 'ignore':
+        expected = np.count_nonzero(n_alt > 0, axis=1)
+    else:
+        expected = np.count_nonzero(n_alt != 0, axis=1)
+
+    assert np.array_equal(count_non_reference_calls(n_alt, missing_mask, missing=missing, block_size=256), expected)
+    assert np.array_equal(count_non_reference_calls(n_alt, missing=missing, block_size=256), expected)
+
+
+
+def test_count_non_reference_calls_rejects_unknown_handling():
+    with pytest.raises(ValueError):
+        count_non_reference_calls(np.zeros((2, 2), dtype=np.int8), missing='drop')
+
+
+
+def test_condense_distance_matrix():
+    rng = np.random.default_rng(4)
+    distances = rng.integers(0, 100, size=(40, 40)).astype(np.int32)
+    distances = np.triu(distances, 1) + np.triu(distances, 1).T
+
+    expected = [distances[i, j] for i in range(40) for j in range(i + 1, 40)]
+    condensed = condense_distance_matrix(distances)
+
+    assert condensed.dtype == np.float64
+    assert np.array_equal(condensed, expected)
+    assert condense_distance_matrix(np.zeros((1, 1))).shape == (0,)
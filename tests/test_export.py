@@ -0,0 +1,152 @@
+"""Checks the vectorized VCF and CSV formatting against plain per-call string formatting"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import zarr
+
+from divbrowse.lib.export import (
+    create_nucleotides_lookup_table,
+    generate_nucleotide_rows,
+    generate_vcf_records,
+    genotypes_to_vcf_fields,
+    integers_to_vcf_fields,
+    iter_chunk_aligned_blocks,
+    join_byte_fields
+)
+
+
+
+def format_gt(call) -> str:
+    return '/'.join('.' if allele < 0 else str(allele) for allele in np.atleast_1d(call).tolist())
+
+
+
+def format_dp(value) -> str:
+    return '.' if value < 0 else str(value)
+
+
+
+def make_gt(count_variants: int, count_samples: int, ploidy: int, max_allele: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.integers(-1, max_allele + 1, size=(count_variants, count_samples, ploidy)).astype(np.int8)
+
+
+
+def join_rows(fields) -> list:
+    newlines = np.full((fields[0].shape[0], 1), ord('\n'), dtype=np.uint8)
+    return join_byte_fields([fields, (newlines, np.ones(newlines.shape, dtype=bool))]).decode('utf-8').splitlines()
+
+
+
+@pytest.mark.parametrize('ploidy, max_allele, max_table_size', [(2, 1, 65536), (2, 3, 65536), (2, 12, 16), (1, 2, 65536), (4, 2, 16)])
+def test_genotypes_to_vcf_fields(ploidy, max_allele, max_table_size):
+    gt = make_gt(50, 30, ploidy, max_allele, seed=ploidy)
+    if ploidy == 1:
+        gt = gt[:, :, 0]
+
+    expected = [''.join('\t' + format_gt(call) for call in row) for row in gt]
+
+    assert join_rows(genotypes_to_vcf_fields(gt, max_table_size=max_table_size)) == expected
+
+
+
+@pytest.mark.parametrize('max_value, max_table_size', [(30, 65536), (2 ** 31 - 1, 65536), (300, 100)])
+def test_integers_to_vcf_fields(max_value, max_table_size):
+    rng = np.random.default_rng(0)
+    values = rng.integers(-1, 40, size=(50, 30)).astype(np.int32)
+    values[0, :3] = [max_value, -1, 0]
+
+    expected = [''.join(':' + format_dp(value) for value in row) for row in values.tolist()]
+
+    assert join_rows(integers_to_vcf_fields(values, max_table_size=max_table_size)) == expected
+
+
+
+def test_integers_to_vcf_fields_all_missing():
+    values = np.full((2, 3), -1, dtype=np.int16)
+    assert join_rows(integers_to_vcf_fields(values)) == [':.:.:.', ':.:.:.']
+
+
+
+def test_iter_chunk_aligned_blocks():
+    variants_indices = np.array([3, 4, 9, 10, 11, 12, 25, 2, 5])
+    blocks = [block.tolist() for block in iter_chunk_aligned_blocks(variants_indices, 10, max_block_size=2)]
+
+    assert blocks == [[3, 4], [9], [10, 11], [12], [25], [2, 5]]
+    assert list(iter_chunk_aligned_blocks(np.array([], dtype=np.int64), 10)) == []
+
+
+
+def make_genotype_data(count_variants: int, count_samples: int, seed: int):
+    """Mimics the attributes of GenotypeData that the VCF export reads"""
+
+    rng = np.random.default_rng(seed)
+    callset = zarr.group()
+    gt = make_gt(count_variants, count_samples, 2, 2, seed)
+    dp = rng.integers(-1, 60, size=(count_variants, count_samples)).astype(np.int16)
+    callset.create_dataset('calldata/GT', data=gt, chunks=(16, 8, 2))
+    callset.create_dataset('calldata/DP', data=dp, chunks=(16, 8))
+
+    alts = np.stack([rng.choice(['A', 'C'], count_variants), rng.choice(['', 'T'], count_variants)], axis=1)
+    gd = SimpleNamespace(
+        callset = callset,
+        calldata = callset['calldata/GT'],
+        reference_allele = zarr.array(rng.choice(['G', 'GT'], count_variants)),
+        alternate_alleles = zarr.array(alts),
+        variants_qual = zarr.array(rng.integers(0, 100, count_variants).astype(np.float32) / 4),
+        pos = np.arange(count_variants) * 10 + 100,
+        get_calldata_array = lambda source, variants_selection, samples_mask: callset[source]
+    )
+    return gd, gt, dp
+
+
+
+@pytest.mark.parametrize('with_dp', [False, True])
+def test_generate_vcf_records(with_dp):
+    gd, gt, dp = make_genotype_data(100, 20, seed=1)
+    variants_indices = np.concatenate([np.arange(5, 40), [70, 3, 99]])
+    samples_mask = np.zeros(20, dtype=bool)
+    samples_mask[[0, 3, 4, 11, 19]] = True
+
+    expected = []
+    for i in variants_indices.tolist():
+        alts = [alt for alt in gd.alternate_alleles[i].tolist() if alt != '']
+        columns = ['1', str(gd.pos[i]), '.', str(gd.reference_allele[i]), ','.join(alts), str(gd.variants_qual[i]), 'NA', '', 'GT:DP' if with_dp else 'GT']
+        for sample in np.flatnonzero(samples_mask).tolist():
+            columns.append(format_gt(gt[i, sample]) + (':' + format_dp(dp[i, sample]) if with_dp else ''))
+        expected.append('\t'.join(columns))
+
+    records = ''.join(generate_vcf_records(gd, '1', variants_indices, samples_mask, with_dp=with_dp, max_block_calls=40))
+
+    assert records.splitlines() == expected
+
+
+
+def test_generate_nucleotide_rows():
+    rng = np.random.default_rng(2)
+    ref = rng.choice(['A', 'C', 'G', 'T'], 40)
+    alts = np.stack([rng.choice(['A', 'C', 'G', 'T'], 40), np.full(40, '')], axis=1)
+    n_alt = rng.integers(-1, 3, size=(25, 40)).astype(np.int8)
+    labels = ['sample_' + str(i) for i in range(25)]
+
+    table = create_nucleotides_lookup_table(ref, alts)
+    assert table[:, 3].tolist() == [b'.'] * 40
+    assert table[(ref == 'A') & (alts[:, 0] == 'G'), 1].tolist() == [b'R'] * int(np.count_nonzero((ref == 'A') & (alts[:, 0] == 'G')))
+
+    expected = ''.join(
+        label + ''.join('\t' + table[variant, 3 if value < 0 else value].decode() for variant, value in enumerate(row)) + '\n'
+        for label, row in zip(labels, n_alt.tolist())
+    )
+
+    assert b''.join(generate_nucleotide_rows(n_alt, table, labels, block_size=7)).decode() == expected
+
+    # multi-character alleles are joined row by row
+    table = create_nucleotides_lookup_table(np.char.add(ref, 'A'), alts)
+    expected = ''.join(
+        label + ''.join('\t' + table[variant, 3 if value < 0 else value].decode() for variant, value in enumerate(row)) + '\n'
+        for label, row in zip(labels, n_alt.tolist())
+    )
+
+    assert b''.join(generate_nucleotide_rows(n_alt, table, labels, block_size=7)).decode() == expected
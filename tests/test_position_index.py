@@ -0,0 +1,118 @@
+"""Checks the PositionIndex lookups against brute-force scans of the positions"""
+
+import numpy as np
+import pytest
+
+from divbrowse.lib.position_index import PositionIndex
+
+
+
+def make_index(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    chrom = np.array(['1'] * 300 + ['2'] * 200 + ['3'] * 1, dtype=object)
+    pos = np.concatenate([
+        np.sort(rng.choice(np.arange(1, 5000), 300, replace=False)),
+        np.sort(rng.choice(np.arange(1, 5000), 200, replace=False)),
+        [42]
+    ])
+    return PositionIndex.from_chrom_pos(chrom, pos), chrom, pos
+
+
+
+def brute_force_locate(pos_chrom: np.ndarray, pos: int, method: str):
+    exact = np.flatnonzero(pos_chrom == pos)
+    if exact.size > 0:
+        return int(exact[0]), 'direct_lookup'
+
+    before = np.flatnonzero(pos_chrom < pos)
+    after = np.flatnonzero(pos_chrom > pos)
+
+    if method == 'pad':
+        i = before[-1] if before.size > 0 else 0
+    elif method == 'backfill':
+        i = after[0] if after.size > 0 else pos_chrom.shape[0] - 1
+    elif before.size == 0:
+        i = after[0]
+    elif after.size == 0:
+        i = before[-1]
+    else:
+        # ties are resolved to the next variant
+        i = before[-1] if pos - pos_chrom[before[-1]] < pos_chrom[after[0]] - pos else after[0]
+
+    return int(i), 'nearest_lookup'
+
+
+
+@pytest.mark.parametrize('method', ['nearest', 'pad', 'backfill'])
+def test_locate(method):
+    index, chrom, pos = make_index()
+
+    for _chr in ['1', '2', '3']:
+        start, stop = index.chrom_range(_chr)
+        pos_chrom = pos[chrom == _chr]
+        assert (start, stop) == tuple(np.flatnonzero(chrom == _chr)[[0, -1]] + [0, 1])
+
+        for query in range(0, 5002):
+            i, lookup_type = index.locate(_chr, query, method=method)
+            expected_i, expected_type = brute_force_locate(pos_chrom, query, method)
+            assert (i - start, lookup_type) == (expected_i, expected_type), query
+
+
+
+def test_locate_nearest_tie_resolves_to_next_variant():
+    index = PositionIndex.from_chrom_pos(np.array(['1', '1']), np.array([10, 20]))
+
+    assert index.locate('1', 15) == (1, 'nearest_lookup')
+    assert index.locate('1', 14) == (0, 'nearest_lookup')
+
+
+
+def test_locate_many():
+    index, chrom, pos = make_index()
+    queries = np.arange(0, 5002)
+
+    for _chr in ['1', '2']:
+        start, _ = index.chrom_range(_chr)
+        pos_chrom = pos[chrom == _chr]
+        found, idx = index.locate_many(_chr, queries)
+
+        assert np.array_equal(found, np.isin(queries, pos_chrom))
+        assert np.array_equal(pos[idx[found]], queries[found])
+
+
+
+def test_locate_range():
+    index, chrom, pos = make_index()
+    rng = np.random.default_rng(1)
+
+    for _chr in ['1', '2', '3']:
+        for startpos, endpos in rng.integers(0, 5002, size=(500, 2)).tolist():
+            selected = index.locate_range(_chr, startpos, endpos)
+            expected = np.flatnonzero((chrom == _chr) & (pos >= startpos) & (pos <= endpos))
+            assert np.array_equal(np.arange(selected.start, selected.stop), expected), (startpos, endpos)
+
+
+
+def test_count_in_windows():
+    index, chrom, pos = make_index()
+    rng = np.random.default_rng(2)
+
+    chroms = rng.choice(['1', '2', '3', 'unknown'], 1000)
+    startpos = rng.integers(0, 5002, 1000)
+    endpos = rng.integers(0, 5002, 1000)
+
+    expected = [
+        np.count_nonzero((chrom == _chr) & (pos >= min(_start, _end)) & (pos <= max(_start, _end)))
+        for _chr, _start, _end in zip(chroms, startpos, endpos)
+    ]
+
+    assert np.array_equal(index.count_in_windows(chroms, startpos, endpos), expected)
+
+
+
+def test_from_chrom_pos_rejects_unsorted_and_split_chromosomes():
+    with pytest.raises(ValueError):
+        PositionIndex.from_chrom_pos(np.array(['1', '1']), np.array([20, 10]))
+
+    with pytest.raises(ValueError):
+        PositionIndex.from_chrom_pos(np.array(['1', '2', '1']), np.array([10, 20, 30]))
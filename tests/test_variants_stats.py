@@ -0,0 +1,151 @@
+"""Checks the per-variant statistics of the different read paths against each other and the resumption of `calcsumstats`"""
+
+import os
+
+import numpy as np
+import numcodecs
+import pytest
+import zarr
+
+from divbrowse.lib.derived_calldata import write_nalt
+from divbrowse.lib.variants_stats import (
+    SAMPLES_STATS_GROUP,
+    VARIANTS_STATS_ARRAYS,
+    VARIANTS_STATS_GROUP,
+    calc_variants_stats,
+    calc_variants_stats_from_n_alt,
+    count_n_alt_values,
+    has_variants_stats,
+    write_variants_stats
+)
+
+
+
+def make_gt(count_variants: int, count_samples: int, max_allele: int = 1, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    gt = rng.integers(0, max_allele + 1, size=(count_variants, count_samples, 2)).astype(np.int8)
+    gt[rng.random(gt.shape) < 0.05] = -1
+    return gt
+
+
+
+@pytest.mark.parametrize('variants_axis', [0, 1])
+def test_count_n_alt_values(variants_axis):
+    rng = np.random.default_rng(0)
+    # more than 255 samples and variants than fit into one tile
+    n_alt = rng.integers(-1, 3, size=(300, 700)).astype(np.int8)
+    n_alt[:, :5] = 2
+
+    expected = np.stack([np.count_nonzero(n_alt == value, axis=1) for value in range(-1, 3)], axis=1)
+    counts = count_n_alt_values(n_alt if variants_axis == 0 else n_alt.T, ploidy=2, variants_axis=variants_axis, tile_variants=256)
+
+    assert np.array_equal(counts, expected)
+
+
+
+def test_calc_variants_stats_from_n_alt_matches_genotypes():
+    gt = make_gt(500, 40)
+    gt[0] = -1
+
+    from_gt = calc_variants_stats(gt)
+    n_alt = np.where(np.any(gt < 0, axis=2), -1, np.count_nonzero(gt > 0, axis=2)).astype(np.int8)
+    from_n_alt = calc_variants_stats_from_n_alt(n_alt, ploidy=2)
+
+    for name in VARIANTS_STATS_ARRAYS:
+        assert from_n_alt[name].dtype == np.float32
+        assert np.allclose(from_n_alt[name], from_gt[name], equal_nan=True), name
+
+
+
+def test_write_variants_stats_resumes_interrupted_run(tmp_path):
+    path_zarr = str(tmp_path / 'variants.zarr')
+    gt = make_gt(1000, 30, max_allele=2)
+    callset = zarr.open_group(path_zarr, mode='w')
+    callset.create_dataset('calldata/GT', data=gt, chunks=(128, 16, 2))
+    callset.create_dataset('variants/POS', data=np.arange(1000))
+    callset.create_dataset('variants/ALT', data=np.full((1000, 2), 'A'), dtype='<U1')
+
+    write_variants_stats(path_zarr, workers=1)
+    assert has_variants_stats(callset)
+
+    expected = calc_variants_stats(gt, max_allele=2)
+    variants_group = callset[VARIANTS_STATS_GROUP]
+    for name in VARIANTS_STATS_ARRAYS + ['allele_counts']:
+        assert np.allclose(variants_group[name][:], expected[name], equal_nan=True), name
+    assert np.array_equal(callset[SAMPLES_STATS_GROUP]['count_called'][:], expected['count_called'])
+    assert np.array_equal(callset[SAMPLES_STATS_GROUP]['count_het'][:], expected['count_het'])
+
+    # interrupt after all chunks but 1 and 7: their results are lost, chunk 0 is marked as done but altered
+    chunks_done = np.ones(8, dtype=bool)
+    chunks_done[[1, 7]] = False
+    variants_group['chunks_done'][:] = chunks_done
+    variants_group.attrs['complete'] = False
+    for name in VARIANTS_STATS_ARRAYS:
+        variants_group[name][128:256] = np.nan
+        variants_group[name][896:] = np.nan
+    callset[SAMPLES_STATS_GROUP]['partial_count_het'][7] = 0
+    variants_group['maf'][0:128] = 0.25
+    assert not has_variants_stats(callset)
+
+    progress = []
+    write_variants_stats(path_zarr, workers=1, progress=lambda done, total: progress.append((done, total)))
+
+    assert has_variants_stats(callset)
+    assert progress[0] == (6, 8) and progress[-1] == (8, 8)
+    assert np.all(variants_group['maf'][0:128] == 0.25)
+    for name in VARIANTS_STATS_ARRAYS:
+        assert np.allclose(variants_group[name][128:], expected[name][128:], equal_nan=True), name
+    assert np.array_equal(callset[SAMPLES_STATS_GROUP]['count_het'][:], expected['count_het'])
+
+
+
+def make_genotype_data(datadir: str, gt: np.ndarray):
+    from divbrowse.lib.genotype_data import GenotypeData
+
+    count_variants, count_samples = gt.shape[:2]
+    rng = np.random.default_rng(0)
+    callset = zarr.open_group(os.path.join(datadir, 'variants.zarr'), mode='w')
+    callset.create_dataset('calldata/GT', data=gt, chunks=(100, count_samples, 2))
+    callset.create_dataset('variants/CHROM', data=np.full(count_variants, '1', dtype=object), object_codec=numcodecs.VLenUTF8())
+    callset.create_dataset('variants/POS', data=np.arange(1, count_variants + 1) * 10)
+    callset.create_dataset('variants/REF', data=rng.choice(['A', 'C'], count_variants).astype(object), object_codec=numcodecs.VLenUTF8())
+    callset.create_dataset('variants/ALT', data=np.stack([np.full(count_variants, 'G'), np.full(count_variants, 'T')], axis=1).astype(object), object_codec=numcodecs.VLenUTF8())
+    callset.create_dataset('variants/QUAL', data=np.ones(count_variants, dtype=np.float32))
+    callset.create_dataset('samples', data=np.array(['S' + str(i) for i in range(count_samples)], dtype=object), object_codec=numcodecs.VLenUTF8())
+
+    write_nalt(os.path.join(datadir, 'variants.zarr'), workers=1)
+
+    config = {
+        'datadir': datadir + os.sep,
+        'variants': {'zarr_dir': 'variants.zarr', 'sample_id_mapping_filename': None},
+        'chromosome_labels': {1: '1'},
+        'centromeres_positions': {1: 0},
+        'gff3': {}
+    }
+    return GenotypeData(config)
+
+
+
+def test_heterozygosity_from_nalt_matches_genotypes(tmp_path):
+    gt = make_gt(1000, 30, max_allele=2, seed=1)
+    gd = make_genotype_data(str(tmp_path), gt)
+    assert gd.available['nalt']
+
+    samples_mask = np.ones(30, dtype=bool)
+    samples_mask[[2, 17]] = False
+
+    for variants_selection in [slice(50, 950), np.arange(50, 950, 3)]:
+        expected = calc_variants_stats(gt[variants_selection][:, samples_mask])
+        # calls like 1/2 are heterozygous, even though their number of alternate alleles is the one of 1/1
+        assert np.any(expected['heterozygosity_freq'] != calc_variants_stats_from_n_alt(gd.nalt.get_orthogonal_selection((variants_selection, samples_mask)), 2)['heterozygosity_freq'])
+
+        result = gd.calc_variants_summary_stats_chunked(variants_selection, samples_mask)
+        for name in VARIANTS_STATS_ARRAYS:
+            assert np.allclose(result[name], expected[name], equal_nan=True), name
+
+    variant_calls_slice = gd.get_slice_of_variant_calls('1', startpos=500, endpos=9500, samples=gd.samples[samples_mask], calc_summary_stats=True)
+    assert variant_calls_slice.sliced_variant_calls is None
+    selection = variant_calls_slice.get_variants_selection()
+    expected = calc_variants_stats(gt[selection][:, samples_mask])
+    for name in VARIANTS_STATS_ARRAYS:
+        assert np.allclose(np.asarray(variant_calls_slice.variants_summary_stats[name], dtype=np.float64), expected[name], equal_nan=True), name